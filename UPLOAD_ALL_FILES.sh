@@ -67,10 +67,12 @@ upload "app.py"
 upload "requirements.txt"
 upload "gunicorn_config.py"
 upload "monitor.py"
+upload "manage.py"
 upload "deploy-zero-downtime.sh"
 upload "deploy.sh"
 upload "login.html"
 upload "img" 1
+upload "templates" 1
 
 # Set permissions
 echo ""
@@ -1,10 +1,14 @@
 from fastapi import FastAPI, Request, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse, StreamingResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.requests import Request as StarletteRequest
+from starlette.datastructures import Headers
 from authlib.integrations.starlette_client import OAuth
+from jinja2 import Environment, FileSystemLoader
 try:
     from dotenv import load_dotenv  # type: ignore
     _HAS_DOTENV = True
@@ -13,11 +17,32 @@ except Exception:
     def load_dotenv(*args, **kwargs):
         return False
 import psycopg2
+from psycopg2.extras import execute_values
 import os
+import re
 import html
 import csv
+import base64
+import gzip
+import binascii
+import hashlib
+import json
+import secrets
+import select
+import sqlite3
+import asyncio
+import functools
+import heapq
+import threading
+from bisect import bisect_right
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from io import StringIO, BytesIO
+from urllib.parse import urlencode
 from datetime import datetime, timedelta, date, time
+from time import monotonic
 from typing import Optional, Tuple, List
 
 
@@ -38,6 +63,26 @@ try:
 except Exception:
     SimpleDocTemplate = None  # type: ignore
 
+# Streaming multipart parser (python-multipart; older releases install as "multipart")
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import MultipartParseError
+except Exception:
+    from multipart.multipart import MultipartParser, parse_options_header  # type: ignore
+    from multipart.exceptions import MultipartParseError  # type: ignore
+
+# Optional import for responsive image derivatives
+try:
+    from PIL import Image
+except Exception:
+    Image = None  # type: ignore
+
+# Optional import for brotli-encoded precompressed responses (gzip is always available)
+try:
+    import brotli
+except Exception:
+    brotli = None  # type: ignore
+
 def _ensure_env_file():
     """Create a basic .env on first run so the app can boot with sane defaults."""
     try:
@@ -66,8 +111,145 @@ if _HAS_DOTENV:
 
 app = FastAPI()
 
+# ==== Response Compression ====
+# Responses smaller than this go out uncompressed; the framing overhead is not worth it
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))                       # per-request gzip
+PRECOMPRESS_MAX_BYTES = int(os.getenv("PRECOMPRESS_MAX_BYTES", str(1024 * 1024)))
+COMPRESSIBLE_STATIC_TYPES = ("text/", "image/svg+xml", "application/javascript", "application/json", "application/xml")
+
+# Preferred first when the client accepts several
+_CONTENT_ENCODINGS = ("br", "gzip")
+
+def compress_variants(body: bytes) -> dict:
+    """Encode body once with every available coding, keeping only the ones that shrink it.
+
+    Uses the slowest, densest settings: the result is stored and reused for
+    every request until the underlying page or file changes.
+    """
+    variants = {"identity": body}
+    if len(body) < COMPRESS_MIN_SIZE:
+        return variants
+    encoded = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded["br"] = brotli.compress(body, quality=11)
+    for coding, data in encoded.items():
+        if len(data) < len(body):
+            variants[coding] = data
+    return variants
+
+def negotiate_encoding(accept_encoding: str, available) -> str:
+    """Pick the best coding in available that the Accept-Encoding header allows."""
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip()] = q
+    for coding in _CONTENT_ENCODINGS:
+        if coding in available and accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return "identity"
+
+def precompressed_response(variants: dict, coding: str, media_type: str, headers: Optional[dict] = None) -> Response:
+    """Response for a body stored via compress_variants(), in the coding picked by negotiate_encoding()."""
+    headers = dict(headers or {})
+    if coding != "identity":
+        # GZipMiddleware adds Vary itself to responses it handles, but passes encoded ones through
+        headers["Content-Encoding"] = coding
+        headers["Vary"] = "Accept-Encoding"
+    return Response(content=variants[coding], media_type=media_type, headers=headers)
+
+@functools.lru_cache(maxsize=256)
+def _static_variants(path: str, mtime_ns: int, size: int) -> dict:
+    with open(path, "rb") as f:
+        return compress_variants(f.read())
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that compresses text-like assets (SVG, CSS, JS...) once per file version.
+
+    Raster images are already compressed and stream from disk as before.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        request_headers = Headers(scope=scope)
+        media_type = response.headers.get("content-type", "")
+        if (
+            response.status_code != 200
+            or "range" in request_headers
+            or not media_type.startswith(COMPRESSIBLE_STATIC_TYPES)
+            or not COMPRESS_MIN_SIZE <= stat_result.st_size <= PRECOMPRESS_MAX_BYTES
+        ):
+            return response
+        variants = _static_variants(str(full_path), stat_result.st_mtime_ns, stat_result.st_size)
+        coding = negotiate_encoding(request_headers.get("accept-encoding", ""), variants)
+        headers = {name: response.headers[name] for name in ("etag", "last-modified") if name in response.headers}
+        return precompressed_response(variants, coding, media_type, headers)
+
+# ==== Conditional GET ====
+# Upper bound for Cache-Control max-age on public responses; schedule boundaries cap it further
+PUBLIC_CACHE_MAX_AGE = int(os.getenv("PUBLIC_CACHE_MAX_AGE", "60"))
+
+class CachedBody:
+    """A response body with its strong ETag, expiry and (optionally) precompressed encodings."""
+
+    __slots__ = ("variants", "etag", "expires_at")
+
+    def __init__(self, body: bytes, expires_at: Optional[datetime] = None, precompress: bool = True):
+        self.variants = compress_variants(body) if precompress else {"identity": body}
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.expires_at = expires_at
+
+    @classmethod
+    async def build(cls, body: bytes, expires_at: Optional[datetime] = None, precompress: bool = True):
+        """Construct off the event loop when the body is big enough to be compressed."""
+        if not precompress or len(body) < COMPRESS_MIN_SIZE:
+            return cls(body, expires_at, precompress)
+        return await run_in_threadpool(cls, body, expires_at, precompress)
+
+def encoded_etag(etag: str, coding: str) -> str:
+    """Strong ETags differ per content-coding: "abc" is sent as "abc-br" when brotli-encoded."""
+    return etag if coding == "identity" else f'{etag[:-1]}-{coding}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against etag in any of its encodings."""
+    if not if_none_match:
+        return False
+    candidates = {etag} | {encoded_etag(etag, coding) for coding in _CONTENT_ENCODINGS}
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") in candidates:
+            return True
+    return False
+
+def cache_control_until(expires_at: Optional[datetime], private: bool = False) -> str:
+    max_age = PUBLIC_CACHE_MAX_AGE
+    if expires_at is not None:
+        max_age = min(max_age, max(0, int((expires_at - datetime.now()).total_seconds())))
+    return f"{'private' if private else 'public'}, max-age={max_age}"
+
+def cached_body_response(request: Request, cached: CachedBody, media_type: str, private: bool = False) -> Response:
+    """200 with the best encoding of cached, or 304 when the client already holds it.
+
+    private responses differ per device, so shared caches must not store them.
+    """
+    coding = negotiate_encoding(request.headers.get("accept-encoding", ""), cached.variants)
+    headers = {
+        "ETag": encoded_etag(cached.etag, coding),
+        "Cache-Control": cache_control_until(cached.expires_at, private),
+    }
+    if etag_matches(request.headers.get("if-none-match"), cached.etag):
+        return Response(status_code=304, headers=headers)
+    return precompressed_response(cached.variants, coding, media_type, headers)
+
 # ==== Static Files ====
-app.mount("/img", StaticFiles(directory="img"), name="img")
+app.mount("/img", PrecompressedStaticFiles(directory="img"), name="img")
 
 # ==== Session Middleware ====
 # Configure session with proper cookie settings for OAuth
@@ -88,6 +270,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ==== Compression ====
+# Outermost, so it sees final bodies; responses that already carry a Content-Encoding pass through
+app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=COMPRESS_LEVEL)
+
 load_dotenv()
 
 # ==== Database ====
@@ -97,34 +283,610 @@ DB_CONFIG = {
     "password": os.getenv("DB_PASSWORD"),
     "host": os.getenv("DB_HOST"),
     "port": int(os.getenv("DB_PORT")),
-    "sslmode": "require"
+    "sslmode": os.getenv("DB_SSLMODE", "require")
 }
 
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+# Connection pool sizing (per gunicorn worker)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))            # seconds to wait for a free connection
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))         # close idle connections above min size after this
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "3600"))  # recycle every connection after this
+DB_POOL_CHECK_AFTER = float(os.getenv("DB_POOL_CHECK_AFTER", "30"))    # ping connections idle longer than this on checkout
+
+# Circuit breaker around database connectivity (per gunicorn worker)
+DB_BREAKER_FAILURE_THRESHOLD = int(os.getenv("DB_BREAKER_FAILURE_THRESHOLD", "3"))  # consecutive connectivity errors that open it
+DB_BREAKER_PROBE_INTERVAL = float(os.getenv("DB_BREAKER_PROBE_INTERVAL", "5"))     # seconds between half-open probe requests
+
 def get_connection():
+    """Open a new, unpooled PostgreSQL connection. Request handlers should use db_cursor() instead."""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
+        return psycopg2.connect(**DB_CONFIG, connect_timeout=DB_CONNECT_TIMEOUT)
     except Exception as e:
         print(f"Error connecting to database: {str(e)}")
-        # Try to reconnect with more detailed error handling
+        raise
+
+class DatabaseUnavailable(Exception):
+    """Raised without touching the network while the database circuit breaker is open."""
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker shared by every database call in the worker.
+
+    Closed: calls go through; ``failure_threshold`` consecutive connectivity
+    errors open the breaker. Open: calls fail immediately with
+    DatabaseUnavailable. After ``probe_interval`` seconds it goes half-open and
+    lets one call through as a probe (another every ``probe_interval`` while
+    probes keep failing); a successful call closes it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, probe_interval: float = 5.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._last_probe = 0.0
+        self._counters = {
+            "opened": 0,
+            "rejected": 0,
+            "probes": 0,
+            "failures": 0,
+        }
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def rejecting(self) -> bool:
+        """True (and counted as a rejection) while calls would be refused.
+
+        Lock-free, so handlers can check it on the event loop.
+        """
+        if self._state != self.CLOSED and monotonic() - self._last_probe < self.probe_interval:
+            self._counters["rejected"] += 1
+            return True
+        return False
+
+    def before_call(self):
+        """Raise DatabaseUnavailable unless the call may go ahead (possibly as a probe)."""
+        if self._state == self.CLOSED:
+            return
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            now = monotonic()
+            if now - self._last_probe < self.probe_interval:
+                self._counters["rejected"] += 1
+                raise DatabaseUnavailable(
+                    f"Database circuit breaker is {self._state}; next probe in "
+                    f"{self.probe_interval - (now - self._last_probe):.1f}s"
+                )
+            self._state = self.HALF_OPEN
+            self._last_probe = now
+            self._counters["probes"] += 1
+
+    def record_success(self):
+        if self._state == self.CLOSED and not self._failures:
+            return
+        with self._lock:
+            if self._state != self.CLOSED:
+                print("Database reachable again, closing circuit breaker")
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._counters["failures"] += 1
+            if self._state == self.HALF_OPEN or (
+                    self._state == self.CLOSED and self._failures >= self.failure_threshold):
+                if self._state == self.CLOSED:
+                    self._counters["opened"] += 1
+                    self._opened_at = monotonic()
+                    print(f"Database unreachable after {self._failures} errors, opening circuit breaker")
+                self._state = self.OPEN
+                self._last_probe = monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "failure_threshold": self.failure_threshold,
+                "probe_interval_s": self.probe_interval,
+                "open_for_s": round(monotonic() - self._opened_at, 1) if self._state != self.CLOSED else 0,
+                **self._counters,
+            }
+
+db_breaker = CircuitBreaker(DB_BREAKER_FAILURE_THRESHOLD, DB_BREAKER_PROBE_INTERVAL)
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free within DB_POOL_TIMEOUT."""
+
+class ConnectionPool:
+    """Thread-safe pool of PostgreSQL connections for a single worker process.
+
+    Connections are opened lazily up to ``max_size``. Idle connections above
+    ``min_size`` are closed after ``max_idle`` seconds, every connection is
+    recycled after ``max_lifetime`` seconds, and a connection that sat idle for
+    longer than ``check_after`` seconds is pinged before it is handed out.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=5, timeout=10.0,
+                 max_idle=300.0, max_lifetime=3600.0, check_after=30.0):
+        self._connect = connect
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self._cond = threading.Condition()
+        self._idle = deque()      # (conn, opened_at, last_used), most recently used on the right
+        self._in_use = {}         # id(conn) -> opened_at
+        self._opening = 0
+        self._closed = False
+        self._counters = {
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "connect_errors": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+        }
+
+    def _size_locked(self) -> int:
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _close_quietly(self, conn):
         try:
-            # Try with a timeout
-            conn = psycopg2.connect(
-                dbname=DB_CONFIG['dbname'],
-                user=DB_CONFIG['user'],
-                password=DB_CONFIG['password'],
-                host=DB_CONFIG['host'],
-                port=DB_CONFIG['port'],
-                sslmode=DB_CONFIG['sslmode'],
-                connect_timeout=5
-            )
+            conn.close()
+        except Exception:
+            pass
+        self._counters["connections_closed"] += 1
+
+    def _prune_locked(self, now: float):
+        """Close idle connections that exceeded their idle time or lifetime."""
+        kept = deque()
+        while self._idle:
+            conn, opened_at, last_used = self._idle.popleft()
+            expired = now - opened_at > self.max_lifetime
+            stale = (now - last_used > self.max_idle
+                     and len(kept) + len(self._idle) + len(self._in_use) >= self.min_size)
+            if conn.closed or expired or stale:
+                self._close_quietly(conn)
+            else:
+                kept.append((conn, opened_at, last_used))
+        self._idle = kept
+
+    def _open(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._opening -= 1
+                self._counters["connect_errors"] += 1
+                self._cond.notify()
+            raise
+        now = monotonic()
+        with self._cond:
+            self._opening -= 1
+            self._in_use[id(conn)] = now
+            self._counters["connections_opened"] += 1
+        return conn
+
+    def _healthy(self, conn) -> bool:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        """Check out a connection, waiting up to ``timeout`` seconds for one to free up."""
+        started = monotonic()
+        deadline = started + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                while True:
+                    now = monotonic()
+                    self._prune_locked(now)
+                    if self._idle:
+                        conn, opened_at, last_used = self._idle.pop()
+                        self._in_use[id(conn)] = opened_at
+                        break
+                    if self._size_locked() < self.max_size:
+                        self._opening += 1
+                        conn = None
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout(f"No database connection available within {self.timeout:g}s")
+                    if not waited:
+                        waited = True
+                        self._counters["waits"] += 1
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                conn = self._open()
+            elif now - last_used > self.check_after and not self._healthy(conn):
+                with self._cond:
+                    self._in_use.pop(id(conn), None)
+                    self._counters["health_check_failures"] += 1
+                    self._close_quietly(conn)
+                    self._cond.notify()
+                continue
+
+            with self._cond:
+                self._counters["checkouts"] += 1
+                if waited:
+                    self._counters["wait_time_total"] += monotonic() - started
             return conn
-        except Exception as e:
-            print(f"Failed to connect to database: {str(e)}")
-            # Create a simple in-memory database for fallback
-            import sqlite3
-            print("Falling back to SQLite in-memory database")
-            return sqlite3.connect(":memory:")
+
+    def putconn(self, conn, discard: bool = False):
+        """Return a connection to the pool, closing it if it is broken or expired."""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        now = monotonic()
+        with self._cond:
+            opened_at = self._in_use.pop(id(conn), now)
+            if discard or conn.closed or self._closed or now - opened_at > self.max_lifetime:
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, opened_at, now))
+            self._cond.notify()
+
+    def fill(self):
+        """Open connections until ``min_size`` is reached (used to warm a fresh worker)."""
+        while True:
+            with self._cond:
+                if self._closed or self._size_locked() >= self.min_size:
+                    return
+                self._opening += 1
+            self.putconn(self._open())
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._close_quietly(self._idle.popleft()[0])
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            counters = dict(self._counters)
+            waits = counters.pop("wait_time_total")
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size_locked(),
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "avg_wait_ms": round(waits * 1000 / counters["waits"], 2) if counters["waits"] else 0.0,
+                **counters,
+            }
+
+_pool: Optional[ConnectionPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """Return this process's pool, creating a fresh one after a fork (preload_app)."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ConnectionPool(
+                    get_connection,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    check_after=DB_POOL_CHECK_AFTER,
+                )
+                _pool_pid = pid
+    return _pool
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection; commits on success and rolls back on error.
+
+    Fails fast with DatabaseUnavailable while the circuit breaker is open.
+    Connectivity errors count against the breaker; anything else means the
+    server answered.
+    """
+    db_breaker.before_call()
+    pool = get_pool()
+    try:
+        conn = pool.getconn()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        db_breaker.record_failure()
+        raise
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except BaseException as e:
+        broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, discard=broken)
+        if broken:
+            db_breaker.record_failure()
+        else:
+            db_breaker.record_success()
+
+@contextmanager
+def db_cursor():
+    """Borrow a pooled connection and yield a cursor on it (see db_connection)."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+# ==== Async Database Access ====
+# psycopg2 is blocking, so request handlers must never call the functions above
+# directly from the event loop. run_db() hands them to a small per-worker thread
+# pool and caps how many run at once, so a slow export cannot starve /login.
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", str(DB_POOL_MAX_SIZE)))
+
+_db_executor: Optional[ThreadPoolExecutor] = None
+_db_executor_pid: Optional[int] = None
+_db_semaphore: Optional[asyncio.Semaphore] = None
+_db_waiting = 0
+_db_in_flight = 0
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Return this process's DB thread pool, creating a fresh one after a fork."""
+    global _db_executor, _db_executor_pid, _db_semaphore
+    pid = os.getpid()
+    if _db_executor is None or _db_executor_pid != pid:
+        _db_executor = ThreadPoolExecutor(max_workers=DB_MAX_CONCURRENCY, thread_name_prefix="db")
+        _db_executor_pid = pid
+        _db_semaphore = asyncio.Semaphore(DB_MAX_CONCURRENCY)
+    return _db_executor
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking data-access function off the event loop, at most DB_MAX_CONCURRENCY at a time."""
+    global _db_waiting, _db_in_flight
+    executor = get_db_executor()
+    _db_waiting += 1
+    try:
+        await _db_semaphore.acquire()
+    finally:
+        _db_waiting -= 1
+    _db_in_flight += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    finally:
+        _db_in_flight -= 1
+        _db_semaphore.release()
+
+async def run_db_or_fallback(fallback, func, *args, **kwargs):
+    """run_db(), but while the circuit breaker is open answer from ``fallback()``
+    on the event loop instead of queueing for a database thread."""
+    if db_breaker.rejecting():
+        return fallback()
+    return await run_db(func, *args, **kwargs)
+
+def db_executor_stats() -> dict:
+    return {
+        "max_concurrency": DB_MAX_CONCURRENCY,
+        "in_flight": _db_in_flight,
+        "waiting": _db_waiting,
+    }
+
+# ==== Cross-worker Cache Invalidation ====
+# Writers bump a row in cache_versions and NOTIFY in the same transaction;
+# every worker on every node LISTENs on one dedicated connection and drops
+# the matching in-process cache. If the listener is disconnected, caches fall
+# back to a TTL (see SETTINGS_CACHE_TTL).
+CACHE_NOTIFY_CHANNEL = "nuanu_cache"
+CACHE_LISTEN_RETRY = float(os.getenv("CACHE_LISTEN_RETRY", "5"))
+
+def bump_cache_version(cur, name: str) -> int:
+    """Increment a cache version inside the caller's transaction and notify all workers on commit."""
+    cur.execute("""
+        INSERT INTO cache_versions (name, version) VALUES (%s, 1)
+        ON CONFLICT (name) DO UPDATE
+        SET version = cache_versions.version + 1, updated_at = CURRENT_TIMESTAMP
+        RETURNING version
+    """, (name,))
+    version = cur.fetchone()[0]
+    cur.execute("SELECT pg_notify(%s, %s)", (CACHE_NOTIFY_CHANNEL, f"{name}:{version}"))
+    return version
+
+class CacheListener:
+    """Background thread that LISTENs for cache_versions changes.
+
+    Subscribers are ``callback(version)`` functions keyed by cache name; on
+    (re)connect every subscriber is called with ``None`` because
+    notifications sent while disconnected are lost.
+    """
+
+    def __init__(self, channel: str, retry_interval: float):
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self._subscribers: dict = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._connected = False
+        self._counters = {"notifications": 0, "reconnects": 0}
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    def subscribe(self, name: str, callback):
+        self._subscribers.setdefault(name, []).append(callback)
+
+    def _dispatch(self, name: str, version: Optional[int]):
+        for callback in self._subscribers.get(name, []):
+            try:
+                callback(version)
+            except Exception as e:
+                print(f"Error invalidating {name} cache: {e}")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.retry_interval + 1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = get_connection()
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {self.channel}")
+                self._connected = True
+                self._counters["reconnects"] += 1
+                for name in list(self._subscribers):
+                    self._dispatch(name, None)
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        name, _, version = notify.payload.partition(":")
+                        self._counters["notifications"] += 1
+                        self._dispatch(name, int(version) if version.isdigit() else None)
+            except Exception as e:
+                print(f"Cache listener disconnected: {e}")
+            finally:
+                self._connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._stop.wait(self.retry_interval)
+
+    def stats(self) -> dict:
+        return {
+            "connected": self._connected,
+            "channel": self.channel,
+            **self._counters,
+        }
+
+cache_listener = CacheListener(CACHE_NOTIFY_CHANNEL, CACHE_LISTEN_RETRY)
+
+class NotifiedCache:
+    """Base for per-worker caches kept coherent through cache_listener.
+
+    Subclasses implement ``_fetch() -> (value, version)`` and may override
+    ``_expired(value)``. While the listener is connected a loaded value stays
+    valid until a NOTIFY for ``name`` arrives, so reads cost no database
+    round trip; without the listener it expires after ``ttl`` seconds.
+    """
+
+    def __init__(self, name: str, ttl: float):
+        self.name = name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._value = None
+        self._version: Optional[int] = None
+        self._loaded_at = 0.0
+        self._generation = 0   # bumped by invalidate(); a load that raced one is discarded
+        self._counters = {"hits": 0, "loads": 0, "invalidations": 0}
+        cache_listener.subscribe(name, self.invalidate)
+
+    @property
+    def version(self) -> Optional[int]:
+        return self._version
+
+    def _fetch(self):
+        raise NotImplementedError
+
+    def _expired(self, value) -> bool:
+        return False
+
+    def current(self):
+        """The cached value if it is still valid, else None (never touches the database)."""
+        value = self._value
+        if value is None or self._expired(value):
+            return None
+        if not cache_listener.connected and monotonic() - self._loaded_at >= self.ttl:
+            return None
+        return value
+
+    def is_fresh(self) -> bool:
+        return self.current() is not None
+
+    def get(self):
+        value = self.current()
+        if value is not None:
+            self._counters["hits"] += 1
+            return value
+        return self.load()
+
+    def load(self):
+        generation = self._generation
+        value, version = self._fetch()
+        with self._lock:
+            self._counters["loads"] += 1
+            if generation == self._generation:
+                self._value = value
+                self._version = version
+                self._loaded_at = monotonic()
+        return value
+
+    def invalidate(self, version: Optional[int] = None):
+        """Drop the cached value unless it is already at ``version`` or newer."""
+        with self._lock:
+            if version is not None and self._version is not None and self._version >= version:
+                return
+            self._generation += 1
+            self._value = None
+            self._counters["invalidations"] += 1
+
+    def stats(self) -> dict:
+        return {
+            "version": self._version,
+            "fresh": self.is_fresh(),
+            "age_s": round(monotonic() - self._loaded_at, 1) if self._value is not None else None,
+            "ttl_s": self.ttl,
+            **self._counters,
+        }
 
 DASHBOARD_PASSWORD = os.getenv("DASHBOARD_PASSWORD", "Nuanu0361")
 
@@ -267,10 +1029,351 @@ if FACEBOOK_OAUTH_ENABLED:
         client_kwargs={"scope": "email"},
     )
 
+# ==== Media Store ====
+# Uploaded images are decoded once and written to MEDIA_ROOT/<id[:2]>/<id>,
+# where the media ID is the SHA-256 of the file. The database keeps only the
+# ID and /media/<id> serves the bytes with immutable cache headers. With
+# several nodes, MEDIA_ROOT must be shared storage.
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "media")
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(6 * 1024 * 1024)))
+MEDIA_URL_PREFIX = "/media/"
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_MEDIA_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+class MediaError(ValueError):
+    """Raised for an image value that is not a supported image or is too large."""
+
+class MediaTooLarge(MediaError):
+    """Raised when an image exceeds MEDIA_MAX_BYTES."""
+
+def _too_large_message() -> str:
+    return f"Image is too large. Please keep it under {MEDIA_MAX_BYTES // (1024 * 1024)} MB."
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Content type from the first bytes of a file, or None if it is not a supported image."""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def is_media_id(value) -> bool:
+    return isinstance(value, str) and bool(_MEDIA_ID_RE.match(value))
+
+def media_path(media_id: str) -> str:
+    return os.path.join(MEDIA_ROOT, media_id[:2], media_id)
+
+def _write_media_file(path: str, data: bytes):
+    """Write a file under MEDIA_ROOT atomically, so readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def store_media(data: bytes) -> str:
+    """Write image bytes to the store (once) and return their media ID.
+
+    Responsive derivatives are generated in the background.
+    """
+    if len(data) > MEDIA_MAX_BYTES:
+        raise MediaTooLarge(_too_large_message())
+    if not sniff_image_type(data[:16]):
+        raise MediaError("Invalid image format.")
+    media_id = hashlib.sha256(data).hexdigest()
+    path = media_path(media_id)
+    if not os.path.exists(path):
+        _write_media_file(path, data)
+    schedule_derivatives(media_id)
+    return media_id
+
+def decode_data_uri(value: str) -> bytes:
+    """Decode a base64 ``data:image/...`` URI, enforcing MEDIA_MAX_BYTES."""
+    header, sep, payload = value.partition(",")
+    if not sep or not header.startswith("data:image/") or not header.endswith(";base64"):
+        raise MediaError("Invalid image format.")
+    if len(payload) * 3 // 4 > MEDIA_MAX_BYTES + 2:
+        raise MediaTooLarge(_too_large_message())
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise MediaError("Invalid image format.")
+
+class MediaUpload:
+    """Streams the ``file`` part of a multipart/form-data body into the media store.
+
+    Chunks are hashed and written to a temporary file under MEDIA_ROOT as they
+    arrive. The image type is checked from the first bytes and the size limit
+    is enforced per chunk, so a bad or oversized upload is rejected without
+    being held in memory. Other form fields are ignored.
+    """
+
+    FIELD_NAME = "file"
+
+    def __init__(self, boundary: bytes):
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_end": self._on_end,
+        })
+        self._header_field = b""
+        self._header_value = b""
+        self._in_file_part = False
+        self._file_done = False
+        self._complete = False   # closing boundary seen
+        self._head = b""
+        self._size = 0
+        self._hash = hashlib.sha256()
+        self._tmp_path: Optional[str] = None
+        self._file = None
+
+    def _on_part_begin(self):
+        self._in_file_part = False
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_field.lower() == b"content-disposition" and not self._file_done:
+            _, options = parse_options_header(self._header_value)
+            self._in_file_part = options.get(b"name") == self.FIELD_NAME.encode()
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if not self._in_file_part:
+            return
+        chunk = data[start:end]
+        self._size += len(chunk)
+        if self._size > MEDIA_MAX_BYTES:
+            raise MediaTooLarge(_too_large_message())
+        if self._file is None:
+            os.makedirs(os.path.join(MEDIA_ROOT, "tmp"), exist_ok=True)
+            self._tmp_path = os.path.join(MEDIA_ROOT, "tmp", f"upload.{os.getpid()}.{threading.get_ident()}.{id(self)}")
+            self._file = open(self._tmp_path, "wb")
+        if len(self._head) < 16:
+            self._head += chunk[:16 - len(self._head)]
+            if len(self._head) >= 16 and not sniff_image_type(self._head):
+                raise MediaError("Invalid image format.")
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def _on_part_end(self):
+        if self._in_file_part:
+            self._in_file_part = False
+            self._file_done = True
+
+    def _on_end(self):
+        self._complete = True
+
+    def write(self, chunk: bytes):
+        try:
+            self._parser.write(chunk)
+        except MultipartParseError:
+            raise MediaError("Malformed upload.")
+
+    def finish(self) -> str:
+        """Validate the completed upload and move it into place; returns the media ID."""
+        try:
+            self._parser.finalize()
+        except MultipartParseError:
+            raise MediaError("Malformed upload.")
+        if not self._complete:
+            # The body ended before the closing boundary: the upload was truncated
+            raise MediaError("Malformed upload.")
+        if self._file is None:
+            raise MediaError("Please upload an image.")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        if not sniff_image_type(self._head):
+            raise MediaError("Invalid image format.")
+        media_id = self._hash.hexdigest()
+        path = media_path(media_id)
+        if os.path.exists(path):
+            os.remove(self._tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._tmp_path, path)
+        self._tmp_path = None
+        schedule_derivatives(media_id)
+        return media_id
+
+    def abort(self):
+        """Discard a partial upload."""
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+        if self._tmp_path:
+            try:
+                os.remove(self._tmp_path)
+            except OSError:
+                pass
+            self._tmp_path = None
+
+def normalize_media_ref(value: str) -> str:
+    """Turn a submitted image value into the media ID the database stores.
+
+    Accepts a data URI (decoded and stored), a /media/<id> URL, a CSS
+    url(...) around either, or a bare media ID. Empty stays empty.
+    """
+    cleaned = extract_media_url(value or "")
+    if not cleaned:
+        return ""
+    if cleaned.startswith("data:"):
+        return store_media(decode_data_uri(cleaned))
+    candidate = cleaned
+    if MEDIA_URL_PREFIX in candidate:
+        candidate = candidate.split(MEDIA_URL_PREFIX, 1)[1].split("?", 1)[0]
+    if is_media_id(candidate) and os.path.exists(media_path(candidate)):
+        return candidate
+    raise MediaError("Invalid image format.")
+
+def media_url(value: str) -> str:
+    """Public URL for a stored image value: media IDs map to /media/<id>, anything else is returned as is."""
+    if is_media_id(value):
+        return MEDIA_URL_PREFIX + value
+    return value or ""
+
+# ---- Responsive derivatives ----
+# Each stored image gets width-bounded WebP and JPEG copies named
+# <id>-<width>.<ext> next to the original, plus <id>.json listing the widths
+# produced. Widths at or above the original's are skipped (no upscaling).
+MEDIA_DERIVATIVE_WIDTHS = tuple(sorted(
+    int(w) for w in os.getenv("MEDIA_DERIVATIVE_WIDTHS", "480,960,1920").split(",") if w.strip()
+))
+MEDIA_WEBP_QUALITY = int(os.getenv("MEDIA_WEBP_QUALITY", "80"))
+MEDIA_JPEG_QUALITY = int(os.getenv("MEDIA_JPEG_QUALITY", "82"))
+MEDIA_DERIVATIVE_TYPES = {"webp": "image/webp", "jpg": "image/jpeg"}
+
+# sizes attribute for the ad card on the server-rendered /login page and for
+# the ad thumbnail in the static login.html (fed by /api/bootstrap and /api/active-ad)
+AD_CARD_IMAGE_SIZES = "(max-width: 520px) 100vw, 480px"
+AD_THUMB_IMAGE_SIZES = "(max-width: 640px) 35vw, 182px"
+
+_MEDIA_NAME_RE = re.compile(r"^([0-9a-f]{64})(?:-(\d+)\.(webp|jpg))?$")
+
+_media_executor: Optional[ThreadPoolExecutor] = None
+_media_executor_pid: Optional[int] = None
+_derivatives_pending: set = set()
+_derivative_widths: dict = {}   # media_id -> widths on disk, filled once the manifest exists
+_derivatives_lock = threading.Lock()
+
+def derivative_name(media_id: str, width: int, ext: str) -> str:
+    return f"{media_id}-{width}.{ext}"
+
+def get_media_executor() -> ThreadPoolExecutor:
+    """Single background thread per process for image work, recreated after a fork."""
+    global _media_executor, _media_executor_pid
+    pid = os.getpid()
+    if _media_executor is None or _media_executor_pid != pid:
+        _media_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media")
+        _media_executor_pid = pid
+        _derivatives_pending.clear()
+    return _media_executor
+
+def build_derivatives(media_id: str) -> list:
+    """Render the resized WebP/JPEG copies of a stored image; returns the widths produced."""
+    with Image.open(media_path(media_id)) as original:
+        original.seek(0)
+        source = original.convert("RGBA" if "A" in original.getbands() or original.mode == "P" else "RGB")
+    widths = [w for w in MEDIA_DERIVATIVE_WIDTHS if w < source.width]
+    for width in widths:
+        height = max(1, round(source.height * width / source.width))
+        resized = source.resize((width, height), Image.LANCZOS)
+        buf = BytesIO()
+        resized.save(buf, "WEBP", quality=MEDIA_WEBP_QUALITY, method=4)
+        _write_media_file(media_path(derivative_name(media_id, width, "webp")), buf.getvalue())
+        if resized.mode == "RGBA":
+            flattened = Image.new("RGB", resized.size, (255, 255, 255))
+            flattened.paste(resized, mask=resized.getchannel("A"))
+            resized = flattened
+        buf = BytesIO()
+        resized.save(buf, "JPEG", quality=MEDIA_JPEG_QUALITY, optimize=True, progressive=True)
+        _write_media_file(media_path(derivative_name(media_id, width, "jpg")), buf.getvalue())
+    manifest = {"width": source.width, "height": source.height, "widths": widths}
+    _write_media_file(media_path(media_id) + ".json", json.dumps(manifest).encode())
+    return widths
+
+def _build_derivatives_job(media_id: str):
+    started = monotonic()
+    try:
+        widths = build_derivatives(media_id)
+        with _derivatives_lock:
+            _derivative_widths[media_id] = widths
+        print(f"Built {len(widths)} derivative widths for media {media_id[:12]} in {(monotonic() - started) * 1000:.0f}ms")
+    except Exception as e:
+        print(f"Error building derivatives for media {media_id[:12]}: {e}")
+    finally:
+        with _derivatives_lock:
+            _derivatives_pending.discard(media_id)
+
+def schedule_derivatives(media_id: str):
+    """Queue derivative generation unless Pillow is missing or it is already queued."""
+    if Image is None:
+        return
+    executor = get_media_executor()
+    with _derivatives_lock:
+        if media_id in _derivatives_pending or media_id in _derivative_widths:
+            return
+        _derivatives_pending.add(media_id)
+    executor.submit(_build_derivatives_job, media_id)
+
+def get_derivative_widths(media_id: str) -> list:
+    """Widths whose derivatives are on disk; empty (and generation queued) if not built yet."""
+    widths = _derivative_widths.get(media_id)
+    if widths is not None:
+        return widths
+    try:
+        with open(media_path(media_id) + ".json", "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        if os.path.exists(media_path(media_id)):
+            schedule_derivatives(media_id)
+        return []
+    widths = manifest.get("widths", [])
+    with _derivatives_lock:
+        _derivative_widths[media_id] = widths
+    return widths
+
+def media_srcset(media_id: str, ext: str) -> str:
+    """srcset value listing the ``ext`` derivatives of a media ID (empty until they exist)."""
+    if not is_media_id(media_id):
+        return ""
+    return ", ".join(
+        f"{MEDIA_URL_PREFIX}{derivative_name(media_id, width, ext)} {width}w"
+        for width in get_derivative_widths(media_id)
+    )
+
+def media_id_from_src(src: str) -> Optional[str]:
+    """Media ID behind a /media/<id> URL, or None for any other image source."""
+    if src and src.startswith(MEDIA_URL_PREFIX) and is_media_id(src[len(MEDIA_URL_PREFIX):]):
+        return src[len(MEDIA_URL_PREFIX):]
+    return None
+
+@functools.lru_cache(maxsize=1024)
+def media_content_type(name: str) -> str:
+    match = _MEDIA_NAME_RE.match(name)
+    if match and match.group(3):
+        return MEDIA_DERIVATIVE_TYPES[match.group(3)]
+    with open(media_path(name), "rb") as f:
+        return sniff_image_type(f.read(16)) or "application/octet-stream"
+
 # ==== DB Init ====
-def init_db():
-    conn = get_connection()
-    cur = conn.cursor()
+def _migrate_initial_schema(cur):
     cur.execute("""
         CREATE TABLE IF NOT EXISTS trial_emails (
             id SERIAL PRIMARY KEY,
@@ -344,192 +1447,840 @@ def init_db():
         CREATE INDEX IF NOT EXISTS idx_scheduled_ads_dates 
         ON scheduled_ads(start_date, end_date, is_active)
     """)
-    
-    conn.commit()
-    cur.close()
-    conn.close()
 
-def get_page_settings():
-    """Retrieve all page settings as a dictionary"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT setting_key, setting_value FROM page_settings")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return {key: value for key, value in rows}
-
-def get_active_scheduled_ad():
-    """Get the currently active scheduled ad based on current date/time"""
-    from datetime import datetime, time
-    
-    try:
-        conn = None
-        cur = None
-        
+def _migrate_cache_versions(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("INSERT INTO cache_versions (name) VALUES ('page_settings') ON CONFLICT (name) DO NOTHING")
+
+def _migrate_inline_images_to_media(cur):
+    """Move legacy base64 data URIs out of the database into the media store."""
+    cur.execute("SELECT setting_key, setting_value FROM page_settings WHERE setting_value LIKE 'data:image/%'")
+    for key, value in cur.fetchall():
         try:
-            conn = get_connection()
-            # Check if we're using SQLite (fallback) or PostgreSQL
-            is_sqlite = isinstance(conn, sqlite3.Connection) if 'sqlite3' in globals() else False
-            
-            if is_sqlite:
-                # SQLite fallback implementation
-                return None
-                
-            # PostgreSQL implementation
-            cur = conn.cursor()
-            now = datetime.now()
-            current_date = now.date()
-            current_time = now.time()
-            
-            # Find active scheduled ad that matches current date and time
-            query = """
-                SELECT id, title, description, background_image, background_image_type, 
-                       background_image_data, background_color, page_title, button_text,
-                       start_date, end_date, start_time, end_time
-                FROM scheduled_ads
-                WHERE is_active = TRUE
-                  AND start_date <= %s
-                  AND end_date >= %s
-                  AND (
-                    (start_date < %s AND end_date > %s) OR
-                    (start_date = %s AND start_time <= %s AND end_date > %s) OR
-                    (start_date < %s AND end_date = %s AND end_time >= %s) OR
-                    (start_date = %s AND end_date = %s AND start_time <= %s AND end_time >= %s)
-                  )
-                ORDER BY start_date DESC, start_time DESC
-                LIMIT 1
-            """
-            
-            params = (
-                current_date, current_date,  # start_date <= current_date, end_date >= current_date
-                current_date, current_date,   # start_date < current_date, end_date > current_date
-                current_date, current_time, current_date,  # start_date = current_date, start_time <= current_time, end_date > current_date
-                current_date, current_date, current_time,  # start_date < current_date, end_date = current_date, end_time >= current_time
-                current_date, current_date, current_time, current_time  # start_date = end_date = current_date, start_time <= current_time <= end_time
-            )
-            
-            cur.execute(query, params)
-            row = cur.fetchone()
-            
-            if row:
-                return {
-                    'id': row[0],
-                    'title': row[1],
-                    'description': row[2],
-                    'background_image': row[3],
-                    'background_image_type': row[4],
-                    'background_image_data': row[5],
-                    'background_color': row[6],
-                    'page_title': row[7],
-                    'button_text': row[8],
-                    'start_date': row[9],
-                    'end_date': row[10],
-                    'start_time': row[11],
-                    'end_time': row[12]
-                }
-                
-        except Exception as e:
-            print(f"Error in get_active_scheduled_ad: {str(e)}")
-            if conn:
-                conn.rollback()
-            # Return a default ad or None if there's an error
-            return {
-                'id': 0,
-                'title': 'Welcome to NUANU WiFi',
-                'description': 'Please connect to our WiFi network',
-                'background_image': None,
-                'background_image_type': 'url',
-                'background_image_data': '',
-                'background_color': '#667eea',
-                'page_title': 'Welcome to NUANU WiFi',
-                'button_text': 'Connect to WiFi',
-                'start_date': datetime.now().date(),
-                'end_date': (datetime.now() + timedelta(days=365)).date(),
-                'start_time': time(0, 0),
-                'end_time': time(23, 59)
-            }
-            
-        finally:
-            if cur:
-                cur.close()
-            if conn and not is_sqlite:  # Don't close SQLite connection as it's in-memory
-                conn.close()
-                
-    except Exception as e:
-        print(f"Critical error in get_active_scheduled_ad: {str(e)}")
-        return None
-        
-    return None
-    return None
+            media_id = store_media(decode_data_uri(value))
+        except MediaError as e:
+            print(f"Leaving page setting {key} inline: {e}")
+            continue
+        cur.execute("UPDATE page_settings SET setting_value = %s WHERE setting_key = %s", (media_id, key))
+    cur.execute("SELECT id, background_image_data FROM scheduled_ads WHERE background_image_data LIKE 'data:image/%'")
+    for ad_id, value in cur.fetchall():
+        try:
+            media_id = store_media(decode_data_uri(value))
+        except MediaError as e:
+            print(f"Leaving scheduled ad {ad_id} image inline: {e}")
+            continue
+        cur.execute("UPDATE scheduled_ads SET background_image_data = %s WHERE id = %s", (media_id, ad_id))
+    bump_cache_version(cur, "page_settings")
+
+def _migrate_schedule_periods(cur):
+    """Store each schedule as a tsrange and let an exclusion constraint forbid overlaps.
+
+    scheduled_ad_period() gives the half-open window in which a row is live,
+    with the same NULL-time rules ACTIVE_ADS_QUERY always had; windows that
+    can never be live are empty and overlap nothing. If active rows already
+    overlap, the migration stops and lists them rather than choosing which
+    ads go offline; an admin deactivates or reschedules them and restarts.
+    """
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION scheduled_ad_period(start_date DATE, start_time TIME, end_date DATE, end_time TIME)
+        RETURNS tsrange
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$
+            SELECT CASE WHEN lo < hi THEN tsrange(lo, hi, '[)') ELSE 'empty'::tsrange END
+            FROM (SELECT
+                CASE WHEN start_time IS NULL THEN (start_date + 1)::timestamp
+                     ELSE start_date + start_time END AS lo,
+                CASE WHEN end_time IS NULL THEN end_date::timestamp
+                     ELSE end_date + end_time + interval '1 microsecond' END AS hi
+            ) bounds
+        $$
+    """)
+    cur.execute("""
+        ALTER TABLE scheduled_ads ADD COLUMN IF NOT EXISTS active_period tsrange
+        GENERATED ALWAYS AS (scheduled_ad_period(start_date, start_time, end_date, end_time)) STORED
+    """)
+    cur.execute("""
+        SELECT s.id, array_agg(o.id ORDER BY o.id)
+        FROM scheduled_ads s
+        JOIN scheduled_ads o ON o.is_active AND o.id < s.id AND o.active_period && s.active_period
+        WHERE s.is_active
+        GROUP BY s.id
+        ORDER BY s.id
+    """)
+    conflicts = cur.fetchall()
+    if conflicts:
+        listed = "; ".join(f"{ad_id} overlaps {', '.join(map(str, older))}" for ad_id, older in conflicts)
+        raise RuntimeError(
+            f"Cannot add scheduled_ads_no_overlap, active scheduled ads overlap ({listed}). "
+            "Deactivate or reschedule one ad of each pair, then restart to finish the migration; "
+            "to keep the older ads: UPDATE scheduled_ads SET is_active = FALSE WHERE id IN "
+            f"({', '.join(str(ad_id) for ad_id, _ in conflicts)})"
+        )
+    # The constraint's partial GiST index also serves every range lookup on active rows
+    cur.execute("""
+        ALTER TABLE scheduled_ads ADD CONSTRAINT scheduled_ads_no_overlap
+        EXCLUDE USING gist (active_period WITH &&) WHERE (is_active)
+    """)
+    cur.execute("DROP INDEX IF EXISTS idx_scheduled_ads_dates")
+    bump_cache_version(cur, "scheduled_ads")
 
-def extract_media_url(value: str) -> str:
-    """Strip CSS url() wrapper and surrounding quotes from a value."""
-    if not value:
-        return ""
-    cleaned = value.strip()
-    if not cleaned:
-        return ""
-    if cleaned.startswith("url(") and cleaned.endswith(")"):
-        cleaned = cleaned[4:-1].strip()
-    if cleaned and ((cleaned[0] == cleaned[-1]) and cleaned[0] in ("'", '"')):
-        cleaned = cleaned[1:-1]
-    return cleaned
+def _migrate_schedule_recurrence(cur):
+    """Recurrence rules: a weekday mask and skipped dates, evaluated by schedule_occurrences().
 
-def build_ad_image_src(background_image: str, background_image_type: str, background_image_data: str) -> str:
+    A recurring row's active_period is only the envelope of its occurrences,
+    so the exclusion constraint now covers one-off rows only; overlaps that
+    involve a recurring row are checked occurrence by occurrence in
+    occurrence_conflict(). scheduled_ad_occurs_at() is the SQL form of the
+    rule, used by ACTIVE_ADS_QUERY.
     """
-    Convert the stored background/ad image information into a direct image source (URL or data URI).
-    This keeps compatibility with older records that stored CSS url(...) strings.
+    cur.execute("""
+        ALTER TABLE scheduled_ads
+            ADD COLUMN IF NOT EXISTS recurrence_weekdays SMALLINT CHECK (recurrence_weekdays BETWEEN 1 AND 127),
+            ADD COLUMN IF NOT EXISTS recurrence_exceptions DATE[] NOT NULL DEFAULT '{}'
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION scheduled_ad_occurs_at(
+            start_date DATE, end_date DATE, start_time TIME, end_time TIME,
+            weekdays SMALLINT, exceptions DATE[], at_time TIMESTAMP
+        )
+        RETURNS boolean
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$
+            SELECT EXISTS (
+                SELECT 1
+                FROM (VALUES (at_time::date), (at_time::date - 1)) AS occurrence(d)
+                WHERE d BETWEEN start_date AND end_date
+                  AND weekdays & (1 << (extract(isodow FROM d)::int - 1)) <> 0
+                  AND d <> ALL (exceptions)
+                  AND at_time >= d + COALESCE(start_time, '00:00')
+                  AND at_time < d + COALESCE(end_time, '23:59:59') + interval '1 microsecond'
+                      + CASE WHEN COALESCE(end_time, '23:59:59') < COALESCE(start_time, '00:00')
+                             THEN interval '1 day' ELSE interval '0' END
+            )
+        $$
+    """)
+    # Dropping the column also drops scheduled_ads_no_overlap
+    cur.execute("ALTER TABLE scheduled_ads DROP COLUMN active_period")
+    cur.execute("""
+        ALTER TABLE scheduled_ads ADD COLUMN active_period tsrange
+        GENERATED ALWAYS AS (
+            CASE WHEN recurrence_weekdays IS NULL
+                 THEN scheduled_ad_period(start_date, start_time, end_date, end_time)
+                 ELSE tsrange(start_date::timestamp, (end_date + 2)::timestamp, '[)') END
+        ) STORED
+    """)
+    cur.execute("""
+        ALTER TABLE scheduled_ads ADD CONSTRAINT scheduled_ads_no_overlap
+        EXCLUDE USING gist (active_period WITH &&) WHERE (is_active AND recurrence_weekdays IS NULL)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_scheduled_ads_active_period
+        ON scheduled_ads USING gist (active_period) WHERE is_active
+    """)
+    bump_cache_version(cur, "scheduled_ads")
+
+def _migrate_schedule_rotation(cur):
+    """rotation_weight: active ads that all have one may share time and rotate by weight.
+
+    Ads without a weight still keep their time to themselves, so the exclusion
+    constraint narrows to one-off ads without one; occurrence_conflict()
+    checks every pair that involves a recurring or rotating ad.
     """
-    image_type = (background_image_type or "").lower()
-    data_value = (background_image_data or "").strip()
-    raw_value = (background_image or "").strip()
+    cur.execute("""
+        ALTER TABLE scheduled_ads
+            ADD COLUMN IF NOT EXISTS rotation_weight SMALLINT CHECK (rotation_weight BETWEEN 1 AND 1000)
+    """)
+    cur.execute("ALTER TABLE scheduled_ads DROP CONSTRAINT scheduled_ads_no_overlap")
+    cur.execute("""
+        ALTER TABLE scheduled_ads ADD CONSTRAINT scheduled_ads_no_overlap
+        EXCLUDE USING gist (active_period WITH &&)
+        WHERE (is_active AND recurrence_weekdays IS NULL AND rotation_weight IS NULL)
+    """)
+    bump_cache_version(cur, "scheduled_ads")
 
-    if image_type == "upload" and data_value:
-        # Prefer data URIs, but also handle legacy url(...) values.
-        if data_value.startswith("data:"):
-            return data_value
-        return extract_media_url(data_value)
+def _migrate_ad_event_rollups(cur):
+    """ad_event_hourly: impressions and clicks per ad and hour, added to in batches by AdEventCounters."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ad_event_hourly (
+            ad_id INTEGER NOT NULL REFERENCES scheduled_ads(id) ON DELETE CASCADE,
+            hour TIMESTAMP NOT NULL,
+            impressions BIGINT NOT NULL DEFAULT 0,
+            clicks BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (ad_id, hour)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ad_event_hourly_hour ON ad_event_hourly (hour)")
 
-    if image_type == "url" and raw_value:
-        return extract_media_url(raw_value)
+def _migrate_capture_attribution(cur):
+    """trial_emails.ad_id (the ad live when the email was first captured) and ad_conversions.
 
-    # Fallback for legacy data
-    if data_value:
-        if data_value.startswith("data:"):
-            return data_value
-        return extract_media_url(data_value)
-    if raw_value:
-        return extract_media_url(raw_value)
-    return ""
+    ad_id is deliberately not a foreign key: captures outlive the ads they
+    are attributed to, and a capture buffered while its ad is deleted must
+    still be written. ad_conversions is kept up to date by upsert_trial_emails().
+    """
+    cur.execute("ALTER TABLE trial_emails ADD COLUMN IF NOT EXISTS ad_id INTEGER")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ad_conversions (
+            ad_id INTEGER PRIMARY KEY,
+            captures BIGINT NOT NULL DEFAULT 0,
+            consented BIGINT NOT NULL DEFAULT 0,
+            last_capture_at TIMESTAMP
+        )
+    """)
 
-def serialize_time_value(value):
-    """Return a consistent string for date/time/database values."""
-    if value is None:
-        return ""
-    if isinstance(value, datetime):
-        return value.strftime("%Y-%m-%d %H:%M:%S")
-    if isinstance(value, date):
-        return value.strftime("%Y-%m-%d")
-    if isinstance(value, time):
-        return value.strftime("%H:%M:%S")
-    return str(value)
+def _migrate_email_keyset(cur):
+    """(created_at, id) index for keyset pagination and trial_email_daily signup counts.
 
-def get_all_scheduled_ads():
-    """Get all scheduled ads for admin panel"""
-    conn = get_connection()
-    cur = conn.cursor()
+    Both cover existing rows, so this step reads trial_emails once and holds
+    off capture writes until it commits; captures wait in CaptureQueue or
+    the spool meanwhile. Afterwards upsert_trial_emails() keeps the daily
+    counts current.
+    """
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trial_emails_created_at_id ON trial_emails (created_at, id)")
     cur.execute("""
-        SELECT id, title, description, start_date, end_date, start_time, end_time,
-               is_active, created_at, created_by
-        FROM scheduled_ads
-        ORDER BY start_date DESC, start_time DESC
+        CREATE TABLE IF NOT EXISTS trial_email_daily (
+            day DATE PRIMARY KEY,
+            signups BIGINT NOT NULL DEFAULT 0
+        )
     """)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return [
-        {
+    cur.execute("""
+        INSERT INTO trial_email_daily (day, signups)
+        SELECT created_at::date, COUNT(*)
+        FROM trial_emails
+        WHERE created_at IS NOT NULL
+        GROUP BY 1
+        ON CONFLICT (day) DO UPDATE SET signups = EXCLUDED.signups
+    """)
+
+def _migrate_email_rollups(cur):
+    """trial_emails.source and the per-day consent, source and domain rollups.
+
+    Emails captured before this migration have no source and count towards
+    neither form nor OAuth signups. The rollups are rebuilt here from
+    trial_emails, and `manage.py backfill-rollups` does the same for any
+    range later on.
+    """
+    cur.execute("ALTER TABLE trial_emails ADD COLUMN IF NOT EXISTS source TEXT")
+    cur.execute("""
+        ALTER TABLE trial_email_daily
+            ADD COLUMN IF NOT EXISTS consented BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS form_signups BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS oauth_signups BIGINT NOT NULL DEFAULT 0
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS trial_email_daily_domain (
+            day DATE NOT NULL,
+            domain TEXT NOT NULL,
+            signups BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, domain)
+        )
+    """)
+    rebuild_email_rollups(cur)
+
+# Versioned schema migrations: (version, description, step). Append new
+# entries with the next version number and never edit one that has shipped.
+# Each step receives a cursor; all pending steps run in one transaction.
+# Migration 1 is idempotent so databases created before schema_version
+# existed adopt it cleanly.
+MIGRATIONS = [
+    (1, "initial schema: trial_emails, page_settings, scheduled_ads", _migrate_initial_schema),
+    (2, "cache_versions for cross-worker cache invalidation", _migrate_cache_versions),
+    (3, "move inline data URI images to the media store", _migrate_inline_images_to_media),
+    (4, "scheduled_ads.active_period tsrange with a no-overlap exclusion constraint", _migrate_schedule_periods),
+    (5, "scheduled_ads recurrence rules (weekday mask, skipped dates)", _migrate_schedule_recurrence),
+    (6, "scheduled_ads.rotation_weight for ads sharing time slots", _migrate_schedule_rotation),
+    (7, "ad_event_hourly impression/click rollups", _migrate_ad_event_rollups),
+    (8, "trial_emails.ad_id attribution and ad_conversions rollup", _migrate_capture_attribution),
+    (9, "trial_emails keyset index and trial_email_daily signup counts", _migrate_email_keyset),
+    (10, "trial_emails.source and daily consent, source and domain rollups", _migrate_email_rollups),
+]
+
+# pg_advisory_xact_lock key serializing migrations across workers and hosts
+SCHEMA_MIGRATION_LOCK_ID = 0x6E75616E75
+
+def get_schema_version(cur) -> int:
+    cur.execute("SELECT to_regclass('schema_version')")
+    if cur.fetchone()[0] is None:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+def migrate_db() -> int:
+    """Apply pending migrations under an advisory lock; returns the resulting version.
+
+    Concurrent callers block on the lock and then find nothing left to do.
+    """
+    with db_cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_MIGRATION_LOCK_ID,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        current = get_schema_version(cur)
+        for version, description, step in MIGRATIONS:
+            if version <= current:
+                continue
+            started = monotonic()
+            step(cur)
+            cur.execute(
+                "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                (version, description),
+            )
+            current = version
+            print(f"Applied schema migration {version} ({description}) in {(monotonic() - started) * 1000:.0f}ms")
+        return current
+
+def init_db():
+    """Make sure the schema is current. Up-to-date workers only read schema_version."""
+    with db_cursor() as cur:
+        if get_schema_version(cur) >= MIGRATIONS[-1][0]:
+            return
+    migrate_db()
+
+# Last successful result of the data functions the login page depends on,
+# served while the database is unreachable
+_last_good: dict = {}
+
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "30"))  # only used while the cache listener is down
+
+class SettingsCache(NotifiedCache):
+    """In-process copy of page_settings and its cache_versions number."""
+
+    def _fetch(self):
+        with db_cursor() as cur:
+            cur.execute("""
+                SELECT setting_key, setting_value,
+                       (SELECT version FROM cache_versions WHERE name = 'page_settings')
+                FROM page_settings
+            """)
+            rows = cur.fetchall()
+        return {key: value for key, value, _ in rows}, (rows[0][2] if rows else None)
+
+    def get(self) -> dict:
+        return dict(super().get())
+
+settings_cache = SettingsCache("page_settings", SETTINGS_CACHE_TTL)
+
+def get_page_settings():
+    """Retrieve all page settings as a dictionary (served from settings_cache)"""
+    return settings_cache.get()
+
+SCHEDULE_CACHE_TTL = float(os.getenv("SCHEDULE_CACHE_TTL", "30"))  # only used while the cache listener is down
+# How far ahead ScheduleIndex expands recurring schedules into occurrences
+SCHEDULE_HORIZON = timedelta(days=float(os.getenv("SCHEDULE_HORIZON_DAYS", "7")))
+
+# pg_advisory_xact_lock key held by every scheduled_ads write, so the
+# occurrence checks for recurring schedules cannot race each other
+SCHEDULE_WRITE_LOCK_ID = 0x6E75616E76
+
+# Active means now is in active_period (start_date + start_time <= now <= end_date + end_time)
+# and, for recurring schedules, inside one of their occurrences
+ACTIVE_ADS_QUERY = """
+    SELECT id, title, description, background_image, background_image_type,
+           background_image_data, background_color, page_title, button_text,
+           start_date, end_date, start_time, end_time, is_active, created_by,
+           recurrence_weekdays, recurrence_exceptions, rotation_weight
+    FROM scheduled_ads
+    WHERE is_active = TRUE
+      AND active_period @> %s::timestamp
+      AND (recurrence_weekdays IS NULL OR scheduled_ad_occurs_at(
+            start_date, end_date, start_time, end_time,
+            recurrence_weekdays, recurrence_exceptions, %s::timestamp))
+    ORDER BY start_date DESC, start_time DESC
+"""
+
+def _active_ads_params(now: datetime) -> tuple:
+    return (now, now)
+
+# Active schedules still live at or after %s (NULL for all), for ScheduleIndex;
+# same columns as ACTIVE_ADS_QUERY
+SCHEDULED_ADS_INDEX_QUERY = """
+    SELECT id, title, description, background_image, background_image_type,
+           background_image_data, background_color, page_title, button_text,
+           start_date, end_date, start_time, end_time, is_active, created_by,
+           recurrence_weekdays, recurrence_exceptions, rotation_weight
+    FROM scheduled_ads
+    WHERE is_active = TRUE
+      AND active_period && tsrange(%s, NULL)
+"""
+
+# First active one-off, non-rotating schedule other than %s whose period overlaps the given dates and times
+SCHEDULE_CONFLICT_QUERY = """
+    SELECT id, title, start_date, end_date, start_time, end_time
+    FROM scheduled_ads
+    WHERE is_active = TRUE
+      AND recurrence_weekdays IS NULL
+      AND rotation_weight IS NULL
+      AND id IS DISTINCT FROM %s
+      AND active_period && scheduled_ad_period(%s::date, %s::time, %s::date, %s::time)
+    ORDER BY start_date, start_time
+    LIMIT 1
+"""
+
+def schedule_period(start_date: date, start_time, end_date: date, end_time) -> Tuple[datetime, datetime]:
+    """Half-open [start, end) in which a schedule is live.
+
+    Mirrors scheduled_ad_period() exactly, including NULL times: a NULL
+    start_time only matches from the day after start_date, and a NULL
+    end_time stops matching at the start of end_date. start >= end means
+    the schedule is never live.
+    """
+    if start_time is None:
+        start = datetime.combine(start_date + timedelta(days=1), time.min)
+    else:
+        start = datetime.combine(start_date, start_time)
+    if end_time is None:
+        end = datetime.combine(end_date, time.min)
+    else:
+        end = datetime.combine(end_date, end_time) + timedelta(microseconds=1)
+    return start, end
+
+WEEKDAY_NAMES = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+def parse_weekdays(value) -> int:
+    """Weekday mask (bit 0 = Monday) from a mask, a list of day names/numbers or "mon,wed,fri".
+
+    Day numbers are 0 (Monday) to 6; 0 or an empty value means "does not recur".
+    Raises ValueError for anything else.
+    """
+    if value is None or value == "":
+        return 0
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid recurrence_weekdays: {value}")
+    if isinstance(value, int):
+        if not 0 <= value <= 127:
+            raise ValueError(f"Invalid recurrence_weekdays: {value}")
+        return value
+    if isinstance(value, str):
+        if value.strip().isdigit():
+            return parse_weekdays(int(value))
+        value = re.split(r"[\s,;]+", value.strip())
+    if not isinstance(value, list):
+        raise ValueError(f"Invalid recurrence_weekdays: {value}")
+    mask = 0
+    for day in value:
+        if isinstance(day, int) and not isinstance(day, bool) and 0 <= day <= 6:
+            mask |= 1 << day
+        elif isinstance(day, str) and day[:3].capitalize() in WEEKDAY_NAMES:
+            mask |= 1 << WEEKDAY_NAMES.index(day[:3].capitalize())
+        else:
+            raise ValueError(f"Invalid weekday: {day}")
+    return mask
+
+def parse_exception_dates(value) -> List[date]:
+    """Skipped dates from a list or a comma/space separated string of YYYY-MM-DD dates."""
+    if value is None or value == "":
+        return []
+    if isinstance(value, str):
+        value = re.split(r"[\s,;]+", value.strip())
+    if not isinstance(value, list):
+        raise ValueError(f"Invalid recurrence_exceptions: {value}")
+    try:
+        return sorted({date.fromisoformat(str(day)) for day in value if day})
+    except ValueError:
+        raise ValueError(f"Invalid date in recurrence_exceptions: {value}")
+
+def parse_rotation_weight(value) -> int:
+    """Rotation weight from 1 to 1000; 0 or an empty value means the ad keeps its time to itself."""
+    if value is None or value == "":
+        return 0
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 1000:
+        raise ValueError(f"Invalid rotation_weight: {value}")
+    return value
+
+def format_weekdays(mask: Optional[int]) -> str:
+    if not mask:
+        return ""
+    if mask == 127:
+        return "Every day"
+    return ", ".join(name for i, name in enumerate(WEEKDAY_NAMES) if mask >> i & 1)
+
+def schedule_occurrences(start_date: date, end_date: date, start_time, end_time,
+                         weekdays: Optional[int] = None, exceptions=(),
+                         first_day: Optional[date] = None, last_day: Optional[date] = None):
+    """Half-open [start, end) periods in which a schedule is live, in order.
+
+    A one-off schedule (weekdays None) has the single schedule_period(), if
+    it is not empty. A recurring one is live on each day from start_date to
+    end_date whose weekday is in the mask and that is not an exception, from
+    start_time to end_time (NULL meaning 00:00 and 23:59:59), running past
+    midnight when end_time is earlier than start_time. Matches
+    scheduled_ad_occurs_at(). first_day/last_day bound the days expanded.
+    """
+    if weekdays is None:
+        start, end = schedule_period(start_date, start_time, end_date, end_time)
+        if start < end:
+            yield start, end
+        return
+    daily_start = start_time if start_time is not None else time.min
+    daily_end = end_time if end_time is not None else time(23, 59, 59)
+    length = datetime.combine(date.min, daily_end) - datetime.combine(date.min, daily_start) + timedelta(microseconds=1)
+    if daily_end < daily_start:
+        length += timedelta(days=1)
+    skipped = set(exceptions or ())
+    day = max(start_date, first_day) if first_day else start_date
+    last = min(end_date, last_day) if last_day else end_date
+    while day <= last:
+        if weekdays >> day.weekday() & 1 and day not in skipped:
+            start = datetime.combine(day, daily_start)
+            yield start, start + length
+        day += timedelta(days=1)
+
+def _schedule_interval(row) -> Tuple[datetime, datetime]:
+    """schedule_period() of an ACTIVE_ADS_QUERY row."""
+    return schedule_period(row[9], row[11], row[10], row[12])
+
+def _row_occurrences(row, first_day=None, last_day=None):
+    """schedule_occurrences() of an ACTIVE_ADS_QUERY row."""
+    return schedule_occurrences(row[9], row[10], row[11], row[12], row[15], row[16], first_day, last_day)
+
+def build_alias_table(weights) -> Tuple[tuple, tuple]:
+    """Vose's alias table: alias_pick() then returns i with probability weights[i] / sum(weights)."""
+    n = len(weights)
+    if not n:
+        return (), ()
+    total = float(sum(weights))
+    scaled = [w * n / total for w in weights]
+    prob, alias = [1.0] * n, list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] += scaled[s] - 1.0
+        (small if scaled[l] < 1.0 else large).append(l)
+    # Whatever is left is 1 up to rounding and keeps prob 1.0
+    return tuple(prob), tuple(alias)
+
+def alias_pick(table, u1: float, u2: float) -> int:
+    """O(1) weighted pick from build_alias_table() given two uniforms in [0, 1)."""
+    prob, alias = table
+    i = int(u1 * len(prob))
+    return i if u2 < prob[i] else alias[i]
+
+def _schedule_snapshot(ordered: tuple, valid_until: Optional[datetime]) -> dict:
+    return {
+        "rows": ordered,
+        "ids": tuple(r[0] for r in ordered),
+        "alias": build_alias_table([r[17] or 1 for r in ordered]),
+        "valid_until": valid_until,
+    }
+
+def _schedule_order(row):
+    # ORDER BY start_date DESC, start_time DESC (Postgres puts NULLs first in DESC)
+    return (row[9], row[11] is None, row[11] or time.min, row[0])
+
+class ScheduleIndex:
+    """Active scheduled ads as a sorted boundary list, answering "what is live at T" by bisect.
+
+    Every start and every end of an occurrence is a boundary. Between two
+    neighbouring boundaries the set of live ads cannot change, so each segment
+    keeps a prebuilt snapshot {"rows", "ids", "alias", "valid_until"}: rows in
+    ACTIVE_ADS_QUERY order, their rotation alias table and the boundary at
+    which the segment ends.
+
+    Boundaries are only built up to expanded_until, a rolling horizon ahead
+    of the latest lookup. at() extends it before lookups get close, sweeping
+    just the new occurrences on from the previous live set, so neither a
+    lookup nor an extension depends on how many occurrences lie behind or
+    beyond the horizon. With since given, segments before the lookup time
+    are dropped as the horizon moves.
+    """
+
+    def __init__(self, rows, since: Optional[datetime] = None, horizon: timedelta = SCHEDULE_HORIZON):
+        self.since = since
+        self.horizon = horizon
+        self.size = 0
+        self.ids: set = set()
+        self.expanded_until: Optional[datetime] = None
+        self._order = 0
+        self._pending: list = []      # heap of (when, starts, order, row) not yet swept
+        self._recurring = []
+        self._live: dict = {}
+        self._lock = threading.Lock()
+        for row in rows:
+            if row[15] is None:
+                start, end = _schedule_interval(row)
+                if start < end and (since is None or end > since):
+                    self._push(start, end, row)
+                    self.size += 1
+                    self.ids.add(row[0])
+            elif since is None or row[10] >= since.date() - timedelta(days=1):
+                self._recurring.append(row)
+                self.size += 1
+                self.ids.add(row[0])
+        # (boundaries, segments), replaced whole so readers never need the lock
+        self._table = ((), (_schedule_snapshot((), None),))
+        self._extend((since or datetime.now()) + horizon, since)
+
+    @property
+    def boundaries(self):
+        return self._table[0]
+
+    def _push(self, start: datetime, end: datetime, row):
+        # Ends sort before starts at the same instant, so back-to-back occurrences hand over cleanly
+        heapq.heappush(self._pending, (start, True, self._order, row))
+        heapq.heappush(self._pending, (end, False, self._order + 1, row))
+        self._order += 2
+
+    def _extend(self, until: datetime, drop_before: Optional[datetime] = None):
+        with self._lock:
+            previous = self.expanded_until
+            if previous is not None and until <= previous:
+                return
+            first_day = (previous or self.since).date() - timedelta(days=1) if (previous or self.since) else None
+            for row in self._recurring:
+                for start, end in _row_occurrences(row, first_day, until.date()):
+                    if start >= until:
+                        break
+                    if previous is not None and start < previous:
+                        continue
+                    if previous is None and self.since is not None and end <= self.since:
+                        continue
+                    self._push(start, end, row)
+
+            boundaries, snapshots = [], []
+            if previous is not None and not (self._pending and self._pending[0][0] == previous):
+                # No event at the old horizon: keep the live set but give it a fresh valid_until
+                boundaries.append(previous)
+                snapshots.append(None)
+            while self._pending and self._pending[0][0] < until:
+                when = self._pending[0][0]
+                while self._pending and self._pending[0][0] == when:
+                    _, starts, _, row = heapq.heappop(self._pending)
+                    if starts:
+                        self._live[row[0]] = row
+                    else:
+                        self._live.pop(row[0], None)
+                boundaries.append(when)
+                snapshots.append(tuple(sorted(self._live.values(), key=_schedule_order, reverse=True)))
+            old_boundaries, old_segments = self._table
+            if snapshots and snapshots[0] is None:
+                snapshots[0] = old_segments[-1]["rows"]
+            segments = list(old_segments)
+            ends = boundaries[1:] + [until]
+            segments[-1] = {**segments[-1], "valid_until": boundaries[0] if boundaries else until}
+            segments += [_schedule_snapshot(ordered, valid_until) for ordered, valid_until in zip(snapshots, ends)]
+            boundaries = list(old_boundaries) + boundaries
+            if drop_before is not None:
+                keep = bisect_right(boundaries, drop_before)
+                boundaries, segments = boundaries[keep:], segments[keep:]
+            self._table = (tuple(boundaries), tuple(segments))
+            self.expanded_until = until
+
+    def at(self, when: datetime) -> dict:
+        """Snapshot of the ads live at ``when``; shared, so callers must not modify it."""
+        if when >= self.expanded_until - self.horizon / 2:
+            self._extend(when + self.horizon, when if self.since is not None else None)
+        boundaries, segments = self._table
+        return segments[bisect_right(boundaries, when)]
+
+def rotation_draw(seed: str) -> Tuple[float, float]:
+    """Two uniforms in [0, 1) fixed by a device's rotation seed."""
+    digest = hashlib.blake2b(seed.encode(), digest_size=8).digest()
+    return int.from_bytes(digest[:4], "big") / 2**32, int.from_bytes(digest[4:], "big") / 2**32
+
+def rotation_pick(schedule: dict, seed: Optional[str] = None):
+    """The live row a device with this seed is shown, weighted by rotation_weight.
+
+    Without a seed it is the first row in ACTIVE_ADS_QUERY order.
+    """
+    rows = schedule["rows"]
+    if not rows:
+        return None
+    if seed is None or len(rows) == 1:
+        return rows[0]
+    return rows[alias_pick(schedule["alias"], *rotation_draw(seed))]
+
+class AdScheduleCache(NotifiedCache):
+    """Active scheduled ads, indexed in memory so "live now" never needs a query.
+
+    The cached value is a ScheduleIndex over every active schedule that has not
+    ended yet, recurring ones expanded SCHEDULE_HORIZON ahead. current()/get()
+    return its snapshot for now (see ScheduleIndex), so schedule
+    boundaries and the rolling horizon pass without touching the database;
+    only writes to scheduled_ads reload it, through NOTIFY.
+    """
+
+    def _fetch(self):
+        now = datetime.now()
+        with db_cursor() as cur:
+            cur.execute(SCHEDULED_ADS_INDEX_QUERY, (now,))
+            rows = cur.fetchall()
+            cur.execute("SELECT version FROM cache_versions WHERE name = 'scheduled_ads'")
+            version_row = cur.fetchone()
+        return ScheduleIndex(rows, since=now), (version_row[0] if version_row else 0)
+
+    def current(self):
+        index = super().current()
+        return None if index is None else index.at(datetime.now())
+
+    def load(self):
+        return super().load().at(datetime.now())
+
+    def knows(self, ad_id: int) -> bool:
+        """Whether ad_id is an indexed (active, not yet ended) schedule; True until the first load."""
+        index = self._value
+        return index is None or ad_id in index.ids
+
+    def stats(self) -> dict:
+        index = self._value
+        return {
+            **super().stats(),
+            "indexed_schedules": index.size if index is not None else None,
+            "boundaries": len(index.boundaries) if index is not None else None,
+            "expanded_until": index.expanded_until.isoformat() if index is not None else None,
+        }
+
+ad_schedule = AdScheduleCache("scheduled_ads", SCHEDULE_CACHE_TTL)
+
+def _scheduled_ad_from_row(row) -> dict:
+    return {
+        'id': row[0],
+        'title': row[1],
+        'description': row[2],
+        'background_image': row[3],
+        'background_image_type': row[4],
+        'background_image_data': row[5],
+        'background_color': row[6],
+        'page_title': row[7],
+        'button_text': row[8],
+        'start_date': row[9],
+        'end_date': row[10],
+        'start_time': row[11],
+        'end_time': row[12],
+        'recurrence_weekdays': row[15],
+        'recurrence_exceptions': row[16],
+        'rotation_weight': row[17],
+    }
+
+def get_active_scheduled_ad(seed: Optional[str] = None):
+    """Get the currently active scheduled ad based on current date/time.
+
+    When several ads rotate, it is the one rotation_pick() gives this seed.
+    """
+    try:
+        row = rotation_pick(ad_schedule.get(), seed)
+        ad = _scheduled_ad_from_row(row) if row else None
+        _last_good['active_ad'] = ad
+        return ad
+
+    except Exception as e:
+        print(f"Error in get_active_scheduled_ad: {str(e)}")
+        return get_last_good_active_ad()
+
+def get_last_good_active_ad():
+    """Active ad from the last successful query, while one of its occurrences still covers now.
+
+    Falls back to a default ad when nothing was cached yet.
+    """
+    if 'active_ad' in _last_good:
+        ad = _last_good['active_ad']
+        if ad is None:
+            return None
+        now = datetime.now()
+        occurrences = schedule_occurrences(
+            ad['start_date'], ad['end_date'], ad['start_time'], ad['end_time'],
+            ad['recurrence_weekdays'], ad['recurrence_exceptions'],
+            now.date() - timedelta(days=1), now.date(),
+        )
+        if any(start <= now < end for start, end in occurrences):
+            return ad
+    return {
+            'id': 0,
+            'title': 'Welcome to NUANU WiFi',
+            'description': 'Please connect to our WiFi network',
+            'background_image': None,
+            'background_image_type': 'url',
+            'background_image_data': '',
+            'background_color': '#667eea',
+            'page_title': 'Welcome to NUANU WiFi',
+            'button_text': 'Connect to WiFi',
+            'start_date': datetime.now().date(),
+            'end_date': (datetime.now() + timedelta(days=365)).date(),
+            'start_time': time(0, 0),
+            'end_time': time(23, 59)
+        }
+
+def extract_media_url(value: str) -> str:
+    """Strip CSS url() wrapper and surrounding quotes from a value."""
+    if not value:
+        return ""
+    cleaned = value.strip()
+    if not cleaned:
+        return ""
+    if cleaned.startswith("url(") and cleaned.endswith(")"):
+        cleaned = cleaned[4:-1].strip()
+    if cleaned and ((cleaned[0] == cleaned[-1]) and cleaned[0] in ("'", '"')):
+        cleaned = cleaned[1:-1]
+    return cleaned
+
+def build_ad_image_src(background_image: str, background_image_type: str, background_image_data: str) -> str:
+    """
+    Convert the stored background/ad image information into a direct image source (URL or data URI).
+    Media IDs become /media/<id> URLs; older records with data URIs or CSS url(...) strings still work.
+    """
+    image_type = (background_image_type or "").lower()
+    data_value = (background_image_data or "").strip()
+    raw_value = (background_image or "").strip()
+
+    if is_media_id(data_value):
+        data_value = media_url(data_value)
+
+    if image_type == "upload" and data_value:
+        # Prefer data URIs, but also handle legacy url(...) values.
+        if data_value.startswith("data:"):
+            return data_value
+        return extract_media_url(data_value)
+
+    if image_type == "url" and raw_value:
+        return extract_media_url(raw_value)
+
+    # Fallback for legacy data
+    if data_value:
+        if data_value.startswith("data:"):
+            return data_value
+        return extract_media_url(data_value)
+    if raw_value:
+        return extract_media_url(raw_value)
+    return ""
+
+def serialize_time_value(value):
+    """Return a consistent string for date/time/database values."""
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, time):
+        return value.strftime("%H:%M:%S")
+    return str(value)
+
+def get_all_scheduled_ads():
+    """Get all scheduled ads for admin panel"""
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT id, title, description, start_date, end_date, start_time, end_time,
+                   is_active, created_at, created_by, recurrence_weekdays, recurrence_exceptions,
+                   rotation_weight
+            FROM scheduled_ads
+            ORDER BY start_date DESC, start_time DESC
+        """)
+        rows = cur.fetchall()
+    return [
+        {
             'id': row[0],
             'title': row[1],
             'description': row[2],
@@ -539,23 +2290,319 @@ def get_all_scheduled_ads():
             'end_time': row[6],
             'is_active': row[7],
             'created_at': row[8],
-            'created_by': row[9]
+            'created_by': row[9],
+            'recurrence_weekdays': row[10],
+            'recurrence_exceptions': row[11],
+            'rotation_weight': row[12],
         }
         for row in rows
     ]
 
-def update_page_setting(key: str, value: str):
+# Keys the admin panel may write; anything else in a payload is ignored
+PAGE_SETTING_KEYS = (
+    'google_login_enabled', 'facebook_login_enabled', 'background_image',
+    'background_image_type', 'background_image_data', 'background_color',
+    'page_title', 'button_text',
+)
+
+def update_page_settings(updates: dict) -> int:
+    """Upsert several page settings in one transaction; returns the new settings version.
+
+    All keys are written with a single multi-row statement and the version
+    bump and NOTIFY commit with them, so readers never see a half-applied form.
+    """
+    rows = [
+        (key, "" if value is None else str(value))
+        for key, value in updates.items()
+        if key in PAGE_SETTING_KEYS
+    ]
+    with db_cursor() as cur:
+        if rows:
+            execute_values(cur, """
+                INSERT INTO page_settings (setting_key, setting_value)
+                VALUES %s
+                ON CONFLICT (setting_key) DO UPDATE
+                SET setting_value = EXCLUDED.setting_value,
+                    updated_at = CURRENT_TIMESTAMP
+            """, rows)
+            version = bump_cache_version(cur, "page_settings")
+        else:
+            cur.execute("SELECT version FROM cache_versions WHERE name = 'page_settings'")
+            version = cur.fetchone()[0]
+    settings_cache.invalidate(version)
+    return version
+
+def update_page_setting(key: str, value: str) -> int:
     """Update a specific page setting"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE page_settings 
-        SET setting_value = %s, updated_at = CURRENT_TIMESTAMP 
-        WHERE setting_key = %s
-    """, (value, key))
-    conn.commit()
-    cur.close()
-    conn.close()
+    return update_page_settings({key: value})
+
+def upsert_trial_emails(records: List[dict]):
+    """Insert captured emails, or grant consent to ones already saved, in one multi-row statement.
+
+    Each record has ``email``, ``consented``, ``created_at`` (capture time),
+    ``ad_id`` (the ad live at capture, or None) and ``source`` ("form" or
+    the OAuth provider). Emails must be unique within a batch. Consent is
+    only ever granted, never revoked, and an email keeps the ad and source
+    of its first capture.
+
+    Only new rows and rows whose consent is just granted are touched and
+    returned, so ad_conversions and the daily rollups are brought up to
+    date in the same transaction from exactly those rows.
+    """
+    if not records:
+        return
+    with db_cursor() as cur:
+        changed = execute_values(cur, """
+            INSERT INTO trial_emails (email, is_verified, consented, created_at, ad_id, source)
+            VALUES %s
+            ON CONFLICT (email) DO UPDATE
+            SET is_verified = TRUE, consented = trial_emails.consented OR EXCLUDED.consented
+            WHERE EXCLUDED.consented AND trial_emails.consented IS NOT TRUE
+            RETURNING ad_id, consented, created_at, xmax = 0, email, source
+        """, [(r['email'], r['consented'], r['created_at'], r.get('ad_id'), r.get('source')) for r in records],
+            template="(%s, TRUE, %s, %s, %s, %s)", page_size=len(records), fetch=True)
+        update_ad_conversions(cur, changed)
+        update_email_rollups(cur, changed)
+
+def update_ad_conversions(cur, changed: list):
+    """Add rows returned by upsert_trial_emails to ad_conversions.
+
+    A new email counts as a capture (and as consented if it is); an existing
+    one only adds to consented, when its consent was just granted.
+    """
+    totals: dict = {}
+    for ad_id, consented, created_at, inserted, _, _ in changed:
+        if ad_id is None:
+            continue
+        counts = totals.setdefault(ad_id, [0, 0, None])
+        if inserted:
+            counts[0] += 1
+            counts[2] = max(counts[2] or created_at, created_at)
+        if consented:
+            counts[1] += 1
+    if not totals:
+        return
+    execute_values(cur, """
+        INSERT INTO ad_conversions (ad_id, captures, consented, last_capture_at)
+        VALUES %s
+        ON CONFLICT (ad_id) DO UPDATE
+        SET captures = ad_conversions.captures + EXCLUDED.captures,
+            consented = ad_conversions.consented + EXCLUDED.consented,
+            last_capture_at = GREATEST(ad_conversions.last_capture_at, EXCLUDED.last_capture_at)
+    """, [(ad_id, *counts) for ad_id, counts in sorted(totals.items())],
+        template="(%s, %s, %s, %s::timestamp)")
+
+# Email domains counted on their own in trial_email_daily_domain; the rest are "other".
+# After changing this list, run `manage.py backfill-rollups` to regroup past days.
+EMAIL_DOMAIN_BUCKETS = tuple(
+    d.strip().lower()
+    for d in os.getenv("EMAIL_DOMAIN_BUCKETS", "gmail.com,yahoo.com,hotmail.com,outlook.com,icloud.com").split(",")
+    if d.strip()
+)
+OAUTH_SOURCES = ("google", "facebook")
+
+def email_domain_bucket(email: str) -> str:
+    domain = email.rsplit("@", 1)[-1].strip().lower()
+    return domain if domain in EMAIL_DOMAIN_BUCKETS else "other"
+
+def update_email_rollups(cur, changed: list):
+    """Add rows returned by upsert_trial_emails to trial_email_daily and trial_email_daily_domain.
+
+    Rows are counted on the day of their first capture: a new email adds a
+    signup (by source and domain), and a just-granted consent adds to that
+    day's consented count.
+    """
+    days: dict = {}
+    domains: dict = {}
+    for _, consented, created_at, inserted, email, source in changed:
+        if created_at is None:
+            continue
+        day = created_at.date()
+        counts = days.setdefault(day, [0, 0, 0, 0])
+        if consented:
+            counts[1] += 1
+        if not inserted:
+            continue
+        counts[0] += 1
+        if source == "form":
+            counts[2] += 1
+        elif source in OAUTH_SOURCES:
+            counts[3] += 1
+        key = (day, email_domain_bucket(email))
+        domains[key] = domains.get(key, 0) + 1
+    if not days:
+        return
+    execute_values(cur, """
+        INSERT INTO trial_email_daily (day, signups, consented, form_signups, oauth_signups)
+        VALUES %s
+        ON CONFLICT (day) DO UPDATE
+        SET signups = trial_email_daily.signups + EXCLUDED.signups,
+            consented = trial_email_daily.consented + EXCLUDED.consented,
+            form_signups = trial_email_daily.form_signups + EXCLUDED.form_signups,
+            oauth_signups = trial_email_daily.oauth_signups + EXCLUDED.oauth_signups
+    """, [(day, *counts) for day, counts in sorted(days.items())])
+    if domains:
+        execute_values(cur, """
+            INSERT INTO trial_email_daily_domain (day, domain, signups)
+            VALUES %s
+            ON CONFLICT (day, domain) DO UPDATE SET signups = trial_email_daily_domain.signups + EXCLUDED.signups
+        """, [(day, domain, n) for (day, domain), n in sorted(domains.items())])
+
+def rebuild_email_rollups(cur, start_day: Optional[date] = None, end_day: Optional[date] = None) -> int:
+    """Recompute the daily rollups from trial_emails for start_day..end_day (None: unbounded).
+
+    The rollup tables are locked against ingest for the rebuild, so a batch
+    committed meanwhile is counted exactly once: either it is already in
+    trial_emails when they are re-read, or it waits and adds on top.
+    Returns the number of days written.
+    """
+    params = {"start": start_day, "end": end_day, "oauth": list(OAUTH_SOURCES), "buckets": list(EMAIL_DOMAIN_BUCKETS)}
+    day_range = "(%(start)s::date IS NULL OR day >= %(start)s::date) AND (%(end)s::date IS NULL OR day <= %(end)s::date)"
+    created_range = """
+        created_at IS NOT NULL
+        AND (%(start)s::date IS NULL OR created_at >= %(start)s::date)
+        AND (%(end)s::date IS NULL OR created_at < %(end)s::date + 1)
+    """
+    cur.execute("LOCK TABLE trial_email_daily, trial_email_daily_domain IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(f"DELETE FROM trial_email_daily WHERE {day_range}", params)
+    cur.execute(f"DELETE FROM trial_email_daily_domain WHERE {day_range}", params)
+    cur.execute(f"""
+        INSERT INTO trial_email_daily (day, signups, consented, form_signups, oauth_signups)
+        SELECT created_at::date,
+               COUNT(*),
+               COUNT(*) FILTER (WHERE consented),
+               COUNT(*) FILTER (WHERE source = 'form'),
+               COUNT(*) FILTER (WHERE source = ANY(%(oauth)s))
+        FROM trial_emails
+        WHERE {created_range}
+        GROUP BY 1
+    """, params)
+    written = cur.rowcount
+    cur.execute(f"""
+        INSERT INTO trial_email_daily_domain (day, domain, signups)
+        SELECT created_at::date, bucket, COUNT(*)
+        FROM (
+            SELECT created_at,
+                   CASE WHEN lower(btrim(substring(email from '@([^@]*)$'))) = ANY(%(buckets)s)
+                        THEN lower(btrim(substring(email from '@([^@]*)$')))
+                        ELSE 'other' END AS bucket
+            FROM trial_emails
+            WHERE {created_range}
+        ) AS captured
+        GROUP BY 1, 2
+    """, params)
+    return written
+
+def fetch_ad_conversions(limit: int = 20) -> list:
+    """Top ads by captures from the ad_conversions rollup, with titles of those still scheduled."""
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT c.ad_id, s.title, c.captures, c.consented, c.last_capture_at
+            FROM ad_conversions c
+            LEFT JOIN scheduled_ads s ON s.id = c.ad_id
+            ORDER BY c.captures DESC, c.ad_id
+            LIMIT %s
+        """, (limit,))
+        return cur.fetchall()
+
+def is_email_verified(email: str) -> bool:
+    with db_cursor() as cur:
+        cur.execute("SELECT is_verified FROM trial_emails WHERE email = %s", (email,))
+        row = cur.fetchone()
+    return bool(row and row[0])
+
+def fetch_email_summary(start_dt: Optional[datetime], end_dt: Optional[datetime]) -> dict:
+    """Signup totals, per-day series and domain split between start_dt and end_dt, from the rollups.
+
+    Dashboard ranges are whole days, so this reads one row per day (and
+    per domain bucket) in the range rather than scanning trial_emails.
+    """
+    params = {"start": start_dt.date() if start_dt else None, "end": end_dt.date() if end_dt else None}
+    day_range = "(%(start)s::date IS NULL OR day >= %(start)s::date) AND (%(end)s::date IS NULL OR day <= %(end)s::date)"
+    with db_cursor() as cur:
+        cur.execute(f"""
+            SELECT day, signups, consented, form_signups, oauth_signups
+            FROM trial_email_daily
+            WHERE {day_range}
+            ORDER BY day
+        """, params)
+        days = cur.fetchall()
+        cur.execute(f"""
+            SELECT domain, SUM(signups)
+            FROM trial_email_daily_domain
+            WHERE {day_range}
+            GROUP BY domain
+            ORDER BY 2 DESC, domain
+        """, params)
+        domains = [(domain, int(n)) for domain, n in cur.fetchall()]
+    return {
+        "days": days,
+        "signups": sum(row[1] for row in days),
+        "consented": sum(row[2] for row in days),
+        "form": sum(row[3] for row in days),
+        "oauth": sum(row[4] for row in days),
+        "domains": domains,
+    }
+
+def fetch_email_keyset_page(start_dt: Optional[datetime], end_dt: Optional[datetime], page_size: int,
+                            after: Optional[tuple] = None, before: Optional[tuple] = None, limit: Optional[int] = None):
+    """One dashboard page of (email, created_at, id), newest first, by keyset on (created_at, id).
+
+    after: the last row of the page above, to get the next (older) page.
+    before: the first row of the page below, to get the previous (newer) one.
+    With neither, limit rows from the oldest end (the last page) when given,
+    otherwise the newest page. Returns (rows, more): more tells whether
+    further rows lie beyond this page in the direction it was read.
+    Each page is one index range scan, however deep it is.
+    """
+    conditions, params = ["created_at IS NOT NULL"], []
+    if start_dt and end_dt:
+        conditions.append("created_at BETWEEN %s AND %s")
+        params += [start_dt, end_dt]
+    if after:
+        conditions.append("(created_at, id) < (%s, %s)")
+        params += list(after)
+    elif before:
+        conditions.append("(created_at, id) > (%s, %s)")
+        params += list(before)
+    ascending = bool(before) or (not after and limit is not None)
+    order = "ASC" if ascending else "DESC"
+    count = limit if limit is not None else page_size
+    with db_cursor() as cur:
+        cur.execute(f"""
+            SELECT email, created_at, id
+            FROM trial_emails
+            WHERE {" AND ".join(conditions)}
+            ORDER BY created_at {order}, id {order}
+            LIMIT %s
+        """, (*params, count + 1))
+        rows = cur.fetchall()
+    more = len(rows) > count
+    rows = rows[:count]
+    if ascending:
+        rows.reverse()
+    return rows, more
+
+def email_cursor(row) -> str:
+    """Opaque-enough page cursor for the (created_at, id) of a dashboard row."""
+    return f"{row[1].isoformat()}_{row[2]}"
+
+def parse_email_cursor(value: Optional[str]) -> Optional[tuple]:
+    if not value:
+        return None
+    try:
+        created_at, row_id = value.rsplit("_", 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except ValueError:
+        return None
+
+def fetch_emails_for_export(where_sql: str, params: list):
+    with db_cursor() as cur:
+        cur.execute(
+            f"SELECT email, created_at FROM trial_emails {where_sql} ORDER BY created_at DESC",
+            params,
+        )
+        return cur.fetchall()
 
 def update_env_file(updates: dict):
     """Update .env file with new values. Preserves existing keys and adds new ones."""
@@ -593,9 +2640,559 @@ def update_env_file(updates: dict):
             if key not in written:
                 f.write(f"{key}={value}\n")
 
+# ==== Durable Capture Spool ====
+CAPTURE_SPOOL_PATH = os.getenv("CAPTURE_SPOOL_PATH", os.path.join("spool", "captures.db"))
+SPOOL_REPLAY_INTERVAL = float(os.getenv("SPOOL_REPLAY_INTERVAL", "5"))
+SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", "1000"))
+
+def _merge_capture(pending: dict, record: dict):
+    """Fold a capture into an email-keyed dict: consent is sticky, the earliest capture
+    keeps its timestamp, ad and source."""
+    existing = pending.get(record['email'])
+    if existing:
+        existing['consented'] = existing['consented'] or record['consented']
+        if record['created_at'] < existing['created_at']:
+            existing['created_at'] = record['created_at']
+            existing['ad_id'] = record.get('ad_id')
+            existing['source'] = record.get('source')
+    else:
+        pending[record['email']] = record
+
+class CaptureSpool:
+    """File-backed SQLite spool for captures that could not reach PostgreSQL.
+
+    The table mirrors trial_emails. Each batch is appended in one transaction
+    (one fsync) in WAL mode, so spooled captures survive a worker restart. A
+    background task replays them into trial_emails in bulk once the database
+    is back. All workers share the file; the upsert is idempotent, so two
+    workers replaying the same rows is harmless.
+    """
+
+    def __init__(self, path: str, replay_interval: float, batch_size: int):
+        self.path = path
+        self.replay_interval = replay_interval
+        self.batch_size = max(1, batch_size)
+        self._ready = False
+        self._ready_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._last_replay_rate = 0.0
+        self._last_error: Optional[str] = None
+        self._counters = {
+            "spooled_rows": 0,
+            "replayed_rows": 0,
+            "replay_batches": 0,
+            "replay_failures": 0,
+        }
+
+    def _connect(self):
+        if not self._ready:
+            with self._ready_lock:
+                if not self._ready:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    conn = sqlite3.connect(self.path, timeout=30)
+                    try:
+                        conn.execute("PRAGMA journal_mode=WAL")
+                        conn.execute("""
+                            CREATE TABLE IF NOT EXISTS trial_emails (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                email TEXT NOT NULL,
+                                is_verified INTEGER NOT NULL DEFAULT 1,
+                                consented INTEGER NOT NULL DEFAULT 0,
+                                created_at TEXT NOT NULL,
+                                spooled_at REAL NOT NULL,
+                                ad_id INTEGER,
+                                source TEXT
+                            )
+                        """)
+                        # Spool files written before captures carried their ad and source
+                        columns = {row[1] for row in conn.execute("PRAGMA table_info(trial_emails)")}
+                        if "ad_id" not in columns:
+                            conn.execute("ALTER TABLE trial_emails ADD COLUMN ad_id INTEGER")
+                        if "source" not in columns:
+                            conn.execute("ALTER TABLE trial_emails ADD COLUMN source TEXT")
+                        conn.commit()
+                    finally:
+                        conn.close()
+                    self._ready = True
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def append(self, records: list):
+        """Durably store a batch of capture records (email, consented, created_at, ad_id, source)."""
+        spooled_at = datetime.now().timestamp()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO trial_emails (email, consented, created_at, spooled_at, ad_id, source) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (r['email'], 1 if r['consented'] else 0, r['created_at'].isoformat(), spooled_at, r.get('ad_id'), r.get('source'))
+                        for r in records
+                    ],
+                )
+        finally:
+            conn.close()
+        self._counters["spooled_rows"] += len(records)
+
+    def has_rows(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT 1 FROM trial_emails LIMIT 1").fetchone() is not None
+        finally:
+            conn.close()
+
+    def _take(self, limit: int) -> list:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT id, email, consented, created_at, ad_id, source FROM trial_emails ORDER BY id LIMIT ?",
+                (limit,),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [
+            (row_id, {
+                'email': email,
+                'consented': bool(consented),
+                'created_at': datetime.fromisoformat(created_at),
+                'ad_id': ad_id,
+                'source': source,
+            })
+            for row_id, email, consented, created_at, ad_id, source in rows
+        ]
+
+    def _remove(self, ids: list):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("DELETE FROM trial_emails WHERE id = ?", [(i,) for i in ids])
+        finally:
+            conn.close()
+
+    def replay(self) -> int:
+        """Upsert spooled captures into PostgreSQL batch by batch; returns rows replayed.
+
+        A batch is deleted from the spool only after its upsert has committed,
+        so a failure part-way leaves the remainder for the next attempt.
+        """
+        replayed = 0
+        started = monotonic()
+        while True:
+            rows = self._take(self.batch_size)
+            if not rows:
+                break
+            merged: dict = {}
+            for _, record in rows:
+                _merge_capture(merged, record)
+            upsert_trial_emails(list(merged.values()))
+            self._remove([row_id for row_id, _ in rows])
+            replayed += len(rows)
+            self._counters["replayed_rows"] += len(rows)
+            self._counters["replay_batches"] += 1
+        if replayed:
+            self._last_replay_rate = replayed / max(monotonic() - started, 1e-6)
+        return replayed
+
+    def start(self):
+        self._stopping = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if await run_in_threadpool(self.has_rows):
+                    replayed = await run_db(self.replay)
+                    self._last_error = None
+                    if replayed:
+                        print(f"Replayed {replayed} spooled captures into trial_emails")
+            except Exception as e:
+                self._counters["replay_failures"] += 1
+                self._last_error = str(e)
+                print(f"Error replaying capture spool: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.replay_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        rows, oldest = 0, None
+        size = 0
+        if os.path.exists(self.path):
+            conn = self._connect()
+            try:
+                rows, oldest = conn.execute("SELECT COUNT(*), MIN(spooled_at) FROM trial_emails").fetchone()
+            finally:
+                conn.close()
+            for suffix in ("", "-wal"):
+                try:
+                    size += os.path.getsize(self.path + suffix)
+                except OSError:
+                    pass
+        return {
+            "path": self.path,
+            "rows": rows,
+            "bytes": size,
+            "lag_seconds": round(datetime.now().timestamp() - oldest, 1) if oldest else 0,
+            "replay_rate_rows_per_sec": round(self._last_replay_rate, 1),
+            "replay_interval_s": self.replay_interval,
+            "last_error": self._last_error,
+            **self._counters,
+        }
+
+capture_spool = CaptureSpool(CAPTURE_SPOOL_PATH, SPOOL_REPLAY_INTERVAL, SPOOL_REPLAY_BATCH)
+
+# ==== Write-behind Email Ingestion ====
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "250"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "20000"))
+INGEST_ENQUEUE_TIMEOUT = float(os.getenv("INGEST_ENQUEUE_TIMEOUT", "2"))
+
+class CaptureQueue:
+    """Per-worker write-behind buffer for captured emails.
+
+    Handlers enqueue a capture and answer the guest immediately. A background
+    task upserts the buffer every INGEST_FLUSH_MS, or as soon as
+    INGEST_BATCH_SIZE captures are waiting, with one multi-row statement.
+    Repeated captures of the same email are merged while buffered. When
+    INGEST_MAX_PENDING captures are buffered, enqueue() waits for a flush
+    (backpressure) and after INGEST_ENQUEUE_TIMEOUT writes the row itself
+    instead of dropping it.
+    """
+
+    def __init__(self, flush_interval: float, batch_size: int, max_pending: int, enqueue_timeout: float):
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, batch_size)
+        self.max_pending = max(self.batch_size, max_pending)
+        self.enqueue_timeout = enqueue_timeout
+        self._pending: dict = {}     # email -> record, insertion ordered
+        self._in_flight: dict = {}   # records currently being written
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._drained: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._stopping = False
+        self._counters = {
+            "enqueued": 0,
+            "flushes": 0,
+            "flushed_rows": 0,
+            "failed_flushes": 0,
+            "backpressure_waits": 0,
+            "direct_writes": 0,
+        }
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and flush everything still buffered."""
+        self._stopping = True
+        if self._task:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def contains(self, email: str) -> bool:
+        return email in self._pending or email in self._in_flight
+
+    def _merge(self, record: dict):
+        _merge_capture(self._pending, record)
+
+    async def _write(self, batch: list) -> bool:
+        """Upsert a batch; if PostgreSQL fails, park it in the spool instead.
+
+        Returns True when the rows reached the database, False when they were
+        spooled. Raises only if the spool write fails too.
+        """
+        try:
+            await run_db(upsert_trial_emails, batch)
+            return True
+        except Exception as e:
+            self._counters["failed_flushes"] += 1
+            print(f"Error writing {len(batch)} captured emails, spooling them: {e}")
+        await run_in_threadpool(capture_spool.append, batch)
+        return False
+
+    async def enqueue(self, email: str, consented: bool, ad_id: Optional[int] = None, source: Optional[str] = None):
+        record = {'email': email, 'consented': consented, 'created_at': datetime.now(), 'ad_id': ad_id, 'source': source}
+        self._counters["enqueued"] += 1
+        if self._task is None:
+            # Not started (e.g. scripts importing app): write synchronously
+            await self._write([record])
+            return
+        if email not in self._pending and len(self._pending) >= self.max_pending:
+            self._counters["backpressure_waits"] += 1
+            self._wakeup.set()
+            deadline = monotonic() + self.enqueue_timeout
+            while len(self._pending) >= self.max_pending and monotonic() < deadline:
+                self._drained.clear()
+                try:
+                    await asyncio.wait_for(self._drained.wait(), timeout=max(0.0, deadline - monotonic()))
+                except asyncio.TimeoutError:
+                    break
+            if len(self._pending) >= self.max_pending:
+                self._counters["direct_writes"] += 1
+                await self._write([record])
+                return
+        self._merge(record)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing captured emails: {e}")
+
+    async def flush(self):
+        """Write buffered captures in batches.
+
+        A batch PostgreSQL rejects goes to the durable spool; only if that
+        fails as well does it stay buffered for the next tick.
+        """
+        async with self._flush_lock:
+            while self._pending:
+                emails = list(self._pending)[:self.batch_size]
+                batch = [self._pending.pop(email) for email in emails]
+                self._in_flight = {r['email']: r for r in batch}
+                try:
+                    written = await self._write(batch)
+                except Exception as e:
+                    print(f"Error spooling {len(batch)} captured emails: {e}")
+                    for record in batch:
+                        self._merge(record)
+                    return
+                finally:
+                    self._in_flight = {}
+                    self._drained.set()
+                if not written:
+                    # Database is unavailable: spool the rest of the buffer too
+                    # rather than waiting on a failing connection per batch
+                    rest, self._pending = self._pending, {}
+                    if rest:
+                        self._in_flight = rest
+                        try:
+                            await run_in_threadpool(capture_spool.append, list(rest.values()))
+                        except Exception as e:
+                            print(f"Error spooling {len(rest)} captured emails: {e}")
+                            for record in rest.values():
+                                self._merge(record)
+                        finally:
+                            self._in_flight = {}
+                            self._drained.set()
+                    return
+                self._counters["flushes"] += 1
+                self._counters["flushed_rows"] += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "in_flight": len(self._in_flight),
+            "max_pending": self.max_pending,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": int(self.flush_interval * 1000),
+            **self._counters,
+        }
+
+capture_queue = CaptureQueue(
+    flush_interval=INGEST_FLUSH_MS / 1000,
+    batch_size=INGEST_BATCH_SIZE,
+    max_pending=INGEST_MAX_PENDING,
+    enqueue_timeout=INGEST_ENQUEUE_TIMEOUT,
+)
+
+# ==== Ad Impression and Click Analytics ====
+AD_EVENTS_FLUSH_SECONDS = float(os.getenv("AD_EVENTS_FLUSH_SECONDS", "10"))
+AD_EVENTS_MAX_KEYS = int(os.getenv("AD_EVENTS_MAX_KEYS", "10000"))
+AD_EVENT_TYPES = ("impression", "click")
+
+def upsert_ad_event_counts(counts: List[tuple]):
+    """Add (ad_id, hour, impressions, clicks) counts to ad_event_hourly in one statement.
+
+    Counts for ads deleted since they were recorded are dropped. Callers pass
+    the rows sorted, so concurrent flushes from several workers lock them in
+    the same order.
+    """
+    if not counts:
+        return
+    with db_cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO ad_event_hourly (ad_id, hour, impressions, clicks)
+            SELECT v.ad_id, v.hour, v.impressions, v.clicks
+            FROM (VALUES %s) AS v (ad_id, hour, impressions, clicks)
+            WHERE EXISTS (SELECT 1 FROM scheduled_ads s WHERE s.id = v.ad_id)
+            ON CONFLICT (ad_id, hour) DO UPDATE
+            SET impressions = ad_event_hourly.impressions + EXCLUDED.impressions,
+                clicks = ad_event_hourly.clicks + EXCLUDED.clicks
+        """, counts, template="(%s::integer, %s::timestamp, %s::bigint, %s::bigint)", page_size=len(counts))
+
+class AdEventCounters:
+    """Per-worker impression/click counters, added to ad_event_hourly in batches.
+
+    record() only bumps an in-memory counter per (ad_id, hour), so a beacon
+    never waits on the database. A background task adds the counters to the
+    rollup every flush_interval with one multi-row upsert; when that fails
+    they are merged back and retried on the next tick. At most max_keys
+    (ad_id, hour) pairs are buffered, also across failed flushes; events for
+    further pairs are dropped and counted.
+    """
+
+    def __init__(self, flush_interval: float, max_keys: int):
+        self.flush_interval = flush_interval
+        self.max_keys = max(1, max_keys)
+        self._counts: dict = {}      # (ad_id, hour) -> [impressions, clicks]
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._stopping = False
+        self._counters = {
+            "recorded": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "flushed_rows": 0,
+            "failed_flushes": 0,
+        }
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and flush what is still counted."""
+        self._stopping = True
+        if self._task:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def record(self, ad_id: int, event: str, when: Optional[datetime] = None):
+        hour = (when or datetime.now()).replace(minute=0, second=0, microsecond=0)
+        counts = self._counts.get((ad_id, hour))
+        if counts is None:
+            if len(self._counts) >= self.max_keys:
+                self._counters["dropped"] += 1
+                return
+            counts = self._counts[(ad_id, hour)] = [0, 0]
+        counts[AD_EVENT_TYPES.index(event)] += 1
+        self._counters["recorded"] += 1
+
+    def _merge(self, batch: dict):
+        """Put a batch that failed to flush back in front of what was recorded meanwhile, within max_keys."""
+        recorded, self._counts = self._counts, {}
+        for source in (batch, recorded):
+            for key, (impressions, clicks) in source.items():
+                counts = self._counts.get(key)
+                if counts is None:
+                    if len(self._counts) >= self.max_keys:
+                        self._counters["dropped"] += impressions + clicks
+                        continue
+                    counts = self._counts[key] = [0, 0]
+                counts[0] += impressions
+                counts[1] += clicks
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._counts:
+                return
+            batch, self._counts = self._counts, {}
+            rows = sorted((ad_id, hour, impressions, clicks) for (ad_id, hour), (impressions, clicks) in batch.items())
+            try:
+                await run_db(upsert_ad_event_counts, rows)
+            except Exception as e:
+                self._counters["failed_flushes"] += 1
+                print(f"Error flushing ad event counters for {len(rows)} ad-hours: {e}")
+                self._merge(batch)
+                return
+            self._counters["flushes"] += 1
+            self._counters["flushed_rows"] += len(rows)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._counts),
+            "max_keys": self.max_keys,
+            "flush_interval_s": self.flush_interval,
+            **self._counters,
+        }
+
+ad_event_counters = AdEventCounters(flush_interval=AD_EVENTS_FLUSH_SECONDS, max_keys=AD_EVENTS_MAX_KEYS)
+
+@app.post("/api/ad-events")
+async def record_ad_event(request: Request):
+    """Beacon from the login page: {"ad_id": <id>, "event": "impression" | "click"}.
+
+    Any content type is accepted, as navigator.sendBeacon() posts text/plain.
+    Only counted in memory here; see AdEventCounters.
+    """
+    try:
+        data = json.loads(await request.body())
+    except ValueError:
+        data = None
+    ad_id = data.get("ad_id") if isinstance(data, dict) else None
+    event = data.get("event") if isinstance(data, dict) else None
+    if not isinstance(ad_id, int) or isinstance(ad_id, bool) or event not in AD_EVENT_TYPES:
+        return JSONResponse({"status": "error", "message": 'Expected an ad_id and an event ("impression" or "click").'}, status_code=400)
+    if not ad_schedule.knows(ad_id):
+        return JSONResponse({"status": "error", "message": "Ad not found"}, status_code=404)
+    ad_event_counters.record(ad_id, event)
+    return Response(status_code=204)
+
 @app.on_event("startup")
-def startup_event():
-    init_db()
+async def startup_event():
+    try:
+        await run_db(init_db)
+        await run_db(get_pool().fill)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError, DatabaseUnavailable, PoolTimeout) as e:
+        # Keep serving: captures are spooled locally until the database is back.
+        # Anything else (a failed migration, a schema error) leaves the code and
+        # schema out of step, so it propagates and the worker refuses to boot.
+        print(f"Error initializing database: {e}")
+    capture_queue.start()
+    capture_spool.start()
+    ad_event_counters.start()
+    cache_listener.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Flush buffered captures before the pool goes away
+    await capture_queue.stop()
+    await capture_spool.stop()
+    await ad_event_counters.stop()
+    await run_in_threadpool(cache_listener.stop)
+    get_pool().close()
 
 # ==== Simpan Email Baru (Auto-Verified) ====
 @app.post("/save_trial_email")
@@ -608,16 +3205,7 @@ async def save_email(request: Request):
     if consent is not True:
         return JSONResponse({"status": "error", "message": "Consent required"}, status_code=400)
 
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO trial_emails (email, is_verified, consented)
-        VALUES (%s, TRUE, TRUE)
-        ON CONFLICT (email) DO UPDATE SET is_verified = TRUE, consented = TRUE
-    """, (email,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    await capture_queue.enqueue(email, True, await capture_ad_id(request), "form")
 
     return {"status": "exists", "message": "Auto-verified"}
 
@@ -629,14 +3217,7 @@ async def check_email(request: Request):
     if not email:
         return {"status": "error", "message": "Invalid email"}
 
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT is_verified FROM trial_emails WHERE email = %s", (email,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-
-    if row and row[0]:
+    if capture_queue.contains(email) or await run_db(is_email_verified, email):
         return {"status": "exists"}
     else:
         return {"status": "not_verified"}
@@ -664,6 +3245,8 @@ async def login_google(request: StarletteRequest):
     
     # Store redirect_uri in session to ensure we use the same one in callback
     request.session["oauth_redirect_uri"] = redirect_uri
+    # Attribute the capture to the ad shown now, not whatever is live when the provider returns
+    request.session["capture_ad_id"] = await capture_ad_id(request)
     
     print(f"DEBUG: OAuth redirect_uri = {redirect_uri}, hostname = {host}")
     
@@ -709,16 +3292,7 @@ async def auth_google_callback(request: StarletteRequest):
         return JSONResponse({"status": "error", "message": f"Google authentication failed: {str(e)}"}, status_code=500)
 
     # Save or update in DB as verified
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO trial_emails (email, is_verified)
-        VALUES (%s, TRUE)
-        ON CONFLICT (email) DO UPDATE SET is_verified = TRUE
-    """, (email,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    await capture_queue.enqueue(email, False, await oauth_capture_ad_id(request), "google")
 
     login_url = (
         f"http://{GATEWAY_IP}/login?"
@@ -751,6 +3325,7 @@ async def login_facebook(request: StarletteRequest):
     
     # Store redirect_uri in session
     request.session["oauth_facebook_redirect_uri"] = redirect_uri
+    request.session["capture_ad_id"] = await capture_ad_id(request)
     
     print(f"DEBUG: Facebook OAuth redirect_uri = {redirect_uri}, hostname = {host}, scheme = {scheme}")
     
@@ -771,16 +3346,7 @@ async def auth_facebook_callback(request: StarletteRequest):
     if not email:
         return JSONResponse({"status": "error", "message": "Facebook account did not return an email address. Email scope is required."}, status_code=400)
 
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO trial_emails (email, is_verified, consented)
-        VALUES (%s, TRUE, TRUE)
-        ON CONFLICT (email) DO UPDATE SET is_verified = TRUE, consented = TRUE
-    """, (email,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    await capture_queue.enqueue(email, True, await oauth_capture_ad_id(request), "facebook")
 
     login_url = (
         f"http://{GATEWAY_IP}/login?"
@@ -788,6 +3354,41 @@ async def auth_facebook_callback(request: StarletteRequest):
     )
     return RedirectResponse(url=login_url)
 
+# ==== Page Templates ====
+# Compiled once at import so gunicorn's preload_app shares them with every worker
+TEMPLATE_DIR = "templates"
+TEMPLATE_CHUNK_PARTS = 512  # template output pieces per streamed chunk (roughly 8-32 KiB of HTML)
+
+templates = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    autoescape=True,
+    trim_blocks=True,
+    lstrip_blocks=True,
+    auto_reload=False,
+)
+LOGIN_TEMPLATE = templates.get_template("login.html.j2")
+DASHBOARD_TEMPLATE = templates.get_template("dashboard.html.j2")
+ADMIN_TEMPLATE = templates.get_template("admin.html.j2")
+SCHEDULER_TEMPLATE = templates.get_template("scheduler.html.j2")
+
+def _template_chunks(template, context: dict):
+    """Yield the rendered page in batches of TEMPLATE_CHUNK_PARTS output pieces.
+
+    A sync generator on purpose: StreamingResponse pulls it through the threadpool,
+    so rendering a large scheduler page never holds up the event loop. Batching
+    keeps that to one threadpool hop per chunk rather than one per piece.
+    """
+    pieces = template.generate(context)
+    while True:
+        batch = list(islice(pieces, TEMPLATE_CHUNK_PARTS))
+        if not batch:
+            break
+        yield "".join(batch).encode("utf-8")
+
+def stream_template(template, **context) -> StreamingResponse:
+    """Stream a preloaded template as text/html without building the whole page first."""
+    return StreamingResponse(_template_chunks(template, context), media_type="text/html; charset=utf-8")
+
 # ==== Dashboard Login Page ====
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard_login(request: Request):
@@ -799,9 +3400,12 @@ async def dashboard_login(request: Request):
                 page = 1
         except (ValueError, TypeError):
             page = 1
-        # Pass-through filter params
+        # Pass-through cursor and filter params
         return await show_dashboard(
             page=page,
+            after=request.query_params.get("after"),
+            before=request.query_params.get("before"),
+            last=request.query_params.get("last") == "1",
             date_filter=request.query_params.get("date_filter"),
             start_date_str=request.query_params.get("start_date"),
             end_date_str=request.query_params.get("end_date"),
@@ -915,185 +3519,115 @@ def _compute_date_range(
 
     return None, None, "All time"
 
-async def show_dashboard(page: int = 1, page_size: int = 20, date_filter: Optional[str] = None, start_date_str: Optional[str] = None, end_date_str: Optional[str] = None):
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    # Build WHERE clause from date filter
-    start_dt, end_dt, range_label = _compute_date_range(date_filter, start_date_str, end_date_str)
-    where_sql = ""
-    params: List = []
-    if start_dt and end_dt:
-        where_sql = "WHERE created_at BETWEEN %s AND %s"
-        params.extend([start_dt, end_dt])
-
-    # Get total count for pagination
-    cur.execute(f"SELECT COUNT(*) FROM trial_emails {where_sql}", params)
-    total_count = cur.fetchone()[0]
-    
-    # Calculate offset
-    offset = (page - 1) * page_size
-    
-    # Get paginated results
-    cur.execute(
-        f"""
-        SELECT email, created_at 
-        FROM trial_emails 
-        {where_sql}
-        ORDER BY created_at DESC 
-        LIMIT %s OFFSET %s
-    """,
-        (*params, page_size, offset),
-    )
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+# Longer ranges are charted by week, and beyond two years by month, to keep the bar count small
+SIGNUP_CHART_DAILY_MAX_DAYS = 90
+SIGNUP_CHART_WEEKLY_MAX_DAYS = 730
+
+def _chart_period_start(day: date, unit: str) -> date:
+    if unit == "week":
+        return day - timedelta(days=day.weekday())
+    if unit == "month":
+        return day.replace(day=1)
+    return day
+
+def _next_chart_period(start: date, unit: str) -> date:
+    if unit == "week":
+        return start + timedelta(days=7)
+    if unit == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+def _signup_chart(days: list, start_dt: Optional[datetime], end_dt: Optional[datetime], width: int = 800, height: int = 160) -> Optional[dict]:
+    """SVG bar geometry for signups (and the consented part of each) per day, week or month of the range."""
+    first = start_dt.date() if start_dt else (days[0][0] if days else None)
+    last = end_dt.date() if end_dt else (days[-1][0] if days else None)
+    if first is None or last < first:
+        return None
+    span = (last - first).days + 1
+    unit = "day" if span <= SIGNUP_CHART_DAILY_MAX_DAYS else "week" if span <= SIGNUP_CHART_WEEKLY_MAX_DAYS else "month"
+    periods = []
+    period = _chart_period_start(first, unit)
+    while period <= last:
+        periods.append(period)
+        period = _next_chart_period(period, unit)
+    totals = {period: [0, 0] for period in periods}
+    for day, signups, consented, _, _ in days:
+        counts = totals.get(_chart_period_start(day, unit))
+        if counts is not None:
+            counts[0] += signups
+            counts[1] += consented
+    step = width / len(periods)
+    peak = max([signups for signups, _ in totals.values()] + [1])
+    bars = []
+    for i, period in enumerate(periods):
+        signups, consented = totals[period]
+        bars.append({
+            "day": period,
+            "x": round(i * step + step * 0.1, 2),
+            "width": round(max(step * 0.8, 0.5), 2),
+            "signups": signups,
+            "consented": consented,
+            "height": round(signups / peak * height, 2),
+            "consented_height": round(consented / peak * height, 2),
+        })
+    return {"bars": bars, "unit": unit, "width": width, "height": height, "peak": peak, "first": first, "last": last}
 
-    # Calculate pagination info
-    total_pages = (total_count + page_size - 1) // page_size
-    has_prev = page > 1
-    has_next = page < total_pages
+async def show_dashboard(page: int = 1, page_size: int = 20, date_filter: Optional[str] = None, start_date_str: Optional[str] = None, end_date_str: Optional[str] = None,
+                         after: Optional[str] = None, before: Optional[str] = None, last: bool = False):
+    # Pages are addressed by the (created_at, id) cursor of a neighbouring row; page only labels them
+    start_dt, end_dt, range_label = _compute_date_range(date_filter, start_date_str, end_date_str)
+    after_key, before_key = parse_email_cursor(after), parse_email_cursor(before)
+
+    summary = await run_db(fetch_email_summary, start_dt, end_dt)
+    total_count = summary["signups"]
+    total_pages = max(1, (total_count + page_size - 1) // page_size)
+
+    if last:
+        page = total_pages
+        rows, _ = await run_db(fetch_email_keyset_page, start_dt, end_dt, page_size, None, None,
+                               total_count - (total_pages - 1) * page_size or page_size)
+        has_prev, has_next = total_pages > 1, False
+    elif after_key:
+        rows, has_next = await run_db(fetch_email_keyset_page, start_dt, end_dt, page_size, after_key)
+        has_prev = True
+    elif before_key:
+        rows, has_prev = await run_db(fetch_email_keyset_page, start_dt, end_dt, page_size, None, before_key)
+        has_next = True
+        if not has_prev:
+            page = 1
+    else:
+        page = 1
+        rows, has_next = await run_db(fetch_email_keyset_page, start_dt, end_dt, page_size)
+        has_prev = False
+    # Counts come from the daily rollup, so keep the label in range if rows arrived meanwhile
+    page = min(max(page, 2 if has_prev else 1), total_pages)
+    conversions = await run_db(fetch_ad_conversions)
 
     # Build filter query string for pagination links
-    filter_qs = ""
-    if date_filter:
-        filter_qs += f"&date_filter={date_filter}"
-    if start_date_str:
-        filter_qs += f"&start_date={start_date_str}"
-    if end_date_str:
-        filter_qs += f"&end_date={end_date_str}"
-
-    html = f"""
-    <html>
-      <head>
-        <title>Email Dashboard</title>
-        <style>
-          body {{ font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background: #f3f4f6; padding: 20px; }}
-          h1 {{ text-align: center; color: #333; }}
-          .filters {{ background: white; border-radius: 8px; padding: 16px; box-shadow: 0 5px 15px rgba(0,0,0,0.08); }}
-          .filters form {{ display: flex; flex-wrap: wrap; gap: 12px; align-items: end; }}
-          .filters label {{ font-size: 13px; color: #555; }}
-          .filters select, .filters input[type=date] {{ padding: 8px 10px; border: 1px solid #ccc; border-radius: 6px; }}
-          .filters button {{ background: #4f46e5; color: white; border: none; padding: 10px 14px; border-radius: 6px; cursor: pointer; }}
-          .pagination-info {{ text-align: center; margin: 10px 0; color: #666; font-size: 14px; }}
-          table {{ width: 100%; border-collapse: collapse; margin-top: 20px; background: white; border-radius: 8px; overflow: hidden; box-shadow: 0 5px 15px rgba(0,0,0,0.1); }}
-          th, td {{ padding: 12px 15px; text-align: left; }}
-          th {{ background: #667eea; color: white; }}
-          tr:nth-child(even) {{ background: #f2f2f2; }}
-          .logout, .download {{ display: inline-block; margin: 10px; text-decoration: none; font-weight: bold; padding: 10px 15px; border-radius: 6px; }}
-          .logout {{ color: #667eea; border: 1px solid #667eea; }}
-          .logout:hover {{ background: #667eea; color: white; }}
-          .download {{ background: #10b981; color: white; }}
-          .download:hover {{ background: #059669; }}
-          .buttons {{ text-align:center; margin-top: 20px; }}
-          .pagination {{ text-align: center; margin: 20px 0; }}
-          .pagination a {{ display: inline-block; padding: 8px 12px; margin: 0 4px; text-decoration: none; border: 1px solid #667eea; border-radius: 4px; color: #667eea; }}
-          .pagination a:hover {{ background: #667eea; color: white; }}
-          .pagination .current {{ background: #667eea; color: white; }}
-          .pagination .disabled {{ color: #ccc; border-color: #ccc; cursor: not-allowed; }}
-          .pagination .disabled:hover {{ background: transparent; color: #ccc; }}
-          @media(max-width: 600px) {{ table, th, td {{ font-size: 14px; }} }}
-        </style>
-      </head>
-      <body>
-        <h1>📊 Collected Emails</h1>
-        <div class="filters">
-          <form method="get" action="/dashboard">
-            <div>
-              <label for="date_filter">Date</label><br>
-              <select name="date_filter" id="date_filter">
-                <option value="" {"selected" if not date_filter else ""}>All time</option>
-                <option value="today" {"selected" if date_filter=="today" else ""}>Today</option>
-                <option value="yesterday" {"selected" if date_filter=="yesterday" else ""}>Yesterday</option>
-                <option value="last7" {"selected" if date_filter=="last7" else ""}>Last 7 days</option>
-                <option value="last30" {"selected" if date_filter=="last30" else ""}>Last 30 days</option>
-                <option value="thisMonth" {"selected" if date_filter=="thisMonth" else ""}>This month</option>
-                <option value="prevMonth" {"selected" if date_filter=="prevMonth" else ""}>Previous month</option>
-                <option value="custom" {"selected" if date_filter=="custom" else ""}>Custom range</option>
-              </select>
-            </div>
-            <div>
-              <label for="start_date">Start</label><br>
-              <input type="date" name="start_date" id="start_date" value="{start_date_str or ''}">
-            </div>
-            <div>
-              <label for="end_date">End</label><br>
-              <input type="date" name="end_date" id="end_date" value="{end_date_str or ''}">
-            </div>
-            <div>
-              <input type="hidden" name="page" value="1">
-              <button type="submit">Apply</button>
-            </div>
-          </form>
-          <div style="margin-top:8px;color:#666;font-size:13px;">Range: {range_label}</div>
-        </div>
-        <div class="pagination-info">
-          Showing {len(rows)} of {total_count} emails (Page {page} of {total_pages})
-        </div>
-        <table>
-          <tr><th>Email</th><th>Created At</th></tr>
-    """
-    for email, created_at in rows:
-        html += f"<tr><td>{email}</td><td>{created_at.date()}</td></tr>"
-
-    # Add pagination controls
-    html += """
-        </table>
-        <div class="pagination">
-    """
-    
-    # Previous button
-    if has_prev:
-        html += f'<a href="/dashboard?page={page-1}{filter_qs}">« Previous</a>'
-    else:
-        html += '<span class="disabled">« Previous</span>'
-    
-    # Page numbers (show up to 5 pages around current page)
-    start_page = max(1, page - 2)
-    end_page = min(total_pages, page + 2)
-    
-    if start_page > 1:
-        html += f'<a href="/dashboard?page=1{filter_qs}">1</a>'
-        if start_page > 2:
-            html += '<span>...</span>'
-    
-    for p in range(start_page, end_page + 1):
-        if p == page:
-            html += f'<span class="current">{p}</span>'
-        else:
-            html += f'<a href="/dashboard?page={p}{filter_qs}">{p}</a>'
-    
-    if end_page < total_pages:
-        if end_page < total_pages - 1:
-            html += '<span>...</span>'
-        html += f'<a href="/dashboard?page={total_pages}{filter_qs}">{total_pages}</a>'
-    
-    # Next button
-    if has_next:
-        html += f'<a href="/dashboard?page={page+1}{filter_qs}">Next »</a>'
-    else:
-        html += '<span class="disabled">Next »</span>'
-    
-    html += """
-        </div>
-        <div class="buttons">
-            <a href="/admin" class="download" style="text-decoration:none;">⚙️ Admin Panel</a>
-            <form method="get" action="/dashboard/export" style="display:inline-block;margin:10px;">
-                <input type="hidden" name="date_filter" value="{date_filter or ''}">
-                <input type="hidden" name="start_date" value="{start_date_str or ''}">
-                <input type="hidden" name="end_date" value="{end_date_str or ''}">
-                <label style="margin-right:6px;">Format:</label>
-                <label><input type="radio" name="format" value="csv" checked> CSV</label>
-                <label><input type="radio" name="format" value="xlsx"> XLSX</label>
-                <label><input type="radio" name="format" value="pdf"> PDF</label>
-                <button class="download" type="submit">Download</button>
-            </form>
-            <a href="/dashboard/logout" class="logout">Logout</a>
-        </div>
-      </body>
-    </html>
-    """
-    return HTMLResponse(content=html)
+    filter_params = [
+        (name, value)
+        for name, value in (("date_filter", date_filter), ("start_date", start_date_str), ("end_date", end_date_str))
+        if value
+    ]
+    filter_qs = "&" + urlencode(filter_params) if filter_params else ""
+
+    return stream_template(
+        DASHBOARD_TEMPLATE,
+        rows=rows,
+        total_count=total_count,
+        page=page,
+        total_pages=total_pages,
+        prev_cursor=email_cursor(rows[0]) if rows and has_prev else None,
+        next_cursor=email_cursor(rows[-1]) if rows and has_next else None,
+        filter_qs=filter_qs,
+        date_filter=date_filter,
+        start_date_str=start_date_str,
+        end_date_str=end_date_str,
+        range_label=range_label,
+        conversions=conversions,
+        summary=summary,
+        chart=_signup_chart(summary["days"], start_dt, end_dt),
+    )
 
 # ==== Dashboard Logout ====
 @app.get("/dashboard/logout")
@@ -1102,6 +3636,53 @@ async def dashboard_logout(request: Request):
     return RedirectResponse("/dashboard")
 
 # ==== Export by Date and Format ====
+# The builders below are CPU-bound for large ranges, so they run in a worker thread.
+def _build_export_csv(rows) -> StringIO:
+    csv_file = StringIO()
+    writer = csv.writer(csv_file)
+    writer.writerow(["Email", "Created At"])
+    for email, created_at in rows:
+        writer.writerow([email, created_at.date()])
+    csv_file.seek(0)
+    return csv_file
+
+def _build_export_xlsx(rows) -> BytesIO:
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Emails"
+    ws.append(["Email", "Created At"])
+    for email, created_at in rows:
+        ws.append([email, created_at.date().isoformat()])
+    bio = BytesIO()
+    wb.save(bio)
+    bio.seek(0)
+    return bio
+
+def _build_export_pdf(rows) -> BytesIO:
+    bio = BytesIO()
+    doc = SimpleDocTemplate(bio, pagesize=letter)
+    styles = getSampleStyleSheet()
+    elements = []
+    title = Paragraph("Collected Emails", styles["Title"])
+    elements.append(title)
+    elements.append(Spacer(1, 12))
+    data = [["Email", "Created At"]] + [[e, c.date().isoformat()] for e, c in rows]
+    table = Table(data, colWidths=[350, 150])
+    table.setStyle(
+        TableStyle([
+            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#667eea")),
+            ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+            ("ALIGN", (0, 0), (-1, -1), "LEFT"),
+            ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+            ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+            ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.HexColor("#f2f2f2")]),
+        ])
+    )
+    elements.append(table)
+    doc.build(elements)
+    bio.seek(0)
+    return bio
+
 @app.get("/dashboard/export")
 async def export_data(request: Request):
     if not request.session.get("logged_in"):
@@ -1115,29 +3696,16 @@ async def export_data(request: Request):
 
     start_dt, end_dt, _ = _compute_date_range(date_filter, start_date_str, end_date_str)
 
-    conn = get_connection()
-    cur = conn.cursor()
     params: List = []
     where_sql = ""
     if start_dt and end_dt:
         where_sql = "WHERE created_at BETWEEN %s AND %s"
         params.extend([start_dt, end_dt])
-    cur.execute(
-        f"SELECT email, created_at FROM trial_emails {where_sql} ORDER BY created_at DESC",
-        params,
-    )
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    rows = await run_db(fetch_emails_for_export, where_sql, params)
 
     # CSV
     if fmt == "csv":
-        csv_file = StringIO()
-        writer = csv.writer(csv_file)
-        writer.writerow(["Email", "Created At"])
-        for email, created_at in rows:
-            writer.writerow([email, created_at.date()])
-        csv_file.seek(0)
+        csv_file = await run_in_threadpool(_build_export_csv, rows)
         fname = "emails.csv"
         if start_dt and end_dt:
             fname = f"emails_{start_dt.date().isoformat()}_{end_dt.date().isoformat()}.csv"
@@ -1151,15 +3719,7 @@ async def export_data(request: Request):
     if fmt == "xlsx":
         if Workbook is None:
             return JSONResponse({"error": "XLSX export requires openpyxl to be installed"}, status_code=500)
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Emails"
-        ws.append(["Email", "Created At"])
-        for email, created_at in rows:
-            ws.append([email, created_at.date().isoformat()])
-        bio = BytesIO()
-        wb.save(bio)
-        bio.seek(0)
+        bio = await run_in_threadpool(_build_export_xlsx, rows)
         fname = "emails.xlsx"
         if start_dt and end_dt:
             fname = f"emails_{start_dt.date().isoformat()}_{end_dt.date().isoformat()}.xlsx"
@@ -1173,28 +3733,7 @@ async def export_data(request: Request):
     if fmt == "pdf":
         if SimpleDocTemplate is None:
             return JSONResponse({"error": "PDF export requires reportlab to be installed"}, status_code=500)
-        bio = BytesIO()
-        doc = SimpleDocTemplate(bio, pagesize=letter)
-        styles = getSampleStyleSheet()
-        elements = []
-        title = Paragraph("Collected Emails", styles["Title"])
-        elements.append(title)
-        elements.append(Spacer(1, 12))
-        data = [["Email", "Created At"]] + [[e, c.date().isoformat()] for e, c in rows]
-        table = Table(data, colWidths=[350, 150])
-        table.setStyle(
-            TableStyle([
-                ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#667eea")),
-                ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-                ("ALIGN", (0, 0), (-1, -1), "LEFT"),
-                ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-                ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.HexColor("#f2f2f2")]),
-            ])
-        )
-        elements.append(table)
-        doc.build(elements)
-        bio.seek(0)
+        bio = await run_in_threadpool(_build_export_pdf, rows)
         fname = "emails.pdf"
         if start_dt and end_dt:
             fname = f"emails_{start_dt.date().isoformat()}_{end_dt.date().isoformat()}.pdf"
@@ -1212,891 +3751,36 @@ async def scheduler_page(request: Request):
     if not request.session.get("logged_in"):
         return RedirectResponse("/dashboard")
     
-    ads = get_all_scheduled_ads()
-    active_ad = get_active_scheduled_ad()
-    
-    html = f"""
-    <html>
-      <head>
-        <title>CMS Scheduler - WiFi Login</title>
-        <style>
-          body {{
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea, #764ba2);
-            padding: 20px;
-            margin: 0;
-          }}
-          .container {{
-            max-width: 1200px;
-            margin: 0 auto;
-            background: white;
-            border-radius: 12px;
-            padding: 30px;
-            box-shadow: 0 10px 25px rgba(0,0,0,0.2);
-          }}
-          .nav-links {{
-            margin-bottom: 20px;
-          }}
-          .nav-links a {{
-            color: #667eea;
-            text-decoration: none;
-            margin-right: 15px;
-            font-weight: 600;
-          }}
-          .nav-links a:hover {{
-            text-decoration: underline;
-          }}
-          h1 {{
-            color: #333;
-            margin-bottom: 10px;
-          }}
-          .subtitle {{
-            color: #666;
-            margin-bottom: 30px;
-          }}
-          .active-now-badge {{
-            background: #10b981;
-            color: white;
-            padding: 4px 12px;
-            border-radius: 12px;
-            font-size: 12px;
-            font-weight: 600;
-            display: inline-block;
-            margin-left: 10px;
-            animation: pulse 2s infinite;
-          }}
-          @keyframes pulse {{
-            0%, 100% {{ opacity: 1; }}
-            50% {{ opacity: 0.7; }}
-          }}
-          .pending-badge {{
-            background: #f59e0b;
-            color: white;
-            padding: 4px 12px;
-            border-radius: 12px;
-            font-size: 12px;
-            font-weight: 600;
-            display: inline-block;
-            margin-left: 10px;
-          }}
-          .inactive-badge {{
-            background: #6b7280;
-            color: white;
-            padding: 4px 12px;
-            border-radius: 12px;
-            font-size: 12px;
-            font-weight: 600;
-            display: inline-block;
-            margin-left: 10px;
-          }}
-          .btn {{
-            background: #667eea;
-            color: white;
-            border: none;
-            padding: 10px 20px;
-            border-radius: 8px;
-            cursor: pointer;
-            font-size: 14px;
-            font-weight: 600;
-            margin: 5px;
-          }}
-          .btn:hover {{
-            background: #5a67d8;
-          }}
-          .btn-danger {{
-            background: #dc3545;
-          }}
-          .btn-danger:hover {{
-            background: #c82333;
-          }}
-          .btn-success {{
-            background: #10b981;
-          }}
-          .btn-success:hover {{
-            background: #059669;
-          }}
-          table {{
-            width: 100%;
-            border-collapse: collapse;
-            margin-top: 20px;
-            background: white;
-          }}
-          th, td {{
-            padding: 12px;
-            text-align: left;
-            border-bottom: 1px solid #e1e8ed;
-          }}
-          th {{
-            background: #667eea;
-            color: white;
-            font-weight: 600;
-          }}
-          tr:hover {{
-            background: #f8f9fa;
-          }}
-          .modal {{
-            display: none;
-            position: fixed;
-            top: 0;
-            left: 0;
-            right: 0;
-            bottom: 0;
-            background: rgba(0,0,0,0.7);
-            z-index: 1000;
-            overflow-y: auto;
-          }}
-          .modal.active {{
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            padding: 20px;
-          }}
-          .modal-content {{
-            background: white;
-            border-radius: 12px;
-            padding: 30px;
-            max-width: 600px;
-            width: 100%;
-            max-height: 90vh;
-            overflow-y: auto;
-          }}
-          .form-group {{
-            margin-bottom: 20px;
-          }}
-          .form-group label {{
-            display: block;
-            font-weight: 600;
-            margin-bottom: 8px;
-            color: #333;
-          }}
-          .ad-image-uploader {{
-            border: 2px dashed #cbd5f5;
-            border-radius: 12px;
-            padding: 16px;
-            background: #f8f9ff;
-          }}
-          .ad-source-tabs {{
-            display: flex;
-            gap: 10px;
-            margin-bottom: 15px;
-          }}
-          .ad-tab {{
-            flex: 1;
-            border: none;
-            padding: 10px 12px;
-            border-radius: 8px;
-            background: white;
-            font-weight: 600;
-            cursor: pointer;
-            border: 1px solid #d1d8ff;
-            color: #4b5563;
-          }}
-          .ad-tab.active {{
-            background: #667eea;
-            color: white;
-            border-color: #667eea;
-          }}
-          .ad-source-panel {{
-            margin-bottom: 15px;
-          }}
-          .ad-source-panel.hidden {{
-            display: none;
-          }}
-          .helper-text {{
-            font-size: 12px;
-            color: #6b7280;
-            margin-top: 8px;
-          }}
-          /* Custom Notification Modal */
-          .notification-modal {{
-            display: none;
-            position: fixed;
-            top: 0;
-            left: 0;
-            right: 0;
-            bottom: 0;
-            background: rgba(0, 0, 0, 0.6);
-            backdrop-filter: blur(4px);
-            z-index: 9999;
-            align-items: center;
-            justify-content: center;
-          }}
-          .notification-modal.active {{
-            display: flex;
-            animation: fadeIn 0.2s ease;
-          }}
-          .notification-content {{
-            background: white;
-            border-radius: 16px;
-            padding: 32px;
-            max-width: 480px;
-            width: 90%;
-            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
-            text-align: center;
-            animation: slideIn 0.3s ease;
-          }}
-          .notification-icon {{
-            font-size: 48px;
-            margin-bottom: 16px;
-          }}
-          .notification-icon.error {{
-            color: #dc3545;
-          }}
-          .notification-icon.success {{
-            color: #10b981;
-          }}
-          .notification-title {{
-            font-size: 20px;
-            font-weight: 700;
-            color: #333;
-            margin-bottom: 12px;
-          }}
-          .notification-message {{
-            font-size: 15px;
-            color: #666;
-            line-height: 1.6;
-            margin-bottom: 24px;
-          }}
-          .notification-btn {{
-            background: #667eea;
-            color: white;
-            border: none;
-            padding: 12px 32px;
-            border-radius: 8px;
-            font-size: 15px;
-            font-weight: 600;
-            cursor: pointer;
-            transition: all 0.2s;
-          }}
-          .notification-btn:hover {{
-            background: #5a67d8;
-            transform: translateY(-1px);
-          }}
-          @keyframes fadeIn {{
-            from {{ opacity: 0; }}
-            to {{ opacity: 1; }}
-          }}
-          @keyframes slideIn {{
-            from {{ transform: translateY(-20px); opacity: 0; }}
-            to {{ transform: translateY(0); opacity: 1; }}
-          }}
-          .ad-preview {{
-            border: 1px dashed #a5b4fc;
-            border-radius: 12px;
-            padding: 12px;
-            background: white;
-            min-height: 160px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            text-align: center;
-          }}
-          .ad-preview img {{
-            max-width: 100%;
-            border-radius: 8px;
-            box-shadow: 0 10px 30px rgba(102, 126, 234, 0.2);
-          }}
-          .hidden {{
-            display: none !important;
-          }}
-          .form-row {{
-            display: grid;
-            grid-template-columns: 1fr 1fr;
-            gap: 15px;
-          }}
-          .empty-state {{
-            text-align: center;
-            padding: 60px 20px;
-            color: #666;
-          }}
-          .empty-state h3 {{
-            color: #333;
-            margin-bottom: 10px;
-          }}
-        </style>
-      </head>
-      <body>
-        <div class="container">
-          <div class="nav-links">
-            <a href="/dashboard">← Back to Dashboard</a>
-            <a href="/admin">⚙️ Admin Panel</a>
-            <a href="/login" target="_blank">Preview Login Page →</a>
-          </div>
-          
-          <h1>📅 CMS Scheduler</h1>
-          <p class="subtitle">Schedule Advertisements</p>
-          
-          {f'<div style="background: #dcfce7; padding: 15px; border-radius: 8px; margin-bottom: 20px;"><strong>Currently Active:</strong> {active_ad["title"]} (until {active_ad["end_date"]})</div>' if active_ad else ''}
-          
-          <button class="btn btn-success" id="create-schedule-btn">➕ Create New Schedule</button>
-          
-          <table>
-            <thead>
-              <tr>
-                <th>Title</th>
-                <th>Start Date/Time</th>
-                <th>End Date/Time</th>
-                <th>Status</th>
-                <th>Actions</th>
-              </tr>
-            </thead>
-            <tbody>
-    """
-    
-    if not ads:
-        html += """
-              <tr>
-                <td colspan="5" class="empty-state">
-                  <h3>No scheduled ads yet</h3>
-                  <p>Click "Create New Schedule" to add your first scheduled ad</p>
-                </td>
-              </tr>
-        """
-    else:
-        for ad in ads:
-            # Determine status based on dates and active flag
-            from datetime import datetime
-            now = datetime.now()
-            current_date = now.date()
-            start_date = ad['start_date']
-            end_date = ad['end_date']
-            if ad['is_active'] and start_date <= current_date <= end_date:
-                status_badge = '<span class="active-now-badge">ACTIVE NOW</span>'
-            elif current_date < start_date:
-                status_badge = '<span class="pending-badge">PENDING</span>'
-            elif current_date > end_date:
-                status_badge = '<span class="inactive-badge">EXPIRED</span>'
-            else:
-                status_badge = '<span class="pending-badge">PENDING</span>'
-            html += f"""
-              <tr>
-                <td><strong>{ad['title']}</strong></td>
-                <td>{ad['start_date']} {ad['start_time']}</td>
-                <td>{ad['end_date']} {ad['end_time']}</td>
-                <td>{status_badge}</td>
-                <td>
-                  <button class="btn" onclick="editAd({ad['id']})">✏️ Edit</button>
-                  <button class="btn btn-danger" onclick="deleteAd({ad['id']})">🗑️ Delete</button>
-                </td>
-              </tr>
-            """
+    ads = await run_db(get_all_scheduled_ads)
+    active_ad = await run_db(get_active_scheduled_ad)
+    live_ids = (await run_db(ad_schedule.get))["ids"]
+    totals = await run_db(fetch_ad_performance, performance_since(AD_PERFORMANCE_DEFAULT_DAYS))
     
-    html += """
-            </tbody>
-          </table>
-        </div>
-        
-        <!-- Create/Edit Modal -->
-        <div id="adModal" class="modal">
-          <div class="modal-content">
-            <h2 id="modalTitle">Create New Schedule</h2>
-            <form id="adForm">
-              <input type="hidden" id="adId">
-              <div class="form-group">
-                <label>Title *</label>
-                <input type="text" id="title" required>
-              </div>
-              <div class="form-group">
-                <label>Description</label>
-                <textarea id="description"></textarea>
-              </div>
-              <div class="form-row">
-                <div class="form-group">
-                  <label>Start Date (DD/MM/YYYY) *</label>
-                  <input type="text" id="start_date" placeholder="dd/mm/yyyy" required>
-                </div>
-                <div class="form-group">
-                  <label>End Date (DD/MM/YYYY) *</label>
-                  <input type="text" id="end_date" placeholder="dd/mm/yyyy" required>
-                </div>
-                <script src="https://cdn.jsdelivr.net/npm/flatpickr"></script>
-                <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/flatpickr/dist/flatpickr.min.css">
-              </div>
-              <div class="form-row">
-                <div class="form-group">
-                  <label>Start Time</label>
-                  <input type="time" id="start_time" value="00:00">
-                </div>
-                <div class="form-group">
-                  <label>End Time</label>
-                  <input type="time" id="end_time" value="23:59">
-                </div>
-              </div>
-              <div class="form-group">
-                <label>Advertisement Image *</label>
-                <div class="ad-image-uploader">
-                  <div class="ad-source-tabs">
-                    <button type="button" class="ad-tab active" id="upload-device-btn" data-source="upload">Upload from device</button>
-                    <button type="button" class="ad-tab" id="use-url-btn" data-source="url">Use image URL</button>
-                  </div>
-                  <div class="ad-source-panel" data-panel="upload">
-                    <input type="file" id="adImageFile" accept="image/*">
-                    <p class="helper-text">Choose a JPG, PNG, or WebP from your computer or phone. Recommended size 1080 × 1350 px.</p>
-                  </div>
-                  <div class="ad-source-panel hidden" data-panel="url">
-                    <input type="url" id="adImageUrl" placeholder="https://example.com/promo.jpg">
-                    <p class="helper-text">Make sure the link is publicly accessible.</p>
-                  </div>
-                  <div class="ad-preview" id="adImagePreview">
-                    <p class="helper-text">No image selected yet.</p>
-                  </div>
-                </div>
-              </div>
-              <div style="margin-top: 20px;">
-                <button type="submit" class="btn btn-success">💾 Save</button>
-                <button type="button" class="btn" onclick="closeModal()">Cancel</button>
-              </div>
-            </form>
-          </div>
-        </div>
-
-        <!-- Delete Confirmation Modal -->
-        <div id="deleteConfirmModal" class="modal">
-          <div class="modal-content" style="max-width: 420px; text-align: center;">
-            <h2>Delete Schedule</h2>
-            <p style="margin-top: 10px; color: #374151;">
-              Are you sure you want to Delete this?
-            </p>
-            <div style="margin-top: 24px; display: flex; justify-content: center; gap: 12px;">
-              <button type="button" class="btn btn-danger" id="confirmDeleteYes">Yes</button>
-              <button type="button" class="btn" id="confirmDeleteNo">No</button>
-            </div>
-          </div>
-        </div>
-
-        <!-- Notification Modal (replaces alert()) -->
-        <div id="notificationModal" class="notification-modal">
-          <div class="notification-content">
-            <div class="notification-icon" id="notificationIcon">⚠️</div>
-            <h3 class="notification-title" id="notificationTitle">Notification</h3>
-            <p class="notification-message" id="notificationMessage"></p>
-            <button class="notification-btn" onclick="closeNotification()">OK</button>
-          </div>
-        </div>
-
-        <script>
-          document.addEventListener('DOMContentLoaded', function() {
-            // Global variables for image handling
-            let imageType = 'upload'; // 'upload' or 'url'
-            let imageData = '';       // For base64 data when uploading
-            let imageUrl = '';        // For URL when using external image
-
-            // Delete confirmation state
-            let pendingDeleteId = null;
-            const deleteModal = document.getElementById('deleteConfirmModal');
-            const confirmDeleteYes = document.getElementById('confirmDeleteYes');
-            const confirmDeleteNo = document.getElementById('confirmDeleteNo');
-            
-            // Notification Modal Functions
-            function showNotification(message, type = 'error') {{
-              const modal = document.getElementById('notificationModal');
-              const icon = document.getElementById('notificationIcon');
-              const title = document.getElementById('notificationTitle');
-              const messageEl = document.getElementById('notificationMessage');
-              
-              if (type === 'error') {{
-                icon.textContent = '❌';
-                icon.className = 'notification-icon error';
-                title.textContent = 'Error';
-              }} else if (type === 'success') {{
-                icon.textContent = '✅';
-                icon.className = 'notification-icon success';
-                title.textContent = 'Success';
-              }} else {{
-                icon.textContent = '⚠️';
-                icon.className = 'notification-icon';
-                title.textContent = 'Notification';
-              }}
-              
-              messageEl.textContent = message;
-              modal.classList.add('active');
-            }}
-            
-            window.closeNotification = function() {{
-              const modal = document.getElementById('notificationModal');
-              modal.classList.remove('active');
-            }};
-            
-            // DOM Elements
-            const modal = document.getElementById('adModal');
-            const createBtn = document.getElementById('create-schedule-btn');
-            const form = document.getElementById('adForm');
-            const titleInput = document.getElementById('title');
-            const descriptionInput = document.getElementById('description');
-            const startDateInput = document.getElementById('start_date');
-            const endDateInput = document.getElementById('end_date');
-            const startTimeInput = document.getElementById('start_time');
-            const endTimeInput = document.getElementById('end_time');
-            const imageFileInput = document.getElementById('adImageFile');
-            const imagePreview = document.getElementById('adImagePreview');
-            const uploadDeviceBtn = document.getElementById('upload-device-btn');
-            const useUrlBtn = document.getElementById('use-url-btn');
-            const uploadPanel = document.querySelector('.ad-source-panel[data-panel="upload"]');
-            const urlPanel = document.querySelector('.ad-source-panel[data-panel="url"]');
-            const imageUrlInput = document.getElementById('adImageUrl');
-
-            function openCreateModal() {
-              if (!modal) return;
-              modal.classList.add('active');
-            }
-
-            function closeModal() {
-              if (!modal) return;
-              modal.classList.remove('active');
-            }
-
-            // Helper to toggle between upload and URL panels
-            function showUploadPanel() {
-              if (uploadDeviceBtn) uploadDeviceBtn.classList.add('active');
-              if (useUrlBtn) useUrlBtn.classList.remove('active');
-              if (uploadPanel) uploadPanel.classList.remove('hidden');
-              if (urlPanel) urlPanel.classList.add('hidden');
-            }
-
-            function showUrlPanel() {
-              if (uploadDeviceBtn) uploadDeviceBtn.classList.remove('active');
-              if (useUrlBtn) useUrlBtn.classList.add('active');
-              if (uploadPanel) uploadPanel.classList.add('hidden');
-              if (urlPanel) urlPanel.classList.remove('hidden');
-            }
-
-            // Basic preview for "Upload from device" and store data
-            if (imageFileInput && imagePreview) {
-              imageFileInput.addEventListener('change', function(e) {
-                const file = e.target.files[0];
-                if (!file) {
-                  imagePreview.innerHTML = '<p class=\"helper-text\">No image selected yet.</p>';
-                  return;
-                }
-                if (!file.type.startsWith('image/')) {
-                  showNotification('Please choose an image file.', 'error');
-                  e.target.value = '';
-                  return;
-                }
-                const reader = new FileReader();
-                reader.onload = function(ev) {
-                  imageType = 'upload';
-                  imageData = ev.target.result;
-                  imageUrl = '';
-                  const img = document.createElement('img');
-                  img.src = ev.target.result;
-                  img.alt = 'Advertisement preview';
-                  imagePreview.innerHTML = '';
-                  imagePreview.appendChild(img);
-                };
-                reader.readAsDataURL(file);
-              });
-            }
-
-            // When clicking "Upload from device", switch panel AND open file picker
-            if (uploadDeviceBtn) {
-              uploadDeviceBtn.addEventListener('click', function(e) {
-                e.preventDefault();
-                showUploadPanel();
-                if (imageFileInput) {
-                  imageFileInput.click();
-                }
-              });
-            }
-
-            // When clicking "Use image URL", just switch to URL panel
-            if (useUrlBtn) {
-              useUrlBtn.addEventListener('click', function(e) {
-                e.preventDefault();
-                showUrlPanel();
-                if (imageUrlInput) {
-                  imageUrl = imageUrlInput.value.trim();
-                  imageType = 'url';
-                }
-              });
-            }
-
-            // Ensure initial state is upload panel
-            showUploadPanel();
-
-            if (createBtn) {
-              createBtn.addEventListener('click', function(e) {
-                e.preventDefault();
-                e.stopPropagation();
-                openCreateModal();
-              });
-            }
-
-            // Initialize date pickers
-            document.addEventListener('DOMContentLoaded', function() {
-              flatpickr("#start_date", {
-                dateFormat: "d/m/Y",
-                allowInput: true,
-                onChange: function(selectedDates, dateStr, instance) {
-                  // Ensure the date is in the correct format when selected
-                  if (dateStr) {
-                    instance.input.value = dateStr;
-                  }
-                }
-              });
-              
-              flatpickr("#end_date", {
-                dateFormat: "d/m/Y",
-                allowInput: true,
-                onChange: function(selectedDates, dateStr, instance) {
-                  // Ensure the date is in the correct format when selected
-                  if (dateStr) {
-                    instance.input.value = dateStr;
-                  }
-                }
-              });
-            });
-            
-            // Function to format date to DD/MM/YYYY
-            function formatDateForDisplay(dateString) {
-              if (!dateString) return '';
-              // If already in DD/MM/YYYY format, return as is
-              if (/^\d{2}\/\d{2}\/\d{4}$/.test(dateString)) {
-                return dateString;
-              }
-              // Try to parse as YYYY-MM-DD (ISO format)
-              const date = new Date(dateString);
-              if (!isNaN(date.getTime())) {
-                const day = String(date.getDate()).padStart(2, '0');
-                const month = String(date.getMonth() + 1).padStart(2, '0');
-                const year = date.getFullYear();
-                return `${day}/${month}/${year}`;
-              }
-              return dateString; // Return original if can't parse
-            }
-
-            // Function to convert DD/MM/YYYY to YYYY-MM-DD for the input
-            function formatDateForInput(dateString) {
-              if (!dateString) return '';
-              // If already in YYYY-MM-DD format, return as is
-              if (/^\d{4}-\d{2}-\d{2}$/.test(dateString)) {
-                return dateString;
-              }
-              // Try to parse as DD/MM/YYYY
-              const parts = dateString.split('/');
-              if (parts.length === 3) {
-                const [day, month, year] = parts;
-                return `${year}-${month.padStart(2, '0')}-${day.padStart(2, '0')}`;
-              }
-              return dateString; // Fallback to original if format is unknown
-            }
-
-            // Initialize date pickers when modal is opened
-            function initializeDatePickers() {
-              // Reinitialize flatpickr on modal open
-              if (window.startDatePicker) window.startDatePicker.destroy();
-              if (window.endDatePicker) window.endDatePicker.destroy();
-              
-              window.startDatePicker = flatpickr("#start_date", {
-                dateFormat: "d/m/Y",
-                allowInput: true,
-                onChange: function(selectedDates, dateStr, instance) {
-                  if (dateStr) {
-                    instance.input.value = dateStr;
-                  }
-                }
-              });
-              
-              window.endDatePicker = flatpickr("#end_date", {
-                dateFormat: "d/m/Y",
-                allowInput: true,
-                onChange: function(selectedDates, dateStr, instance) {
-                  if (dateStr) {
-                    instance.input.value = dateStr;
-                  }
-                }
-              });
-            }
-            
-            // Initialize date pickers when modal is opened
-            if (createBtn) {
-              createBtn.addEventListener('click', function(e) {
-                e.preventDefault();
-                e.stopPropagation();
-                openCreateModal();
-                initializeDatePickers();
-              });
-            }
-
-            // Handle form submit: create or update scheduled ad
-            if (form) {
-              form.addEventListener('submit', async function(e) {
-                e.preventDefault();
-
-                const title = titleInput ? titleInput.value.trim() : '';
-                // Format dates for display but keep the original value for submission
-                const startDate = startDateInput ? formatDateForInput(startDateInput.value) : '';
-                const endDate = endDateInput ? formatDateForInput(endDateInput.value) : '';
-
-                if (!title || !startDate || !endDate) {
-                  showNotification('Please fill in Title, Start Date, and End Date.', 'error');
-                  return;
-                }
-
-                if (imageType === 'upload' && !imageData) {
-                  showNotification('Please upload an advertisement image.', 'error');
-                  return;
-                }
-                if (imageType === 'url' && !imageUrl) {
-                  showNotification('Please provide an image URL.', 'error');
-                  return;
-                }
-
-                const startTimeVal = (startTimeInput && startTimeInput.value) || '00:00';
-                const endTimeVal = (endTimeInput && endTimeInput.value) || '23:59';
-
-                const payload = {
-                  title: title,
-                  description: descriptionInput ? descriptionInput.value : '',
-                  start_date: startDate,
-                  end_date: endDate,
-                  start_time: startTimeVal + ':00',
-                  end_time: endTimeVal + ':00',
-                  background_image_type: imageType,
-                  background_image: imageType === 'url' ? imageUrl : '',
-                  background_image_data: imageType === 'upload' ? imageData : '',
-                  is_active: true,
-                  created_by: 'admin'
-                };
-
-                try {
-                  const adIdInput = document.getElementById('adId');
-                  const isEditing = adIdInput && adIdInput.value;
-                  // Build endpoint with string concatenation to keep Python f-string evaluation out of the URL
-                  const endpoint = isEditing ? '/api/scheduled-ads/' + adIdInput.value : '/api/scheduled-ads';
-                  const method = isEditing ? 'PUT' : 'POST';
-
-                  const resp = await fetch(endpoint, {
-                    method: method,
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(payload)
-                  });
-
-                  const data = await resp.json();
-                  if (data.status === 'success') {
-                    window.location.reload();
-                  } else {
-                    showNotification(data.message || 'Failed to save schedule', 'error');
-                  }
-                } catch (err) {
-                  console.error(err);
-                  showNotification('Error saving schedule: ' + err.message, 'error');
-                }
-              });
-            }
-
-            // expose closeModal so the Cancel button works
-            window.closeModal = closeModal;
-
-            // Function to handle edit ad
-            window.editAd = function(adId) {
-              // Use simple string concatenation to avoid mixing JS template literals with Python f-strings
-              fetch('/api/scheduled-ads/' + adId)
-                .then(response => response.json())
-                .then(data => {
-                  if (data.status === 'success') {
-                    const ad = data.data;
-                    document.getElementById('modalTitle').textContent = 'Edit Schedule';
-                    document.getElementById('adId').value = ad.id;
-                    document.getElementById('title').value = ad.title || '';
-                    document.getElementById('description').value = ad.description || '';
-                    
-                    // Format dates for display
-                    const startDate = ad.start_date ? formatDateForDisplay(ad.start_date) : '';
-                    const endDate = ad.end_date ? formatDateForDisplay(ad.end_date) : '';
-                    
-                    // Set the values and reinitialize datepickers
-                    document.getElementById('start_date').value = startDate;
-                    document.getElementById('end_date').value = endDate;
-                    
-                    // Reinitialize datepickers after setting values
-                    initializeDatePickers();
-                    document.getElementById('start_time').value = ad.start_time ? ad.start_time.substring(0, 5) : '00:00';
-                    document.getElementById('end_time').value = ad.end_time ? ad.end_time.substring(0, 5) : '23:59';
-                    
-                    // Handle image preview
-                    const imagePreview = document.getElementById('adImagePreview');
-                    if (ad.background_image_type === 'url' && ad.background_image) {
-                      showUrlPanel();
-                      document.getElementById('adImageUrl').value = ad.background_image;
-                      imageType = 'url';
-                      imageUrl = ad.background_image;
-                      imagePreview.innerHTML = '<img src="' + ad.background_image + '" alt="Preview" style="max-width: 100%; max-height: 200px;">';
-                    } else if (ad.background_image_type === 'upload' && ad.background_image_data) {
-                      showUploadPanel();
-                      imageType = 'upload';
-                      imageData = ad.background_image_data;
-                      imagePreview.innerHTML = '<img src="' + ad.background_image_data + '" alt="Preview" style="max-width: 100%; max-height: 200px;">';
-                    }
-                    
-                    openCreateModal();
-                  } else {
-                    showNotification(data.message || 'Failed to load ad data', 'error');
-                  }
-                })
-                .catch(error => {
-                  console.error('Error:', error);
-                  showNotification('Error loading ad data: ' + error.message, 'error');
-                });
-            };
-
-            function openDeleteModal(adId) {
-              pendingDeleteId = adId;
-              if (deleteModal) {
-                deleteModal.classList.add('active');
-              }
-            }
-
-            function closeDeleteModal() {
-              pendingDeleteId = null;
-              if (deleteModal) {
-                deleteModal.classList.remove('active');
-              }
-            }
-
-            if (confirmDeleteYes) {
-              confirmDeleteYes.addEventListener('click', async function() {
-                if (!pendingDeleteId) {
-                  closeDeleteModal();
-                  return;
-                }
-                try {
-                  // Avoid JS template literals here; keep it simple so the Python f-string doesn't try to interpolate
-                  const resp = await fetch('/api/scheduled-ads/' + pendingDeleteId, {
-                    method: 'DELETE',
-                    headers: { 'Content-Type': 'application/json' },
-                  });
-                  const data = await resp.json();
-                  if (data.status === 'success') {
-                    window.location.reload();
-                  } else {
-                    alert('Error: ' + (data.message || 'Failed to delete schedule'));
-                    closeDeleteModal();
-                  }
-                } catch (error) {
-                  console.error('Error:', error);
-                  alert('Error deleting schedule: ' + error.message);
-                  closeDeleteModal();
-                }
-              });
-            }
-
-            if (confirmDeleteNo) {
-              confirmDeleteNo.addEventListener('click', function() {
-                closeDeleteModal();
-              });
-            }
+    today = date.today()
+    rows = []
+    for ad in ads:
+        # Determine status based on dates and active flag; recurring ads only count while an occurrence runs
+        if ad['recurrence_weekdays'] and ad['id'] in live_ids:
+            status = "active"
+        elif ad['is_active'] and not ad['recurrence_weekdays'] and ad['start_date'] <= today <= ad['end_date']:
+            status = "active"
+        elif today > ad['end_date']:
+            status = "expired"
+        else:
+            status = "pending"
+        rows.append({**ad, "status": status, "repeats": format_weekdays(ad['recurrence_weekdays'])})
+
+    titles = {ad['id']: ad['title'] for ad in ads}
+    performance = [
+        {"title": titles.get(ad_id, f"#{ad_id}"), "impressions": impressions, "clicks": clicks,
+         "ctr": click_through_rate(impressions, clicks)}
+        for ad_id, (impressions, clicks) in sorted(totals.items(), key=lambda item: -item[1][0])
+    ]
 
-            // Function to handle delete ad (trigger modal)
-            window.deleteAd = function(adId) {
-              openDeleteModal(adId);
-            };
-          });
-        </script>
-      </body>
-    </html>
-    """
-    return HTMLResponse(content=html)
+    return stream_template(
+        SCHEDULER_TEMPLATE, ads=rows, active_ad=active_ad, weekday_names=WEEKDAY_NAMES,
+        performance=performance, performance_days=AD_PERFORMANCE_DEFAULT_DAYS,
+    )
 
 # ==== Admin Panel for Page Settings ====
 @app.get("/admin", response_class=HTMLResponse)
@@ -2104,698 +3788,18 @@ async def admin_panel(request: Request):
     if not request.session.get("logged_in"):
         return RedirectResponse("/dashboard")
     
-    settings = get_page_settings()
-    bg_type = settings.get('background_image_type', 'url')
-    bg_url_value = settings.get('background_image', 'url(../img/nuanu.png)')
-    bg_data_value = settings.get('background_image_data', '')
-    bg_data_attr = bg_data_value.replace('"', '&quot;') if bg_data_value else ""
-    bg_url_attr = bg_url_value.replace('"', '&quot;') if bg_url_value else ""
-    google_ready = "true" if GOOGLE_OAUTH_ENABLED else "false"
-    
-    html = f"""
-    <html>
-      <head>
-        <title>Admin Panel - Page Settings</title>
-        <style>
-          body {{
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea, #764ba2);
-            padding: 20px;
-            margin: 0;
-          }}
-          .container {{
-            max-width: 900px;
-            margin: 0 auto;
-            background: white;
-            border-radius: 12px;
-            padding: 30px;
-            box-shadow: 0 10px 25px rgba(0,0,0,0.2);
-          }}
-          h1 {{
-            color: #333;
-            margin-bottom: 10px;
-          }}
-          .subtitle {{
-            color: #666;
-            margin-bottom: 30px;
-          }}
-          .section {{
-            background: #f8f9fa;
-            padding: 20px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-          }}
-          .section h2 {{
-            color: #667eea;
-            margin-top: 0;
-            font-size: 18px;
-          }}
-          .form-group {{
-            margin-bottom: 20px;
-          }}
-          .form-group label {{
-            display: block;
-            font-weight: 600;
-            margin-bottom: 8px;
-            color: #333;
-          }}
-          .radio-group {{
-            display: flex;
-            gap: 12px;
-            flex-wrap: wrap;
-            margin-bottom: 14px;
-          }}
-          .radio-option {{
-            position: relative;
-            display: inline-flex;
-            align-items: center;
-            gap: 10px;
-            padding: 12px 18px;
-            border-radius: 10px;
-            border: 2px solid #e1e8ed;
-            background: white;
-            cursor: pointer;
-            transition: all 0.2s ease;
-            font-weight: 600;
-            color: #4a5568;
-          }}
-          .radio-option input {{
-            position: absolute;
-            opacity: 0;
-            pointer-events: none;
-          }}
-          .radio-option.active {{
-            border-color: #667eea;
-            background: #eef2ff;
-            color: #4338ca;
-            box-shadow: 0 8px 20px rgba(102, 126, 234, 0.15);
-          }}
-          .hidden {{
-            display: none !important;
-          }}
-          .background-actions {{
-            display: flex;
-            flex-wrap: wrap;
-            gap: 10px;
-            margin-top: 12px;
-          }}
-          .background-actions button {{
-            flex: 1;
-            min-width: 160px;
-          }}
-          .background-info {{
-            font-size: 12px;
-            color: #666;
-            margin-top: 6px;
-          }}
-          .background-preview {{
-            margin-top: 16px;
-            border-radius: 12px;
-            border: 1px solid #e1e8ed;
-            height: 150px;
-            background: #f1f5f9;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: #94a3b8;
-            font-size: 14px;
-            position: relative;
-            overflow: hidden;
-          }}
-          .background-preview img {{
-            max-width: 100%;
-            max-height: 100%;
-            object-fit: cover;
-          }}
-          .background-preview .preview-badge {{
-            position: absolute;
-            top: 10px;
-            left: 10px;
-            background: rgba(15, 23, 42, 0.7);
-            color: white;
-            padding: 4px 10px;
-            border-radius: 999px;
-            font-size: 12px;
-            font-weight: 600;
-          }}
-          .oauth-status {{
-            font-size: 12px;
-            color: #6b7280;
-            margin-top: 6px;
-          }}
-          .toggle-switch {{
-            position: relative;
-            display: inline-block;
-            width: 60px;
-            height: 34px;
-          }}
-          .toggle-switch input {{
-            opacity: 0;
-            width: 0;
-            height: 0;
-          }}
-          .slider {{
-            position: absolute;
-            cursor: pointer;
-            top: 0;
-            left: 0;
-            right: 0;
-            bottom: 0;
-            background-color: #ccc;
-            transition: .4s;
-            border-radius: 34px;
-          }}
-          .slider:before {{
-            position: absolute;
-            content: "";
-            height: 26px;
-            width: 26px;
-            left: 4px;
-            bottom: 4px;
-            background-color: white;
-            transition: .4s;
-            border-radius: 50%;
-          }}
-          input:checked + .slider {{
-            background-color: #667eea;
-          }}
-          input:checked + .slider:before {{
-            transform: translateX(26px);
-          }}
-          input[type="text"], input[type="color"], textarea {{
-            width: 100%;
-            padding: 12px;
-            border: 2px solid #e1e8ed;
-            border-radius: 8px;
-            font-size: 14px;
-            box-sizing: border-box;
-          }}
-          textarea {{
-            min-height: 80px;
-            resize: vertical;
-          }}
-          .button-group {{
-            display: flex;
-            gap: 10px;
-            margin-top: 30px;
-          }}
-          button {{
-            background: #667eea;
-            color: white;
-            border: none;
-            padding: 12px 24px;
-            border-radius: 8px;
-            cursor: pointer;
-            font-size: 16px;
-            font-weight: 600;
-            transition: all 0.3s;
-          }}
-          button:hover {{
-            background: #5a67d8;
-            transform: translateY(-2px);
-          }}
-          .btn-secondary {{
-            background: #6c757d;
-          }}
-          .btn-secondary:hover {{
-            background: #5a6268;
-          }}
-          .preview-link {{
-            display: inline-block;
-            margin-left: 10px;
-            color: #667eea;
-            text-decoration: none;
-            font-weight: 600;
-          }}
-          .preview-link:hover {{
-            text-decoration: underline;
-          }}
-          .success-message {{
-            background: #d4edda;
-            color: #155724;
-            padding: 12px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-            display: none;
-          }}
-          /* Loading Overlay */
-          .loading-overlay {{
-            display: none;
-            position: fixed;
-            top: 0;
-            left: 0;
-            right: 0;
-            bottom: 0;
-            background: rgba(0, 0, 0, 0.7);
-            z-index: 9999;
-            justify-content: center;
-            align-items: center;
-          }}
-          .loading-overlay.active {{
-            display: flex;
-          }}
-          .loading-content {{
-            background: white;
-            padding: 30px;
-            border-radius: 12px;
-            text-align: center;
-          }}
-          .spinner {{
-            border: 4px solid #f3f3f3;
-            border-top: 4px solid #667eea;
-            border-radius: 50%;
-            width: 50px;
-            height: 50px;
-            animation: spin 1s linear infinite;
-            margin: 0 auto 20px;
-          }}
-          @keyframes spin {{
-            0% {{ transform: rotate(0deg); }}
-            100% {{ transform: rotate(360deg); }}
-          }}
-          /* Success Popup */
-          .success-popup {{
-            display: none;
-            position: fixed;
-            top: 50%;
-            left: 50%;
-            transform: translate(-50%, -50%) scale(0.7);
-            background: white;
-            padding: 40px;
-            border-radius: 16px;
-            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
-            z-index: 10000;
-            text-align: center;
-            opacity: 0;
-            transition: all 0.3s ease;
-          }}
-          .success-popup.active {{
-            display: block;
-            opacity: 1;
-            transform: translate(-50%, -50%) scale(1);
-          }}
-          .success-icon {{
-            width: 80px;
-            height: 80px;
-            border-radius: 50%;
-            background: #10b981;
-            margin: 0 auto 20px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            animation: scaleIn 0.5s ease;
-          }}
-          @keyframes scaleIn {{
-            0% {{ transform: scale(0); }}
-            50% {{ transform: scale(1.1); }}
-            100% {{ transform: scale(1); }}
-          }}
-          .success-icon::after {{
-            content: '✓';
-            color: white;
-            font-size: 50px;
-            font-weight: bold;
-          }}
-          .success-popup h2 {{
-            color: #10b981;
-            margin: 0 0 10px 0;
-          }}
-          .success-popup p {{
-            color: #666;
-            margin: 0;
-          }}
-          .nav-links {{
-            margin-bottom: 20px;
-          }}
-          .nav-links a {{
-            color: #667eea;
-            text-decoration: none;
-            margin-right: 15px;
-            font-weight: 600;
-          }}
-          .nav-links a:hover {{
-            text-decoration: underline;
-          }}
-        </style>
-      </head>
-      <body>
-        <!-- Loading Overlay -->
-        <div class="loading-overlay" id="loading-overlay">
-          <div class="loading-content">
-            <div class="spinner"></div>
-            <p style="color: #333; font-weight: 600;">Saving settings...</p>
-          </div>
-        </div>
-        
-        <!-- Success Popup -->
-        <div class="success-popup" id="success-popup">
-          <div class="success-icon"></div>
-          <h2>Success!</h2>
-          <p>Your settings have been saved successfully</p>
-        </div>
-        
-        <div class="container">
-          <div class="nav-links">
-            <a href="/dashboard">← Back to Dashboard</a>
-            <a href="/admin/scheduler">📅 CMS Scheduler</a>
-            <a href="/login" target="_blank">Preview Login Page →</a>
-          </div>
-          
-          <h1>⚙️ Admin Panel</h1>
-          <p class="subtitle">Manage your login page settings and features</p>
-          
-          <div id="success-message" class="success-message">
-            ✓ Settings saved successfully!
-          </div>
-          
-          <form id="settings-form">
-            <!-- Login Features Section -->
-            <div class="section">
-              <h2>🔐 Login Features</h2>
-              
-              <div class="form-group">
-                <label>
-                  Google Login Button
-                  <label class="toggle-switch">
-                    <input type="checkbox" id="google_login_enabled" 
-                           {"checked" if settings.get('google_login_enabled') == 'true' else ""}>
-                    <span class="slider"></span>
-                  </label>
-                </label>
-                <div class="oauth-status">
-                  {"✅ Google OAuth credentials detected." if GOOGLE_OAUTH_ENABLED else "⚠️ Google OAuth credentials are missing. The Google button will appear but stay offline until credentials are added to the server."}
-                </div>
-              </div>
-              
-              <div class="form-group">
-                <label>
-                  Facebook Login Button
-                  <label class="toggle-switch">
-                    <input type="checkbox" id="facebook_login_enabled"
-                           {"checked" if settings.get('facebook_login_enabled') == 'true' else ""}>
-                    <span class="slider"></span>
-                  </label>
-                </label>
-                <div class="oauth-status">
-                  {"✅ Facebook OAuth credentials detected." if FACEBOOK_OAUTH_ENABLED else "⚠️ Facebook OAuth credentials are missing. The Facebook button will appear but stay offline until credentials are added to the server."}
-                </div>
-              </div>
-            </div>
-            
-            <!-- OAuth Credentials Section -->
-            <div class="section">
-              <h2>🔑 OAuth Credentials</h2>
-              <p style="color: #666; font-size: 14px; margin-bottom: 20px;">
-                Configure your Google and Facebook OAuth credentials. Changes will be saved to the .env file and take effect immediately.
-              </p>
-              
-              <div class="form-group">
-                <label for="google_client_id">Google Client ID</label>
-                <input type="text" id="google_client_id" 
-                       value="{GOOGLE_CLIENT_ID or ''}"
-                       placeholder="Enter your Google OAuth Client ID">
-                <small style="color: #666; display: block; margin-top: 5px;">
-                  Get this from <a href="https://console.cloud.google.com/apis/credentials" target="_blank">Google Cloud Console</a>
-                </small>
-              </div>
-              
-              <div class="form-group">
-                <label for="google_client_secret">Google Client Secret</label>
-                <input type="password" id="google_client_secret" 
-                       value="{GOOGLE_CLIENT_SECRET or ''}"
-                       placeholder="Enter your Google OAuth Client Secret">
-                <small style="color: #666; display: block; margin-top: 5px;">
-                  Keep this secret secure. It will be stored in the .env file.
-                </small>
-              </div>
-              
-              <div class="form-group">
-                <label for="facebook_client_id">Facebook App ID</label>
-                <input type="text" id="facebook_client_id" 
-                       value="{FACEBOOK_CLIENT_ID or ''}"
-                       placeholder="Enter your Facebook App ID">
-                <small style="color: #666; display: block; margin-top: 5px;">
-                  Get this from <a href="https://developers.facebook.com/apps/" target="_blank">Facebook Developers</a>
-                </small>
-              </div>
-              
-              <div class="form-group">
-                <label for="facebook_client_secret">Facebook App Secret</label>
-                <input type="password" id="facebook_client_secret" 
-                       value="{FACEBOOK_CLIENT_SECRET or ''}"
-                       placeholder="Enter your Facebook App Secret">
-                <small style="color: #666; display: block; margin-top: 5px;">
-                  Keep this secret secure. It will be stored in the .env file.
-                </small>
-              </div>
-            </div>
-            
-            <!-- Page Appearance Section -->
-            <div class="section">
-              <h2>🎨 Page Appearance</h2>
-              
-              <div class="form-group">
-                <label for="page_title">Page Title</label>
-                <input type="text" id="page_title" 
-                       value="{settings.get('page_title', 'Welcome To NUANU Free WiFi')}">
-              </div>
-              
-              <div class="form-group">
-                <label for="button_text">Button Text</label>
-                <input type="text" id="button_text" 
-                       value="{settings.get('button_text', 'Connect to WiFi')}">
-              </div>
-              
-              <div class="form-group">
-                <label>Background Image</label>
-                <p class="helper-text" style="margin-top: -5px;">Upload from your computer.</p>
-                
-                <div id="background-upload-fields">
-                  <input type="file" id="background_file" accept="image/*" style="display: none;">
-                  <div class="background-actions">
-                    <button type="button" id="choose-file-btn">📁 Choose Image</button>
-                    <button type="button" class="btn-secondary" id="clear-upload-btn">Remove</button>
-                  </div>
-                  <div class="background-info">
-                    Supported formats: JPG or PNG up to 3 MB.
-                  </div>
-                </div>
-                
-                <div class="background-preview" id="background-preview">
-                  <span id="background-preview-label">No image selected</span>
-                </div>
-                <input type="hidden" id="background_image_data" value="{bg_data_attr}">
-                <input type="hidden" id="background_image" value="">
-                <input type="hidden" id="background_color" value="{settings.get('background_color', '#667eea')}">
-              </div>
-            </div>
-            
-            <div class="button-group">
-              <button type="submit">💾 Save Settings</button>
-              <button type="button" class="btn-secondary" onclick="window.location.href='/dashboard'">
-                Cancel
-              </button>
-            </div>
-          </form>
-        </div>
-        
-        <script>
-          // Wait for DOM to be ready
-          document.addEventListener('DOMContentLoaded', function() {{
-            console.log('DOM loaded, initializing file upload...');
-            
-            // File upload variables
-            const MAX_UPLOAD_SIZE = 3 * 1024 * 1024; // 3 MB
-            const backgroundImageDataInput = document.getElementById('background_image_data');
-            const backgroundPreview = document.getElementById('background-preview');
-            const chooseFileBtn = document.getElementById('choose-file-btn');
-            const clearUploadBtn = document.getElementById('clear-upload-btn');
-            const backgroundFileInput = document.getElementById('background_file');
-            const previewBadgeClass = 'preview-badge';
-            
-            console.log('Elements found:', {{
-              chooseFileBtn: !!chooseFileBtn,
-              backgroundFileInput: !!backgroundFileInput,
-              clearUploadBtn: !!clearUploadBtn,
-              backgroundPreview: !!backgroundPreview,
-              backgroundImageDataInput: !!backgroundImageDataInput
-            }});
-            
-            // Render preview function
-            function renderPreview() {{
-              if (!backgroundPreview || !backgroundImageDataInput) return;
-              backgroundPreview.style.backgroundImage = 'none';
-              backgroundPreview.innerHTML = '';
-              
-              const data = backgroundImageDataInput.value.trim();
-              if (data) {{
-                const img = document.createElement('img');
-                img.src = data;
-                backgroundPreview.appendChild(img);
-                const badge = document.createElement('span');
-                badge.className = previewBadgeClass;
-                badge.textContent = 'Uploaded';
-                backgroundPreview.appendChild(badge);
-              }} else {{
-                backgroundPreview.textContent = 'Upload an image to preview';
-              }}
-            }}
-            
-            // Choose Image button - FIXED!
-            if (chooseFileBtn) {{
-              chooseFileBtn.addEventListener('click', function(e) {{
-                e.preventDefault();
-                e.stopPropagation();
-                console.log('Choose Image button clicked!');
-                if (backgroundFileInput) {{
-                  console.log('Triggering file input click...');
-                  backgroundFileInput.click();
-                }} else {{
-                  console.error('backgroundFileInput not found!');
-                  alert('File input not found. Please refresh the page.');
-                }}
-              }});
-              console.log('Choose Image button event listener attached');
-            }} else {{
-              console.error('Choose Image button not found!');
-            }}
-            
-            // Clear/Remove button
-            if (clearUploadBtn) {{
-              clearUploadBtn.addEventListener('click', function() {{
-                if (backgroundFileInput) backgroundFileInput.value = '';
-                if (backgroundImageDataInput) backgroundImageDataInput.value = '';
-                renderPreview();
-              }});
-            }}
-            
-            // File input change handler
-            if (backgroundFileInput) {{
-              backgroundFileInput.addEventListener('change', function(event) {{
-                const file = event.target.files[0];
-                if (!file) return;
-                
-                if (!file.type.startsWith('image/')) {{
-                  alert('Please choose an image file.');
-                  event.target.value = '';
-                  return;
-                }}
-                if (file.size > MAX_UPLOAD_SIZE) {{
-                  alert('Image is too large. Choose a file smaller than 3 MB.');
-                  event.target.value = '';
-                  return;
-                }}
-                
-                const reader = new FileReader();
-                reader.onload = function(e) {{
-                  if (backgroundImageDataInput) {{
-                    backgroundImageDataInput.value = e.target.result;
-                    renderPreview();
-                  }}
-                }};
-                reader.onerror = function() {{
-                  alert('Failed to read the image file.');
-                }};
-                reader.readAsDataURL(file);
-              }});
-            }}
-            
-            // Initialize preview on page load
-            renderPreview();
-            
-            // Form submit handler
-            const loadingOverlay = document.getElementById('loading-overlay');
-            const settingsForm = document.getElementById('settings-form');
-            if (settingsForm) {{
-              settingsForm.addEventListener('submit', async (e) => {{
-              e.preventDefault();
-              
-              if (!backgroundImageDataInput.value) {{
-                alert('Please upload an image first.');
-                return;
-              }}
-              
-              loadingOverlay.classList.add('active');
-              
-              const settings = {{
-                google_login_enabled: document.getElementById('google_login_enabled').checked ? 'true' : 'false',
-                facebook_login_enabled: document.getElementById('facebook_login_enabled').checked ? 'true' : 'false',
-                background_image: '',
-                background_image_type: 'upload',
-                background_image_data: backgroundImageDataInput.value,
-                background_color: document.getElementById('background_color').value,
-                page_title: document.getElementById('page_title').value,
-                button_text: document.getElementById('button_text').value
-              }};
-              
-              // Get OAuth credentials
-              const oauthCredentials = {{
-                google_client_id: document.getElementById('google_client_id').value.trim(),
-                google_client_secret: document.getElementById('google_client_secret').value.trim(),
-                facebook_client_id: document.getElementById('facebook_client_id').value.trim(),
-                facebook_client_secret: document.getElementById('facebook_client_secret').value.trim()
-              }};
-              
-              try {{
-                // Save page settings
-                const settingsResponse = await fetch('/api/settings', {{
-                  method: 'POST',
-                  headers: {{ 'Content-Type': 'application/json' }},
-                  body: JSON.stringify(settings)
-                }});
-                
-                // Save OAuth credentials
-                const credentialsResponse = await fetch('/api/oauth-credentials', {{
-                  method: 'POST',
-                  headers: {{ 'Content-Type': 'application/json' }},
-                  body: JSON.stringify(oauthCredentials)
-                }});
-                
-                // Wait for both responses
-                const [settingsData, credentialsData] = await Promise.all([
-                  settingsResponse.json().catch(() => ({{}})),
-                  credentialsResponse.json().catch(() => ({{}}))
-                ]);
-                
-                setTimeout(() => {{
-                  loadingOverlay.classList.remove('active');
-                  
-                  let settingsOk = settingsResponse.ok;
-                  let credentialsOk = credentialsResponse.ok;
-                  
-                  if (settingsOk && credentialsOk) {{
-                    const successPopup = document.getElementById('success-popup');
-                    successPopup.classList.add('active');
-                    setTimeout(() => {{
-                      successPopup.classList.remove('active');
-                      // Reload page after 2 seconds to show updated OAuth status
-                      setTimeout(() => {{
-                        window.location.reload();
-                      }}, 500);
-                    }}, 2000);
-                  }} else {{
-                    let errorMsg = 'Failed to save settings.';
-                    if (!settingsOk) {{
-                      errorMsg = 'Settings: ' + (settingsData.message || settingsResponse.statusText);
-                    }}
-                    if (!credentialsOk) {{
-                      errorMsg += '\\nCredentials: ' + (credentialsData.message || credentialsResponse.statusText);
-                    }}
-                    alert(errorMsg);
-                  }}
-                }}, 800);
-              }} catch (error) {{
-                loadingOverlay.classList.remove('active');
-                alert('Error saving settings: ' + error.message);
-              }}
-              }});
-            }}
-          }});
-        </script>
-      </body>
-    </html>
-    """
-    return HTMLResponse(content=html)
+    settings = {**_default_page_settings(), **(await run_db(get_page_settings))}
+    return stream_template(
+        ADMIN_TEMPLATE,
+        settings=settings,
+        background_image_data=media_url(settings.get('background_image_data', '')),
+        google_oauth_enabled=GOOGLE_OAUTH_ENABLED,
+        facebook_oauth_enabled=FACEBOOK_OAUTH_ENABLED,
+        google_client_id=GOOGLE_CLIENT_ID or '',
+        google_client_secret=GOOGLE_CLIENT_SECRET or '',
+        facebook_client_id=FACEBOOK_CLIENT_ID or '',
+        facebook_client_secret=FACEBOOK_CLIENT_SECRET or '',
+    )
 
 # ==== API Endpoint to Update Settings ====
 @app.post("/api/settings")
@@ -2810,28 +3814,34 @@ async def update_settings(request: Request):
     if img_mode == "upload":
         if not data_url:
             return JSONResponse({"status": "error", "message": "Please upload an image before saving."}, status_code=400)
-        if not data_url.startswith("data:image/"):
-            return JSONResponse({"status": "error", "message": "Invalid image format."}, status_code=400)
-        if len(data_url) > 8_000_000:  # ~6 MB when decoded
-            return JSONResponse({"status": "error", "message": "Image is too large. Please keep it under 6 MB."}, status_code=400)
+        try:
+            data["background_image_data"] = await run_in_threadpool(normalize_media_ref, data_url)
+        except MediaError as e:
+            return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
     else:
         data["background_image_data"] = ""
     
     if img_mode == "none":
         data["background_image"] = ""
     
-    for key, value in data.items():
-        update_page_setting(key, value)
+    version = await run_db(update_page_settings, data)
     
-    return JSONResponse({"status": "success", "message": "Settings updated"})
+    return JSONResponse({"status": "success", "message": "Settings updated", "version": version})
 
 # ==== API Endpoint to Get Settings (for dynamic login page) ====
-@app.get("/api/settings")
-async def get_settings():
-    settings = get_page_settings()
+def public_settings_payload(settings: dict) -> dict:
+    settings["background_image_data"] = media_url(settings.get("background_image_data", ""))
     settings["google_oauth_available"] = "true" if GOOGLE_OAUTH_ENABLED else "false"
     settings["facebook_oauth_available"] = "true" if FACEBOOK_OAUTH_ENABLED else "false"
-    return JSONResponse(settings)
+    return settings
+
+@app.get("/api/settings")
+async def get_settings(request: Request):
+    async def render():
+        settings = await load_safe_settings()
+        return JSONResponse(public_settings_payload(settings)).body, None
+
+    return await cached_render(request, settings_response_cache, settings_response_key, render, "application/json")
 
 # ==== API Endpoint to Update OAuth Credentials ====
 @app.post("/api/oauth-credentials")
@@ -2869,32 +3879,57 @@ async def update_oauth_credentials(request: Request):
             "message": f"Failed to update credentials: {str(e)}"
         }, status_code=500)
 
+# ==== API Endpoint for Worker Metrics ====
+@app.get("/api/metrics")
+async def get_metrics(request: Request):
+    """Per-worker runtime statistics (connection pool usage, etc.)."""
+    if not request.session.get("logged_in"):
+        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
+    return JSONResponse({
+        "status": "success",
+        "pid": os.getpid(),
+        "db_pool": get_pool().stats(),
+        "db_executor": db_executor_stats(),
+        "db_breaker": db_breaker.stats(),
+        "cache_listener": cache_listener.stats(),
+        "settings_cache": settings_cache.stats(),
+        "ad_schedule": ad_schedule.stats(),
+        "login_page_cache": login_page_cache.stats(),
+        "settings_response_cache": settings_response_cache.stats(),
+        "active_ad_response_cache": active_ad_response_cache.stats(),
+        "bootstrap_response_cache": bootstrap_response_cache.stats(),
+        "capture_queue": capture_queue.stats(),
+        "capture_spool": await run_in_threadpool(capture_spool.stats),
+        "ad_events": ad_event_counters.stats(),
+    })
+
 # ==== CMS Scheduler API Endpoints ====
 @app.get("/api/scheduled-ads")
 async def get_scheduled_ads_api(request: Request):
     """Get all scheduled ads for admin panel"""
     if not request.session.get("logged_in"):
         return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
-    ads = get_all_scheduled_ads()
+    ads = await run_db(get_all_scheduled_ads)
     return JSONResponse({"status": "success", "ads": ads})
 
+def fetch_scheduled_ad_row(ad_id: int):
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT id, title, description, background_image, background_image_type,
+                   background_image_data, background_color, page_title, button_text,
+                   start_date, end_date, start_time, end_time, is_active, created_by,
+                   recurrence_weekdays, recurrence_exceptions, rotation_weight
+            FROM scheduled_ads
+            WHERE id = %s
+        """, (ad_id,))
+        return cur.fetchone()
+
 @app.get("/api/scheduled-ads/{ad_id}")
 async def get_scheduled_ad_api(request: Request, ad_id: int):
     """Get a specific scheduled ad"""
     if not request.session.get("logged_in"):
         return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, title, description, background_image, background_image_type,
-               background_image_data, background_color, page_title, button_text,
-               start_date, end_date, start_time, end_time, is_active, created_by
-        FROM scheduled_ads
-        WHERE id = %s
-    """, (ad_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    row = await run_db(fetch_scheduled_ad_row, ad_id)
     
     if not row:
         return JSONResponse({"status": "error", "message": "Ad not found"}, status_code=404)
@@ -2906,7 +3941,7 @@ async def get_scheduled_ad_api(request: Request, ad_id: int):
         'description': row[2],
         'background_image': row[3],
         'background_image_type': row[4],
-        'background_image_data': row[5],
+        'background_image_data': media_url(row[5]),
         'background_color': row[6],
         'page_title': row[7],
         'button_text': row[8],
@@ -2916,6 +3951,9 @@ async def get_scheduled_ad_api(request: Request, ad_id: int):
         'end_time': str(row[12]),
         'is_active': row[13],
         'created_by': row[14],
+        'recurrence_weekdays': row[15] or 0,
+        'recurrence_exceptions': [str(day) for day in row[16]],
+        'rotation_weight': row[17] or 0,
     }
 
     return JSONResponse({
@@ -2924,6 +3962,125 @@ async def get_scheduled_ad_api(request: Request, ad_id: int):
         "ad": ad_payload,
     })
 
+def parse_schedule_fields(data: dict):
+    """Normalize the recurrence and rotation fields of a request payload, in place."""
+    for key, parse in (
+        ('recurrence_weekdays', parse_weekdays),
+        ('recurrence_exceptions', parse_exception_dates),
+        ('rotation_weight', parse_rotation_weight),
+    ):
+        if key in data:
+            data[key] = parse(data[key])
+
+def find_schedule_conflict(cur, ad_id, start_date, start_time, end_date, end_time):
+    """Row of the active schedule (other than ad_id) that the given period overlaps.
+
+    Called after an ExclusionViolation to name the conflicting ad; re-raises
+    if that ad was removed in the meantime.
+    """
+    cur.execute(SCHEDULE_CONFLICT_QUERY, (ad_id, start_date, start_time, end_date, end_time))
+    overlapping = cur.fetchone()
+    if overlapping is None:
+        raise RuntimeError("Schedule conflicts with an ad that no longer exists; please retry")
+    return overlapping
+
+def occurrence_conflict(cur, ad_id: int):
+    """Row of the first active schedule whose occurrences overlap ad_id's, when either recurs or rotates.
+
+    Overlaps between two one-off schedules without a rotation_weight are left
+    to scheduled_ads_no_overlap; two rotating ads may overlap freely.
+    Reads ad_id as stored, so call it after the write; callers hold
+    SCHEDULE_WRITE_LOCK_ID, so no other write can slip in between.
+    """
+    cur.execute("""
+        SELECT start_date, end_date, start_time, end_time, recurrence_weekdays, recurrence_exceptions,
+               is_active, lower(active_period), upper(active_period), rotation_weight
+        FROM scheduled_ads
+        WHERE id = %s
+    """, (ad_id,))
+    row = cur.fetchone()
+    if not row or not row[6] or row[7] is None:
+        return None
+    shared = row[9] is not None
+    cur.execute("""
+        SELECT id, title, start_date, end_date, start_time, end_time, recurrence_weekdays, recurrence_exceptions
+        FROM scheduled_ads
+        WHERE is_active = TRUE
+          AND id <> %s
+          AND active_period && tsrange(%s, %s)
+          AND (%s OR recurrence_weekdays IS NOT NULL OR rotation_weight IS NOT NULL)
+          AND NOT (%s AND rotation_weight IS NOT NULL)
+    """, (ad_id, row[7], row[8], row[4] is not None or shared, shared))
+    candidates = cur.fetchall()
+    if not candidates:
+        return None
+    first_day, last_day = row[7].date() - timedelta(days=1), row[8].date()
+    periods = [(start, end, None) for start, end in schedule_occurrences(*row[:6])]
+    for i, other in enumerate(candidates):
+        periods.extend((start, end, i) for start, end in schedule_occurrences(*other[2:8], first_day, last_day))
+    for a, b in schedule_overlaps(periods):
+        if (a is None) != (b is None):
+            return candidates[a if b is None else b][:6]
+    return None
+
+def insert_scheduled_ad(data: dict):
+    """Insert a scheduled ad unless it overlaps an active one.
+
+    Returns (new_id, None) on success or (None, overlapping_row) on conflict.
+    One-off overlaps are refused by the scheduled_ads_no_overlap constraint
+    and recurring or rotating ones by occurrence_conflict() under
+    SCHEDULE_WRITE_LOCK_ID, so two concurrent inserts cannot both win.
+    """
+    start_date = data.get('start_date')
+    end_date = data.get('end_date')
+    start_time = data.get('start_time', '00:00:00')
+    end_time = data.get('end_time', '23:59:59')
+    
+    with db_cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEDULE_WRITE_LOCK_ID,))
+        cur.execute("SAVEPOINT schedule_write")
+        try:
+            cur.execute("""
+                INSERT INTO scheduled_ads (
+                    title, description, background_image, background_image_type,
+                    background_image_data, background_color, page_title, button_text,
+                    start_date, end_date, start_time, end_time, is_active, created_by,
+                    recurrence_weekdays, recurrence_exceptions, rotation_weight
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """, (
+                data.get('title'),
+                data.get('description'),
+                data.get('background_image'),
+                data.get('background_image_type', 'url'),
+                data.get('background_image_data', ''),
+                data.get('background_color', '#667eea'),
+                data.get('page_title'),
+                data.get('button_text'),
+                start_date,
+                end_date,
+                start_time,
+                end_time,
+                data.get('is_active', True),
+                data.get('created_by', 'admin'),
+                data.get('recurrence_weekdays') or None,
+                data.get('recurrence_exceptions') or [],
+                data.get('rotation_weight') or None,
+            ))
+        except psycopg2.errors.ExclusionViolation:
+            cur.execute("ROLLBACK TO SAVEPOINT schedule_write")
+            return None, find_schedule_conflict(cur, None, start_date, start_time, end_date, end_time)
+    
+        ad_id = cur.fetchone()[0]
+        overlapping = occurrence_conflict(cur, ad_id)
+        if overlapping:
+            cur.execute("ROLLBACK TO SAVEPOINT schedule_write")
+            return None, overlapping
+        version = bump_cache_version(cur, "scheduled_ads")
+    ad_schedule.invalidate(version)
+    return ad_id, None
+
+
 @app.post("/api/scheduled-ads")
 async def create_scheduled_ad(request: Request):
     """Create a new scheduled ad"""
@@ -2931,77 +4088,25 @@ async def create_scheduled_ad(request: Request):
         return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
     
     data = await request.json()
+    if data.get('background_image_data'):
+        try:
+            data['background_image_data'] = await run_in_threadpool(normalize_media_ref, data['background_image_data'])
+        except MediaError as e:
+            return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
     
     # Validate required fields
     required_fields = ['title', 'start_date', 'end_date']
     for field in required_fields:
         if field not in data or not data[field]:
             return JSONResponse({"status": "error", "message": f"Missing required field: {field}"}, status_code=400)
+    try:
+        parse_schedule_fields(data)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
     
-    # Parse dates and times
     try:
-        start_date = data.get('start_date')
-        end_date = data.get('end_date')
-        start_time = data.get('start_time', '00:00:00')
-        end_time = data.get('end_time', '23:59:59')
-        
-        # Check for overlapping schedules
-        conn = get_connection()
-        cur = conn.cursor()
-        
-        # Query to find any active schedules that overlap with the new schedule
-        overlap_query = """
-            SELECT id, title, start_date, end_date, start_time, end_time
-            FROM scheduled_ads
-            WHERE is_active = TRUE
-              AND (
-                -- Case 1: New schedule starts during an existing schedule
-                (start_date <= %s AND end_date >= %s AND 
-                 (start_date < %s OR (start_date = %s AND start_time <= %s)) AND
-                 (end_date > %s OR (end_date = %s AND end_time >= %s)))
-                OR
-                -- Case 2: New schedule ends during an existing schedule
-                (start_date <= %s AND end_date >= %s AND
-                 (start_date < %s OR (start_date = %s AND start_time <= %s)) AND
-                 (end_date > %s OR (end_date = %s AND end_time >= %s)))
-                OR
-                -- Case 3: New schedule completely contains an existing schedule
-                (start_date >= %s AND end_date <= %s AND
-                 (start_date > %s OR (start_date = %s AND start_time >= %s)) AND
-                 (end_date < %s OR (end_date = %s AND end_time <= %s)))
-                OR
-                -- Case 4: Existing schedule completely contains the new schedule
-                (start_date <= %s AND end_date >= %s AND
-                 (start_date < %s OR (start_date = %s AND start_time <= %s)) AND
-                 (end_date > %s OR (end_date = %s AND end_time >= %s)))
-              )
-        """
-        
-        params = (
-            # Case 1: New schedule starts during existing
-            start_date, start_date,
-            start_date, start_date, start_time,
-            start_date, start_date, start_time,
-            # Case 2: New schedule ends during existing
-            end_date, end_date,
-            end_date, end_date, end_time,
-            end_date, end_date, end_time,
-            # Case 3: New schedule contains existing
-            start_date, end_date,
-            start_date, start_date, start_time,
-            end_date, end_date, end_time,
-            # Case 4: Existing contains new schedule
-            start_date, end_date,
-            start_date, start_date, start_time,
-            end_date, end_date, end_time,
-        )
-        
-        cur.execute(overlap_query, params)
-        overlapping = cur.fetchone()
-        
+        ad_id, overlapping = await run_db(insert_scheduled_ad, data)
         if overlapping:
-            cur.close()
-            conn.close()
             overlap_title = overlapping[1]
             overlap_dates = f"{overlapping[2]} to {overlapping[3]}"
             return JSONResponse({
@@ -3009,47 +4114,89 @@ async def create_scheduled_ad(request: Request):
                 "message": f"A schedule already exists for this date/time range: '{overlap_title}' ({overlap_dates}). Please choose a different time period."
             }, status_code=400)
         
-        # No overlap found, proceed with creation
-        cur.execute("""
-            INSERT INTO scheduled_ads (
-                title, description, background_image, background_image_type,
-                background_image_data, background_color, page_title, button_text,
-                start_date, end_date, start_time, end_time, is_active, created_by
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            data.get('title'),
-            data.get('description'),
-            data.get('background_image'),
-            data.get('background_image_type', 'url'),
-            data.get('background_image_data', ''),
-            data.get('background_color', '#667eea'),
-            data.get('page_title'),
-            data.get('button_text'),
-            start_date,
-            end_date,
-            start_time,
-            end_time,
-            data.get('is_active', True),
-            data.get('created_by', 'admin')
-        ))
-        
-        ad_id = cur.fetchone()[0]
-        conn.commit()
-        cur.close()
-        conn.close()
-        
         return JSONResponse({"status": "success", "message": "Scheduled ad created", "id": ad_id})
     
     except Exception as e:
-        if 'conn' in locals() and conn:
-            conn.rollback()
-            if 'cur' in locals() and cur:
-                cur.close()
-            conn.close()
         return JSONResponse({"status": "error", "message": f"Error creating schedule: {str(e)}"}, status_code=500)
 
 
+def apply_scheduled_ad_update(ad_id: int, data: dict):
+    """Apply a partial update to a scheduled ad, refusing overlaps with other active ads.
+
+    Returns ("updated" | "not_found" | "overlap", overlapping_row_or_None).
+    Activating an ad is checked the same way as moving its dates, by the
+    scheduled_ads_no_overlap constraint and occurrence_conflict().
+    A recurrence_weekdays of 0 turns the ad back into a one-off schedule and
+    a rotation_weight of 0 makes it keep its time to itself again.
+    """
+    with db_cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEDULE_WRITE_LOCK_ID,))
+        cur.execute("SAVEPOINT schedule_write")
+        try:
+            cur.execute("""
+                UPDATE scheduled_ads SET
+                    title = COALESCE(%s, title),
+                    description = COALESCE(%s, description),
+                    background_image = COALESCE(%s, background_image),
+                    background_image_type = COALESCE(%s, background_image_type),
+                    background_image_data = COALESCE(%s, background_image_data),
+                    background_color = COALESCE(%s, background_color),
+                    page_title = COALESCE(%s, page_title),
+                    button_text = COALESCE(%s, button_text),
+                    start_date = COALESCE(%s, start_date),
+                    end_date = COALESCE(%s, end_date),
+                    start_time = COALESCE(%s, start_time),
+                    end_time = COALESCE(%s, end_time),
+                    is_active = COALESCE(%s, is_active),
+                    recurrence_weekdays = NULLIF(COALESCE(%s, recurrence_weekdays), 0),
+                    recurrence_exceptions = COALESCE(%s, recurrence_exceptions),
+                    rotation_weight = NULLIF(COALESCE(%s, rotation_weight), 0),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+                RETURNING id
+            """, (
+                data.get('title'),
+                data.get('description'),
+                data.get('background_image'),
+                data.get('background_image_type'),
+                data.get('background_image_data'),
+                data.get('background_color'),
+                data.get('page_title'),
+                data.get('button_text'),
+                data.get('start_date'),
+                data.get('end_date'),
+                data.get('start_time'),
+                data.get('end_time'),
+                data.get('is_active'),
+                data.get('recurrence_weekdays'),
+                data.get('recurrence_exceptions'),
+                data.get('rotation_weight'),
+                ad_id
+            ))
+        except psycopg2.errors.ExclusionViolation:
+            cur.execute("ROLLBACK TO SAVEPOINT schedule_write")
+            cur.execute("SELECT start_date, end_date, start_time, end_time FROM scheduled_ads WHERE id = %s", (ad_id,))
+            current = cur.fetchone()
+            if not current:
+                return "not_found", None
+            # Same precedence as the COALESCEs above: given values win, missing ones keep the row's
+            start_date, end_date, start_time, end_time = (
+                data[key] if data.get(key) is not None else value
+                for key, value in zip(('start_date', 'end_date', 'start_time', 'end_time'), current)
+            )
+            return "overlap", find_schedule_conflict(cur, ad_id, start_date, start_time, end_date, end_time)
+    
+        if not cur.fetchone():
+            return "not_found", None
+        overlapping = occurrence_conflict(cur, ad_id)
+        if overlapping:
+            cur.execute("ROLLBACK TO SAVEPOINT schedule_write")
+            return "overlap", overlapping
+        version = bump_cache_version(cur, "scheduled_ads")
+    ad_schedule.invalidate(version)
+    return "updated", None
+
+
 @app.put("/api/scheduled-ads/{ad_id}")
 async def update_scheduled_ad(request: Request, ad_id: int):
     """Update a scheduled ad"""
@@ -3057,177 +4204,366 @@ async def update_scheduled_ad(request: Request, ad_id: int):
         return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
     
     data = await request.json()
+    if data.get('background_image_data'):
+        try:
+            data['background_image_data'] = await run_in_threadpool(normalize_media_ref, data['background_image_data'])
+        except MediaError as e:
+            return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
     
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        
-        # If dates/times are being updated, check for overlaps (excluding current schedule)
-        if any(key in data for key in ['start_date', 'end_date', 'start_time', 'end_time']):
-            # First, get the current schedule's dates/times
-            cur.execute("""
-                SELECT start_date, end_date, start_time, end_time
-                FROM scheduled_ads
-                WHERE id = %s
-            """, (ad_id,))
-            current = cur.fetchone()
-            
-            if not current:
-                cur.close()
-                conn.close()
-                return JSONResponse({"status": "error", "message": "Ad not found"}, status_code=404)
-            
-            # Use new values if provided, otherwise use current values
-            start_date = data.get('start_date') or current[0]
-            end_date = data.get('end_date') or current[1]
-            start_time = data.get('start_time') or current[2]
-            end_time = data.get('end_time') or current[3]
-            
-            # Check for overlapping schedules (excluding the current one being edited)
-            overlap_query = """
-                SELECT id, title, start_date, end_date, start_time, end_time
-                FROM scheduled_ads
-                WHERE is_active = TRUE
-                  AND id != %s
-                  AND (
-                    -- Case 1: New schedule starts during an existing schedule
-                    (start_date <= %s AND end_date >= %s AND 
-                     (start_date < %s OR (start_date = %s AND start_time <= %s)) AND
-                     (end_date > %s OR (end_date = %s AND end_time >= %s)))
-                    OR
-                    -- Case 2: New schedule ends during an existing schedule
-                    (start_date <= %s AND end_date >= %s AND
-                     (start_date < %s OR (start_date = %s AND start_time <= %s)) AND
-                     (end_date > %s OR (end_date = %s AND end_time >= %s)))
-                    OR
-                    -- Case 3: New schedule completely contains an existing schedule
-                    (start_date >= %s AND end_date <= %s AND
-                     (start_date > %s OR (start_date = %s AND start_time >= %s)) AND
-                     (end_date < %s OR (end_date = %s AND end_time <= %s)))
-                    OR
-                    -- Case 4: Existing schedule completely contains the new schedule
-                    (start_date <= %s AND end_date >= %s AND
-                     (start_date < %s OR (start_date = %s AND start_time <= %s)) AND
-                     (end_date > %s OR (end_date = %s AND end_time >= %s)))
-                  )
-            """
-            
-            params = (
-                ad_id,  # Exclude current schedule
-                # Case 1: New schedule starts during existing
-                start_date, start_date,
-                start_date, start_date, start_time,
-                start_date, start_date, start_time,
-                # Case 2: New schedule ends during existing
-                end_date, end_date,
-                end_date, end_date, end_time,
-                end_date, end_date, end_time,
-                # Case 3: New schedule contains existing
-                start_date, end_date,
-                start_date, start_date, start_time,
-                end_date, end_date, end_time,
-                # Case 4: Existing contains new schedule
-                start_date, end_date,
-                start_date, start_date, start_time,
-                end_date, end_date, end_time,
-            )
-            
-            cur.execute(overlap_query, params)
-            overlapping = cur.fetchone()
-            
-            if overlapping:
-                cur.close()
-                conn.close()
-                overlap_title = overlapping[1]
-                overlap_dates = f"{overlapping[2]} to {overlapping[3]}"
-                return JSONResponse({
-                    "status": "error", 
-                    "message": f"A schedule already exists for this date/time range: '{overlap_title}' ({overlap_dates}). Please choose a different time period."
-                }, status_code=400)
-        
-        # No overlap found, proceed with update
-        cur.execute("""
-            UPDATE scheduled_ads SET
-                title = COALESCE(%s, title),
-                description = COALESCE(%s, description),
-                background_image = COALESCE(%s, background_image),
-                background_image_type = COALESCE(%s, background_image_type),
-                background_image_data = COALESCE(%s, background_image_data),
-                background_color = COALESCE(%s, background_color),
-                page_title = COALESCE(%s, page_title),
-                button_text = COALESCE(%s, button_text),
-                start_date = COALESCE(%s, start_date),
-                end_date = COALESCE(%s, end_date),
-                start_time = COALESCE(%s, start_time),
-                end_time = COALESCE(%s, end_time),
-                is_active = COALESCE(%s, is_active),
-                updated_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-            RETURNING id
-        """, (
-            data.get('title'),
-            data.get('description'),
-            data.get('background_image'),
-            data.get('background_image_type'),
-            data.get('background_image_data'),
-            data.get('background_color'),
-            data.get('page_title'),
-            data.get('button_text'),
-            data.get('start_date'),
-            data.get('end_date'),
-            data.get('start_time'),
-            data.get('end_time'),
-            data.get('is_active'),
-            ad_id
-        ))
-        
-        if not cur.fetchone():
-            cur.close()
-            conn.close()
+        parse_schedule_fields(data)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+    
+    try:
+        outcome, overlapping = await run_db(apply_scheduled_ad_update, ad_id, data)
+        if outcome == "not_found":
             return JSONResponse({"status": "error", "message": "Ad not found"}, status_code=404)
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        if outcome == "overlap":
+            overlap_title = overlapping[1]
+            overlap_dates = f"{overlapping[2]} to {overlapping[3]}"
+            return JSONResponse({
+                "status": "error", 
+                "message": f"A schedule already exists for this date/time range: '{overlap_title}' ({overlap_dates}). Please choose a different time period."
+            }, status_code=400)
         
         return JSONResponse({"status": "success", "message": "Scheduled ad updated"})
     
     except Exception as e:
-        if 'conn' in locals() and conn:
-            conn.rollback()
-            if 'cur' in locals() and cur:
-                cur.close()
-            conn.close()
         return JSONResponse({"status": "error", "message": f"Error updating schedule: {str(e)}"}, status_code=500)
 
 
+def delete_scheduled_ad_record(ad_id: int) -> bool:
+    with db_cursor() as cur:
+        cur.execute("DELETE FROM scheduled_ads WHERE id = %s RETURNING id", (ad_id,))
+        if cur.fetchone() is None:
+            return False
+        version = bump_cache_version(cur, "scheduled_ads")
+    ad_schedule.invalidate(version)
+    return True
+
+
 @app.delete("/api/scheduled-ads/{ad_id}")
 async def delete_scheduled_ad(request: Request, ad_id: int):
     """Delete a scheduled ad"""
     if not request.session.get("logged_in"):
         return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
     
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM scheduled_ads WHERE id = %s RETURNING id", (ad_id,))
-    
-    if not cur.fetchone():
-        cur.close()
-        conn.close()
+    if not await run_db(delete_scheduled_ad_record, ad_id):
         return JSONResponse({"status": "error", "message": "Ad not found"}, status_code=404)
     
-    conn.commit()
-    cur.close()
-    conn.close()
-    
     return JSONResponse({"status": "success", "message": "Scheduled ad deleted"})
 
-@app.get("/api/active-ad")
-async def get_active_ad_public():
-    """Public endpoint for the login page to fetch the current scheduled advertisement."""
-    ad = get_active_scheduled_ad()
+# ==== Bulk Schedule Import ====
+SCHEDULE_IMPORT_MAX_ROWS = int(os.getenv("SCHEDULE_IMPORT_MAX_ROWS", "10000"))
+
+# Columns an import row may set; anything else in the input is ignored
+SCHEDULE_IMPORT_COLUMNS = (
+    'title', 'description', 'background_image', 'background_image_type',
+    'background_image_data', 'background_color', 'page_title', 'button_text',
+    'start_date', 'end_date', 'start_time', 'end_time', 'is_active', 'created_by',
+    'recurrence_weekdays', 'recurrence_exceptions', 'rotation_weight',
+)
+
+# Free-text columns; JSON imports may send other types, which are rejected per row
+SCHEDULE_IMPORT_TEXT_COLUMNS = (
+    'description', 'background_image', 'background_image_type', 'background_image_data',
+    'background_color', 'page_title', 'button_text', 'created_by',
+)
+
+_IMPORT_BOOLEANS = {"true": True, "1": True, "yes": True, "false": False, "0": False, "no": False}
+
+def parse_schedule_import(body: bytes, content_type: str) -> list:
+    """Records of an import upload: a JSON array (or {"ads": [...]}) or CSV with a header row.
+
+    Raises ValueError with a user-facing message when the payload is unusable.
+    """
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("Import files must be UTF-8.")
+    if content_type == "application/json":
+        try:
+            records = json.loads(text)
+        except ValueError:
+            raise ValueError("Invalid JSON.")
+        if isinstance(records, dict):
+            records = records.get("ads")
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            raise ValueError('Expected a JSON array of schedules or {"ads": [...]}.')
+    elif content_type in ("text/csv", "text/plain"):
+        reader = csv.DictReader(StringIO(text))
+        if not reader.fieldnames or not {'title', 'start_date', 'end_date'} <= set(reader.fieldnames):
+            raise ValueError("CSV header must include title, start_date and end_date.")
+        # Empty cells mean "not given", as a missing JSON key does
+        records = [{k: v for k, v in row.items() if k and v not in ("", None)} for row in reader]
+    else:
+        raise ValueError("Send the schedules as application/json or text/csv.")
+    if not records:
+        raise ValueError("No schedules to import.")
+    if len(records) > SCHEDULE_IMPORT_MAX_ROWS:
+        raise ValueError(f"Import at most {SCHEDULE_IMPORT_MAX_ROWS} schedules at a time.")
+    return records
+
+def prepare_import_row(record: dict) -> Tuple[Optional[dict], List[str]]:
+    """Validate one import record and fill in the defaults insert_scheduled_ad uses.
+
+    Returns (values, errors); values are only fit to insert when errors is empty.
+    """
+    errors = []
+    values = {key: record.get(key) for key in SCHEDULE_IMPORT_COLUMNS}
+    if not isinstance(values['title'], str) or not values['title'].strip():
+        errors.append("Missing required field: title")
+    for key in SCHEDULE_IMPORT_TEXT_COLUMNS:
+        if values[key] is not None and not isinstance(values[key], str):
+            errors.append(f"Invalid {key}: {values[key]!r} (expected text)")
+            values[key] = None
+    for key in ('start_date', 'end_date'):
+        try:
+            values[key] = date.fromisoformat(str(values[key]))
+        except ValueError:
+            errors.append(f"Missing required field: {key}" if values[key] is None else f"Invalid {key}: {values[key]}")
+    for key, default in (('start_time', time(0, 0)), ('end_time', time(23, 59, 59))):
+        if values[key] is None:
+            values[key] = default
+            continue
+        try:
+            values[key] = time.fromisoformat(str(values[key]))
+        except ValueError:
+            errors.append(f"Invalid {key}: {values[key]}")
+    active = values['is_active']
+    if active is None:
+        values['is_active'] = True
+    elif isinstance(active, str) and active.strip().lower() in _IMPORT_BOOLEANS:
+        values['is_active'] = _IMPORT_BOOLEANS[active.strip().lower()]
+    elif not isinstance(active, bool):
+        errors.append(f"Invalid is_active: {active}")
+    for key, parse in (
+        ('recurrence_weekdays', parse_weekdays),
+        ('recurrence_exceptions', parse_exception_dates),
+        ('rotation_weight', parse_rotation_weight),
+    ):
+        try:
+            values[key] = parse(values[key])
+        except ValueError as e:
+            errors.append(str(e))
+    if not errors and values['end_date'] < values['start_date']:
+        errors.append("end_date is before start_date")
+    if errors:
+        return values, errors
+    values['background_image_type'] = values['background_image_type'] or 'url'
+    values['background_image_data'] = values['background_image_data'] or ''
+    values['background_color'] = values['background_color'] or '#667eea'
+    values['created_by'] = values['created_by'] or 'admin'
+    values['recurrence_weekdays'] = values['recurrence_weekdays'] or None
+    values['rotation_weight'] = values['rotation_weight'] or None
+    return values, []
+
+def schedule_overlaps(periods) -> List[Tuple]:
+    """Every overlapping pair among half-open (start, end, key) periods, by sweep line.
+
+    Periods are visited by start while a heap holds the live ones by end, so
+    each period meets exactly those it overlaps: O(n log n + pairs).
+    """
+    pairs = []
+    live: list = []
+    for order, (start, end, key) in enumerate(sorted(periods, key=lambda p: p[0])):
+        while live and live[0][0] <= start:
+            heapq.heappop(live)
+        pairs.extend((other, key) for _, _, other in live)
+        heapq.heappush(live, (end, order, key))
+    return pairs
+
+def import_scheduled_ads(rows: list, dry_run: bool = False):
+    """Check prepared import rows against each other and against saved schedules, then insert them.
+
+    rows holds (values, errors) per record. Returns (ids, reports): reports
+    lists every row with errors or conflicts, and nothing is inserted
+    unless it is empty. Two rotating schedules do not conflict. Everything
+    runs in one transaction.
+    """
+    periods = []
+    for i, (values, errors) in enumerate(rows):
+        if not errors and values['is_active']:
+            occurrences = schedule_occurrences(
+                values['start_date'], values['end_date'], values['start_time'], values['end_time'],
+                values['recurrence_weekdays'], values['recurrence_exceptions'],
+            )
+            periods.extend((start, end, ("row", i)) for start, end in occurrences)
+    with db_cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEDULE_WRITE_LOCK_ID,))
+        existing = {}
+        shared = {("row", i) for i, (values, errors) in enumerate(rows) if not errors and values['rotation_weight']}
+        if periods:
+            first, last = min(p[0] for p in periods), max(p[1] for p in periods)
+            cur.execute("""
+                SELECT id, title, start_date, end_date, start_time, end_time, recurrence_weekdays, recurrence_exceptions,
+                       rotation_weight
+                FROM scheduled_ads
+                WHERE is_active = TRUE
+                  AND active_period && tsrange(%s, %s)
+            """, (first, last))
+            for ad_id, title, start_date, end_date, start_time, end_time, weekdays, exceptions, weight in cur.fetchall():
+                existing[ad_id] = {"id": ad_id, "title": title, "start_date": str(start_date), "end_date": str(end_date)}
+                if weight is not None:
+                    shared.add(("id", ad_id))
+                occurrences = schedule_occurrences(
+                    start_date, end_date, start_time, end_time, weekdays, exceptions,
+                    first.date() - timedelta(days=1), last.date(),
+                )
+                periods.extend((start, end, ("id", ad_id)) for start, end in occurrences)
+
+        # A recurring row can meet the same schedule on many days; report each pair once
+        conflicts: dict = {}
+        for a, b in schedule_overlaps(periods):
+            if a in shared and b in shared:
+                continue
+            for this, other in ((a, b), (b, a)):
+                if this[0] == "row" and this != other:
+                    conflicts.setdefault(this[1], {}).setdefault(
+                        other,
+                        existing[other[1]] if other[0] == "id"
+                        else {"row": other[1] + 1, "title": rows[other[1]][0]['title']}
+                    )
+        reports = [
+            {"row": i + 1, "title": values['title'], "errors": errors, "conflicts": list(conflicts.get(i, {}).values())}
+            for i, (values, errors) in enumerate(rows)
+            if errors or i in conflicts
+        ]
+        if reports or dry_run:
+            return [], reports
+
+        inserted = execute_values(cur, f"""
+            INSERT INTO scheduled_ads ({", ".join(SCHEDULE_IMPORT_COLUMNS)})
+            VALUES %s
+            RETURNING id
+        """, [tuple(values[key] for key in SCHEDULE_IMPORT_COLUMNS) for values, _ in rows], page_size=1000, fetch=True)
+        version = bump_cache_version(cur, "scheduled_ads")
+    ad_schedule.invalidate(version)
+    return [row[0] for row in inserted], []
+
+@app.post("/api/scheduled-ads/import")
+async def import_scheduled_ads_endpoint(request: Request, dry_run: bool = False):
+    """Create many scheduled ads at once from JSON or CSV, all or nothing.
+
+    Rows are validated against each other and against saved active schedules;
+    any problem is reported per row (numbered from 1) and nothing is saved.
+    With dry_run=true the rows are only checked.
+    """
+    if not request.session.get("logged_in"):
+        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
+
+    content_type = request.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+    body = await request.body()
+    try:
+        records = await run_in_threadpool(parse_schedule_import, body, content_type)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+
+    rows = await run_in_threadpool(lambda: [prepare_import_row(record) for record in records])
+    for values, errors in rows:
+        if not errors and values['background_image_data']:
+            try:
+                values['background_image_data'] = await run_in_threadpool(normalize_media_ref, values['background_image_data'])
+            except MediaError as e:
+                errors.append(str(e))
+
+    try:
+        ids, reports = await run_db(import_scheduled_ads, rows, dry_run)
+    except psycopg2.errors.ExclusionViolation:
+        return JSONResponse({
+            "status": "error",
+            "message": "Another schedule was saved during the import and now overlaps it. Nothing was imported; please retry."
+        }, status_code=409)
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": f"Error importing schedules: {str(e)}"}, status_code=500)
+
+    if reports:
+        return JSONResponse({
+            "status": "error",
+            "message": f"{len(reports)} of {len(rows)} schedules have problems. Nothing was imported.",
+            "rows": reports,
+        }, status_code=400)
+    if dry_run:
+        return JSONResponse({"status": "success", "message": f"All {len(rows)} schedules can be imported.", "ids": []})
+    return JSONResponse({"status": "success", "message": f"Imported {len(ids)} scheduled ads", "ids": ids})
+
+# ==== Ad Performance API ====
+# Read from ad_event_hourly only; counts still buffered in a worker (up to
+# AD_EVENTS_FLUSH_SECONDS old) show up after its next flush.
+AD_PERFORMANCE_DEFAULT_DAYS = 7
+AD_PERFORMANCE_MAX_DAYS = 366
+
+def performance_since(days: int) -> datetime:
+    """Start of the hour `days` days ago."""
+    return (datetime.now() - timedelta(days=days)).replace(minute=0, second=0, microsecond=0)
+
+def click_through_rate(impressions: int, clicks: int) -> Optional[float]:
+    return round(clicks / impressions, 4) if impressions else None
+
+def fetch_ad_performance(since: datetime) -> dict:
+    """{ad_id: (impressions, clicks)} summed over the rollup hours from since."""
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT ad_id, SUM(impressions), SUM(clicks)
+            FROM ad_event_hourly
+            WHERE hour >= %s
+            GROUP BY ad_id
+        """, (since,))
+        return {ad_id: (int(impressions), int(clicks)) for ad_id, impressions, clicks in cur.fetchall()}
+
+def fetch_ad_hourly(ad_id: int, since: datetime) -> list:
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT hour, impressions, clicks
+            FROM ad_event_hourly
+            WHERE ad_id = %s AND hour >= %s
+            ORDER BY hour
+        """, (ad_id, since))
+        return cur.fetchall()
+
+def _performance_days(days: int) -> int:
+    return min(max(days, 1), AD_PERFORMANCE_MAX_DAYS)
+
+@app.get("/api/ad-performance")
+async def get_ad_performance(request: Request, days: int = AD_PERFORMANCE_DEFAULT_DAYS):
+    """Impressions, clicks and click-through rate per ad over the last `days` days."""
+    if not request.session.get("logged_in"):
+        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
+    since = performance_since(_performance_days(days))
+    totals = await run_db(fetch_ad_performance, since)
+    ads = [
+        {"ad_id": ad_id, "impressions": impressions, "clicks": clicks, "ctr": click_through_rate(impressions, clicks)}
+        for ad_id, (impressions, clicks) in sorted(totals.items(), key=lambda item: -item[1][0])
+    ]
+    return JSONResponse({"status": "success", "since": since.isoformat(), "ads": ads})
+
+@app.get("/api/scheduled-ads/{ad_id}/performance")
+async def get_scheduled_ad_performance(request: Request, ad_id: int, days: int = AD_PERFORMANCE_DEFAULT_DAYS):
+    """Hourly impressions and clicks of one ad over the last `days` days, with totals."""
+    if not request.session.get("logged_in"):
+        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
+    since = performance_since(_performance_days(days))
+    hourly = await run_db(fetch_ad_hourly, ad_id, since)
+    impressions = sum(row[1] for row in hourly)
+    clicks = sum(row[2] for row in hourly)
+    return JSONResponse({
+        "status": "success",
+        "ad_id": ad_id,
+        "since": since.isoformat(),
+        "impressions": impressions,
+        "clicks": clicks,
+        "ctr": click_through_rate(impressions, clicks),
+        "hourly": [
+            {"hour": hour.isoformat(), "impressions": hour_impressions, "clicks": hour_clicks}
+            for hour, hour_impressions, hour_clicks in hourly
+        ],
+    })
+
+def active_ad_payload(ad) -> Optional[dict]:
+    """The public view of a scheduled ad, or None when there is nothing to display."""
     if not ad:
-        return JSONResponse({"status": "success", "ad": None})
+        return None
     
     image_src = build_ad_image_src(
         ad.get('background_image'),
@@ -3237,7 +4573,7 @@ async def get_active_ad_public():
     
     if not image_src:
         # Without an image there's nothing to display as an advertisement, so return None.
-        return JSONResponse({"status": "success", "ad": None})
+        return None
     
     payload = {
         "id": ad.get('id'),
@@ -3249,94 +4585,334 @@ async def get_active_ad_public():
         "end_time": serialize_time_value(ad.get('end_time')),
         "image": image_src
     }
-    return JSONResponse({"status": "success", "ad": payload})
+    media_id = media_id_from_src(image_src)
+    if media_id:
+        payload["srcset"] = media_srcset(media_id, "webp")
+        payload["srcset_jpeg"] = media_srcset(media_id, "jpg")
+        payload["sizes"] = AD_THUMB_IMAGE_SIZES
+    return payload
+
+@app.get("/api/active-ad")
+async def get_active_ad_public(request: Request):
+    """Public endpoint for the login page to fetch the current scheduled advertisement."""
+    async def render(seed):
+        ad = await load_active_ad(seed)
+        return JSONResponse({"status": "success", "ad": active_ad_payload(ad)}).body, schedule_expiry()
+
+    return await rotated_render(request, active_ad_response_cache, active_ad_key, render, "application/json")
+
+@app.get("/api/bootstrap")
+async def get_bootstrap(request: Request):
+    """Everything the static login page needs (settings, OAuth availability, active ad) in one response."""
+    async def render(seed):
+        settings = await load_safe_settings()
+        ad = await load_active_ad(seed)
+        expires_at = schedule_expiry([settings.get('background_image_data')])
+        payload = {"settings": public_settings_payload(settings), "ad": active_ad_payload(ad)}
+        return JSONResponse(payload).body, expires_at
+
+    # Depends on exactly what the rendered /login page does, so it shares that key
+    return await rotated_render(request, bootstrap_response_cache, login_page_key, render, "application/json")
+
+# ==== Media Files ====
+@app.get("/media/{name}")
+async def get_media(request: Request, name: str):
+    """Serve a stored image or one of its derivatives (<id>-<width>.webp|jpg).
+
+    Names are derived from content hashes, so responses never change.
+    """
+    if not _MEDIA_NAME_RE.match(name) or not os.path.exists(media_path(name)):
+        return JSONResponse({"status": "error", "message": "Not found"}, status_code=404)
+    etag = f'"{name}"'
+    headers = {"Cache-Control": MEDIA_CACHE_CONTROL, "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    content_type = await run_in_threadpool(media_content_type, name)
+    return FileResponse(media_path(name), media_type=content_type, headers=headers)
+
+@app.post("/api/media")
+async def upload_media(request: Request):
+    """Streaming image upload (multipart/form-data, field ``file``); returns the media ID."""
+    if not request.session.get("logged_in"):
+        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        return JSONResponse({"status": "error", "message": "Expected a multipart/form-data upload."}, status_code=400)
+    # Reject obviously oversized bodies before reading them (allowing for multipart framing)
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MEDIA_MAX_BYTES + 64 * 1024:
+        return JSONResponse({"status": "error", "message": _too_large_message()}, status_code=413)
+
+    upload = MediaUpload(options[b"boundary"])
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await run_in_threadpool(upload.write, chunk)
+        media_id = await run_in_threadpool(upload.finish)
+    except MediaTooLarge as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=413)
+    except MediaError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+    finally:
+        await run_in_threadpool(upload.abort)
+    return JSONResponse({"status": "success", "id": media_id, "url": media_url(media_id)})
+
+# ==== Rendered Response Cache ====
+class RenderedPageCache:
+    """Final response bodies (CachedBody), keyed by everything they depend on.
+
+    Each entry carries an absolute expiry (the next schedule boundary), so a
+    hit costs one dict lookup and a clock read. Beyond max_entries the least
+    recently used entry is dropped. Requests use it from the event loop, but
+    cache_listener calls clear() from its own thread, so the dict is guarded
+    by a lock.
+    """
+
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: dict = {}   # key -> CachedBody
+        self._counters = {"hits": 0, "misses": 0, "stores": 0}
+
+    def get(self, key) -> Optional[CachedBody]:
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                if cached.expires_at is None or datetime.now() < cached.expires_at:
+                    self._counters["hits"] += 1
+                    self._entries[key] = self._entries.pop(key)
+                    return cached
+                self._entries.pop(key, None)
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key, cached: CachedBody):
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = cached
+            self._counters["stores"] += 1
+
+    def clear(self, version: Optional[int] = None):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), **self._counters}
+
+async def cached_render(
+    request: Request, cache: RenderedPageCache, key_fn, render, media_type: str, private: bool = False
+) -> Response:
+    """Serve render() through cache under key_fn(), with ETag/304 handling and precompression.
+
+    render is an async callable returning (body bytes, expires_at). Nothing is
+    stored unless key_fn() is unchanged after rendering; responses built while
+    the caches are stale (key None) go out uncompressed with max-age=0.
+    """
+    key = key_fn()
+    cached = cache.get(key) if key is not None else None
+    if cached is None:
+        body, expires_at = await render()
+        if key is None:
+            cached = CachedBody(body, datetime.now(), precompress=False)
+        else:
+            cached = await CachedBody.build(body, expires_at)
+            if key == key_fn():
+                cache.put(key, cached)
+    return cached_body_response(request, cached, media_type, private)
+
+# ==== Ad Rotation ====
+# Each device keeps a random seed for the browser session; rotation_pick() maps
+# it to one of the live ads, so a guest sees the same ad until the live set changes.
+ROTATION_COOKIE = "ad_rotation"
+_ROTATION_SEED_RE = re.compile(r"[0-9a-f]{16}")
+
+def rotation_seed(request: Request) -> Tuple[str, bool]:
+    """(seed, is_new): the device's seed from its cookie, or a fresh one."""
+    seed = request.cookies.get(ROTATION_COOKIE, "")
+    if _ROTATION_SEED_RE.fullmatch(seed):
+        return seed, False
+    return secrets.token_hex(8), True
+
+def rotation_choice(schedule: Optional[dict], seed: Optional[str]):
+    """Id of the ad rotation_pick() gives seed, for cache keys."""
+    row = rotation_pick(schedule, seed) if schedule else None
+    return row[0] if row else None
+
+async def capture_ad_id(request: Request) -> Optional[int]:
+    """Id of the ad this device is being shown, to attribute a capture to (None if no ad is live).
+
+    Read from the in-process schedule snapshot. Only when that is stale is it
+    reloaded, and a failure there never holds up the capture.
+    """
+    seed, is_new = rotation_seed(request)
+    schedule = ad_schedule.current()
+    if schedule is None:
+        try:
+            schedule = await run_db_or_fallback(lambda: None, ad_schedule.get)
+        except Exception as e:
+            print(f"Error resolving the active ad for a capture: {e}")
+    return rotation_choice(schedule, None if is_new else seed)
+
+async def oauth_capture_ad_id(request: Request) -> Optional[int]:
+    """The ad noted when the OAuth login started, or the current one if the session lost it."""
+    if "capture_ad_id" in request.session:
+        return request.session.pop("capture_ad_id")
+    return await capture_ad_id(request)
+
+async def rotated_render(request: Request, cache: RenderedPageCache, key_fn, render, media_type: str) -> Response:
+    """cached_render() for responses that show this device's pick of the live ads.
+
+    key_fn and render take the device's seed. Entries are shared by every
+    device with the same pick, so the cache holds one per live ad. While ads
+    rotate (or the schedule is stale) the response is private and a new
+    device gets its seed cookie.
+    """
+    seed, is_new = rotation_seed(request)
+    schedule = ad_schedule.current()
+    private = schedule is None or len(schedule["rows"]) > 1
+    response = await cached_render(
+        request, cache, functools.partial(key_fn, seed), functools.partial(render, seed), media_type, private
+    )
+    if private and is_new:
+        response.set_cookie(ROTATION_COOKIE, seed, httponly=True, samesite="lax")
+    return response
+
+# Bounded by the number of ads live at once, plus variants left over from the previous live set
+LOGIN_PAGE_CACHE_VARIANTS = int(os.getenv("LOGIN_PAGE_CACHE_VARIANTS", "16"))
+
+login_page_cache = RenderedPageCache(max_entries=LOGIN_PAGE_CACHE_VARIANTS)
+settings_response_cache = RenderedPageCache(max_entries=4)
+active_ad_response_cache = RenderedPageCache(max_entries=LOGIN_PAGE_CACHE_VARIANTS)
+bootstrap_response_cache = RenderedPageCache(max_entries=LOGIN_PAGE_CACHE_VARIANTS)
+cache_listener.subscribe("page_settings", login_page_cache.clear)
+cache_listener.subscribe("scheduled_ads", login_page_cache.clear)
+cache_listener.subscribe("page_settings", settings_response_cache.clear)
+cache_listener.subscribe("scheduled_ads", active_ad_response_cache.clear)
+cache_listener.subscribe("page_settings", bootstrap_response_cache.clear)
+cache_listener.subscribe("scheduled_ads", bootstrap_response_cache.clear)
+
+# Pages rendered before an image's resized variants exist are re-rendered soon after
+LOGIN_PAGE_PENDING_MEDIA_TTL = timedelta(seconds=5)
+
+def login_page_key(seed: Optional[str] = None):
+    """Cache key for the rendered /login page, or None while settings or ads are stale."""
+    schedule = ad_schedule.current()
+    if schedule is None or not settings_cache.is_fresh():
+        return None
+    return (settings_cache.version, ad_schedule.version, schedule["ids"], rotation_choice(schedule, seed),
+            GOOGLE_OAUTH_ENABLED, FACEBOOK_OAUTH_ENABLED)
+
+def settings_response_key():
+    """Cache key for GET /api/settings, or None while settings are stale."""
+    if not settings_cache.is_fresh():
+        return None
+    return (settings_cache.version, GOOGLE_OAUTH_ENABLED, FACEBOOK_OAUTH_ENABLED)
+
+def active_ad_key(seed: Optional[str] = None):
+    """Cache key for GET /api/active-ad, or None while the schedule is stale."""
+    schedule = ad_schedule.current()
+    if schedule is None:
+        return None
+    return (ad_schedule.version, schedule["ids"], rotation_choice(schedule, seed))
+
+def schedule_expiry(media_ids=()) -> Optional[datetime]:
+    """When a response built from the current schedule stops being valid: the next schedule
+    boundary, or sooner while resized variants of its images are still being generated."""
+    schedule = ad_schedule.current()
+    expires_at = schedule["valid_until"] if schedule else None
+    media_ids = list(media_ids) + [row[5] for row in (schedule["rows"] if schedule else [])]
+    if Image is not None and any(is_media_id(m) and m not in _derivative_widths for m in media_ids):
+        soon = datetime.now() + LOGIN_PAGE_PENDING_MEDIA_TTL
+        expires_at = soon if expires_at is None else min(expires_at, soon)
+    return expires_at
+
+def login_page_expiry(settings: dict) -> Optional[datetime]:
+    """When a freshly rendered /login stops being valid: the next schedule boundary."""
+    return schedule_expiry([settings.get('background_image_data')])
 
 # ==== Dynamic Login Page ====
 def get_safe_settings():
     """Get page settings with proper error handling"""
-    default_settings = {
-        'background_image': 'url(../img/nuanu.png)',
-        'background_image_type': 'url',
-        'background_image_data': '',
-        'background_color': '#667eea',
-        'page_title': 'Welcome To NUANU Free WiFi',
-        'button_text': 'Connect to WiFi',
-        'google_login_enabled': 'false',
-        'facebook_login_enabled': 'false'
-    }
-    
+    default_settings = _default_page_settings()
     try:
         settings = get_page_settings()
         # Ensure all required settings exist
         for key in default_settings:
             if key not in settings:
                 settings[key] = default_settings[key]
+        _last_good['settings'] = dict(settings)
         return settings
     except Exception as e:
         print(f"Error getting page settings: {e}")
-        return default_settings
-
-def get_safe_ad_content():
-    """Generate ad section HTML for all active scheduled ads with safe fallbacks."""
-    try:
-        conn = None
-        cur = None
-        rows = []
+        return get_last_good_settings()
 
-        try:
-            conn = get_connection()
-            cur = conn.cursor()
+def get_last_good_settings():
+    """Settings from the last successful read, or the defaults if there was none."""
+    if 'settings' in _last_good:
+        return dict(_last_good['settings'])
+    return _default_page_settings()
 
-            now = datetime.now()
-            current_date = now.date()
-            current_time = now.time()
+def _default_page_settings():
+    return {
+        'background_image': 'url(../img/nuanu.png)',
+        'background_image_type': 'url',
+        'background_image_data': '',
+        'background_color': '#667eea',
+        'page_title': 'Welcome To NUANU Free WiFi',
+        'button_text': 'Connect to WiFi',
+        'google_login_enabled': 'false',
+        'facebook_login_enabled': 'false'
+    }
 
-            query = """
-                SELECT id, title, description, background_image, background_image_type,
-                       background_image_data, background_color, page_title, button_text,
-                       start_date, end_date, start_time, end_time, is_active, created_by
-                FROM scheduled_ads
-                WHERE is_active = TRUE
-                  AND start_date <= %s
-                  AND end_date >= %s
-                  AND (
-                    (start_date < %s AND end_date > %s) OR
-                    (start_date = %s AND start_time <= %s AND end_date > %s) OR
-                    (start_date < %s AND end_date = %s AND end_time >= %s) OR
-                    (start_date = %s AND end_date = %s AND start_time <= %s AND end_time >= %s)
-                  )
-                ORDER BY start_date DESC, start_time DESC
-            """
+async def load_safe_settings() -> dict:
+    """get_safe_settings() without leaving the event loop while settings_cache is fresh."""
+    if settings_cache.is_fresh():
+        return get_safe_settings()
+    return await run_db_or_fallback(get_last_good_settings, get_safe_settings)
+
+async def load_active_ad(seed: Optional[str] = None):
+    """get_active_scheduled_ad() without leaving the event loop while ad_schedule is fresh."""
+    if ad_schedule.is_fresh():
+        return get_active_scheduled_ad(seed)
+    return await run_db_or_fallback(get_last_good_active_ad, get_active_scheduled_ad, seed)
+
+async def load_safe_ad_content(seed: Optional[str] = None) -> str:
+    """get_safe_ad_content() without leaving the event loop while ad_schedule is fresh."""
+    if ad_schedule.is_fresh():
+        return get_safe_ad_content(seed)
+    return await run_db_or_fallback(get_last_good_ad_content, get_safe_ad_content, seed)
+
+# Shown when no scheduled ad is active right now
+_EMPTY_AD_CONTENT = """
+<div class="card ad-card">
+  <div class="ad-image-wrapper">
+    <img src="/img/nuanu.png" alt="NUANU WiFi">
+    <div class="ad-label">Welcome</div>
+  </div>
+  <div class="ad-content">
+    <h2>Welcome to NUANU WiFi</h2>
+    <p class="ad-description">Please connect to our WiFi network</p>
+  </div>
+</div>
+"""
 
-            params = (
-                current_date, current_date,
-                current_date, current_date,
-                current_date, current_time, current_date,
-                current_date, current_date, current_time,
-                current_date, current_date, current_time, current_time,
-            )
+def get_safe_ad_content(seed: Optional[str] = None):
+    """Generate ad section HTML with safe fallbacks.
 
-            cur.execute(query, params)
-            rows = cur.fetchall()
-        finally:
-            if cur:
-                cur.close()
-            if conn:
-                conn.close()
+    With a seed it shows the one live ad rotation_pick() gives that device,
+    otherwise every active scheduled ad.
+    """
+    try:
+        schedule = ad_schedule.get()
+        rows = schedule["rows"]
+        if seed is not None and rows:
+            rows = [rotation_pick(schedule, seed)]
 
         if not rows:
-            return """
-            <div class="card ad-card">
-              <div class="ad-image-wrapper">
-                <img src="/img/nuanu.png" alt="NUANU WiFi">
-                <div class="ad-label">Welcome</div>
-              </div>
-              <div class="ad-content">
-                <h2>Welcome to NUANU WiFi</h2>
-                <p class="ad-description">Please connect to our WiFi network</p>
-              </div>
-            </div>
-            """
+            _last_good['ad_content'] = _EMPTY_AD_CONTENT
+            return _EMPTY_AD_CONTENT
 
         cards_html: list[str] = []
 
@@ -3365,10 +4941,20 @@ def get_safe_ad_content():
             title = html.escape(row[1] or "Latest Promotion")
             description = html.escape(row[2] or "").replace("\n", "<br>")
 
+            image_html = f'<img src="{html.escape(ad_image_src, quote=True)}" alt="Advertisement for {title}">'
+            media_id = media_id_from_src(ad_image_src)
+            webp_srcset = media_srcset(media_id, "webp") if media_id else ""
+            if webp_srcset:
+                image_html = (
+                    f'<picture><source type="image/webp" srcset="{webp_srcset}" sizes="{AD_CARD_IMAGE_SIZES}">'
+                    f'<img src="{html.escape(ad_image_src, quote=True)}" srcset="{media_srcset(media_id, "jpg")}" '
+                    f'sizes="{AD_CARD_IMAGE_SIZES}" alt="Advertisement for {title}"></picture>'
+                )
+
             card_html = f"""
-        <div class="card ad-card">
+        <div class="card ad-card" data-ad-id="{row[0]}">
           <div class="ad-image-wrapper">
-            <img src="{html.escape(ad_image_src, quote=True)}" alt="Advertisement for {title}">
+            {image_html}
             <div class="ad-label">Featured Offer</div>
           </div>
           <div class="ad-content">
@@ -3380,11 +4966,19 @@ def get_safe_ad_content():
             """
             cards_html.append(card_html)
 
-        return "\n".join(cards_html)
+        content = "\n".join(cards_html)
+        _last_good['ad_content'] = content
+        return content
 
     except Exception as e:
         print(f"Error generating ad content: {e}")
-        return """
+        return get_last_good_ad_content()
+
+def get_last_good_ad_content():
+    """Ad section HTML from the last successful render, or a generic welcome card."""
+    if 'ad_content' in _last_good:
+        return _last_good['ad_content']
+    return """
         <div class="card ad-card">
           <div class="ad-content">
             <h2>Welcome</h2>
@@ -3409,68 +5003,15 @@ async def dynamic_login(request: Request):
             # On error, still redirect to login but could show error message
             return RedirectResponse(url="/login", status_code=303)
     
-    # Handle GET request (page load)
+    # Handle GET request (page load): steady state is a single cache lookup
+    async def render(seed):
+        settings = await load_safe_settings()
+        ad_section_html = await load_safe_ad_content(seed)
+        html = render_login_page(settings, ad_section_html)
+        return html.encode("utf-8"), login_page_expiry(settings)
+
     try:
-        # Get safe settings with defaults
-        settings = get_safe_settings()
-        
-        # Set default values with fallbacks
-        bg_image_raw = settings.get('background_image', '')
-        bg_image_type = settings.get('background_image_type', 'url')
-        bg_image_data = settings.get('background_image_data', '')
-        bg_color = settings.get('background_color', '#667eea')
-        page_title = settings.get('page_title', 'Welcome To NUANU Free WiFi')
-        button_text = settings.get('button_text', 'Connect to WiFi')
-        
-        # Get ad content safely
-        ad_section_html = get_safe_ad_content()
-        
-        # Set up OAuth buttons
-        google_toggle_enabled = settings.get('google_login_enabled', 'false') == 'true'
-        google_button_active = google_toggle_enabled and GOOGLE_OAUTH_ENABLED
-        facebook_toggle_enabled = settings.get('facebook_login_enabled', 'false') == 'true'
-        facebook_button_active = facebook_toggle_enabled and FACEBOOK_OAUTH_ENABLED
-        
-        # Determine background style safely
-        background_image_css = ""
-        try:
-            if bg_image_type == 'upload' and bg_image_data:
-                value = bg_image_data.strip()
-                if value:
-                    background_image_css = value if value.startswith('url(') else f"url({value})"
-            elif bg_image_type == 'url' and bg_image_raw:
-                value = bg_image_raw.strip()
-                if value and value.lower() != 'none':
-                    background_image_css = value if value.startswith('url(') else f"url({value})"
-            elif bg_image_raw and bg_image_raw.strip() and bg_image_raw.strip().lower() != 'none':
-                value = bg_image_raw.strip()
-                background_image_css = value if value.startswith('url(') else f"url({value})"
-        except Exception as e:
-            print(f"Error processing background image: {e}")
-            background_image_css = ""
-        
-        # Set final background style
-        if background_image_css:
-            background_style = f"background: {background_image_css} no-repeat center center fixed, linear-gradient(135deg, {bg_color}, #764ba2); background-size: cover;"
-        else:
-            background_style = f"background: linear-gradient(135deg, {bg_color}, #764ba2);"
-            
-        # Prepare the HTML response (legacy snippet; main template is defined below)
-        html = f"""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-          <meta charset="UTF-8">
-          <meta name="viewport" content="width=device-width, initial-scale=1.0">
-          <title>{page_title}</title>
-          <style>
-            body {{
-              margin: 0;
-              padding: 0;
-              font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-              {background_style}
-              min-height: 100vh;
-              """
+        return await rotated_render(request, login_page_cache, login_page_key, render, "text/html")
     except Exception as e:
         # If anything above fails, log it and return a very simple fallback page
         print(f"Error rendering /login page: {e}")
@@ -3479,6 +5020,20 @@ async def dynamic_login(request: Request):
             status_code=500,
         )
 
+def render_login_page(settings: dict, ad_section_html: str) -> str:
+    """Build the captive-portal login page from settings and the ad section HTML.
+
+    Rendered to a string rather than streamed: the bytes go into login_page_cache.
+    """
+    bg_image_raw = settings.get('background_image', '')
+    bg_image_type = settings.get('background_image_type', 'url')
+    bg_image_data = media_url(settings.get('background_image_data', ''))
+    bg_color = settings.get('background_color', '#667eea')
+    page_title = settings.get('page_title', 'Welcome To NUANU Free WiFi')
+    button_text = settings.get('button_text', 'Connect to WiFi')
+    google_toggle_enabled = settings.get('google_login_enabled', 'false') == 'true'
+    facebook_toggle_enabled = settings.get('facebook_login_enabled', 'false') == 'true'
+
     # Set up OAuth buttons based on settings
     google_button_active = google_toggle_enabled and GOOGLE_OAUTH_ENABLED
     facebook_button_active = facebook_toggle_enabled and FACEBOOK_OAUTH_ENABLED
@@ -3500,617 +5055,31 @@ async def dynamic_login(request: Request):
     
     if background_image_css:
         background_style = f"background: {background_image_css} no-repeat center center fixed, linear-gradient(135deg, {bg_color}, #764ba2); background-size: cover;"
+        # Serve resized WebP where image-set() is supported; the url() above is the fallback
+        bg_media_id = media_id_from_src(bg_image_data) if bg_image_type == 'upload' else None
+        bg_widths = get_derivative_widths(bg_media_id) if bg_media_id else []
+        if len(bg_widths) >= 2:
+            one_x, two_x = bg_widths[-2], bg_widths[-1]
+            background_style += (
+                f' background-image: image-set(url({MEDIA_URL_PREFIX}{derivative_name(bg_media_id, one_x, "webp")}) type("image/webp") 1x,'
+                f' url({MEDIA_URL_PREFIX}{derivative_name(bg_media_id, two_x, "webp")}) type("image/webp") 2x),'
+                f' linear-gradient(135deg, {bg_color}, #764ba2);'
+            )
     else:
         background_style = f"background: linear-gradient(135deg, {bg_color}, #764ba2);"
 
-    # Main HTML template for the login page
-    html = f"""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0">
-  <title>{page_title}</title>
-  <style>
-    body {{
-      margin: 0;
-      padding: 0;
-      font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-      {background_style}
-      min-height: 100;
-      display: flex;
-      justify-content: center;
-      align-items: center;
-    }}
-    .page-layout {{
-      width: min(1100px, calc(100% - 40px));
-      display: flex;
-      gap: 32px;
-      flex-wrap: wrap;
-      justify-content: center;
-      align-items: stretch;
-      margin: 48px auto;
-    }}
-    .card {{
-      border-radius: 20px;
-      box-shadow: 0 20px 40px rgba(0, 0, 0, 0.35);
-      border: 1px solid rgba(255, 255, 255, 0.18);
-      flex: 1 1 320px;
-      max-width: 480px;
-      background: rgba(255, 255, 255, 0.95);
-      backdrop-filter: blur(10px);
-    }}
-    .form-card {{
-      padding: 40px;
-      text-align: center;
-      color: #333;
-    }}
-    
-    @media (max-width: 768px) {{
-      .form-card {{
-        padding: 32px 24px;
-      }}
-      .page-layout {{
-        width: calc(100% - 32px);
-        flex-direction: column;
-        align-items: stretch;
-        gap: 24px;
-      }}
-    }}
-    
-    @media (max-width: 640px) {{
-      .card {{
-        max-width: 100%;
-      }}
-      .page-layout {{
-        margin: 24px auto;
-      }}
-    }}
-    .form-card h1 {{
-      margin-bottom: 30px;
-      font-size: 28px;
-      font-weight: 600;
-      color: #2c3e50;
-      margin-top: 0;
-    }}
-    .input-group {{
-      margin-bottom: 10px;
-      text-align: left;
-    }}
-    .input-group label {{
-      display: block;
-      margin-bottom: 8px;
-      font-weight: 500;
-      color: #555;
-      font-size: 14px;
-    }}
-    input[type="email"] {{
-      padding: 16px 20px;
-      width: 100%;
-      border: 2px solid #e1e8ed;
-      border-radius: 12px;
-      font-size: 16px;
-      transition: all 0.3s ease;
-      background: #f8f9fa;
-      color: #333;
-      box-sizing: border-box;
-    }}
-    input[type="email"]:focus {{
-      outline: none;
-      border-color: #3498db;
-      background: white;
-      box-shadow: 0 0 0 3px rgba(52, 152, 219, 0.1);
-    }}
-    .validation-message {{
-      font-size: 13px;
-      margin-top: 5px;
-      min-height: 16px;
-    }}
-    .consent {{
-      margin-top: 12px;
-      text-align: left;
-      font-size: 12px;
-      color: #555;
-      background: #f8f9ff;
-      border: 1px solid #e6e8ff;
-      border-radius: 10px;
-      padding: 12px;
-    }}
-    .consent label {{
-      display: flex;
-      align-items: flex-start;
-      gap: 10px;
-      cursor: pointer;
-      line-height: 1.4;
-    }}
-    .consent input[type="checkbox"] {{
-      margin-top: 2px;
-      width: 18px;
-      height: 18px;
-      accent-color: #667eea;
-    }}
-    .validation-message.invalid {{
-      color: #dc3545;
-    }}
-    .validation-message.valid {{
-      color: #28a745;
-    }}
-    button {{
-      margin-top: 15px;
-      background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-      color: white;
-      padding: 16px 20px;
-      border: none;
-      border-radius: 12px;
-      width: 100%;
-      cursor: pointer;
-      font-size: 16px;
-      font-weight: 600;
-      transition: all 0.3s ease;
-      box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-      box-sizing: border-box;
-    }}
-    button:hover {{
-      transform: translateY(-2px);
-      box-shadow: 0 8px 25px rgba(102, 126, 234, 0.6);
-    }}
-    button:disabled {{
-      opacity: 0.6;
-      cursor: not-allowed;
-      transform: none;
-    }}
-    .social-login {{
-      margin-top: 20px;
-      padding-top: 20px;
-      border-top: 1px solid #e1e8ed;
-    }}
-    .social-login p {{
-      color: #666;
-      font-size: 14px;
-      margin-bottom: 15px;
-    }}
-    .social-button {{
-      display: flex;
-      align-items: center;
-      justify-content: center;
-      gap: 12px;
-      padding: 14px 20px;
-      border: 2px solid #e1e8ed;
-      border-radius: 12px;
-      background: white;
-      color: #333;
-      text-decoration: none;
-      font-weight: 600;
-      transition: all 0.3s ease;
-      margin-bottom: 10px;
-      position: relative;
-    }}
-    .social-button.disabled {{
-      opacity: 0.6;
-      cursor: not-allowed;
-      pointer-events: auto;
-    }}
-    .social-button.disabled:hover {{
-      transform: none;
-      box-shadow: none;
-      background: white;
-    }}
-    .social-button .status-badge {{
-      position: absolute;
-      top: 10px;
-      right: 10px;
-      font-size: 11px;
-      font-weight: 600;
-      background: #f97316;
-      color: white;
-      padding: 2px 8px;
-      border-radius: 999px;
-      letter-spacing: 0.3px;
-    }}
-    .social-button:hover {{
-      transform: translateY(-2px);
-      box-shadow: 0 4px 12px rgba(0, 0, 0, 0.15);
-    }}
-    .social-button svg {{
-      width: 20px;
-      height: 20px;
-    }}
-    .social-button.google {{
-      border-color: #db4437;
-      color: #db4437;
-    }}
-    .social-button.google:hover {{
-      background: #db4437;
-      color: white;
-    }}
-    .social-button.google:hover svg path {{
-      fill: white;
-    }}
-    .social-button.facebook {{
-      border-color: #1877f2;
-      color: #1877f2;
-    }}
-    .social-button.facebook:hover {{
-      background: #1877f2;
-      color: white;
-    }}
-    .social-button.facebook:hover svg {{
-      fill: white;
-    }}
-    .oauth-warning {{
-      margin-top: 10px;
-      font-size: 13px;
-      color: #b45309;
-      text-align: center;
-    }}
-    .ad-card {{
-      background: rgba(6, 11, 38, 0.92);
-      color: white;
-      padding: 0;
-      border-radius: 24px;
-      border: 1px solid rgba(255, 255, 255, 0.08);
-      overflow: hidden;
-    }}
-    .ad-card + .ad-card {{
-      margin-top: 24px;
-    }}
-    .ad-image-wrapper {{
-      position: relative;
-    }}
-    .ad-image-wrapper img {{
-      width: 100%;
-      height: 320px;
-      object-fit: cover;
-      display: block;
-    }}
-    .ad-label {{
-      position: absolute;
-      top: 20px;
-      left: 20px;
-      background: rgba(0, 0, 0, 0.65);
-      color: white;
-      padding: 6px 14px;
-      border-radius: 999px;
-      font-size: 12px;
-      letter-spacing: 0.08em;
-      text-transform: uppercase;
-    }}
-    .ad-content {{
-      padding: 24px 30px 32px;
-    }}
-    .ad-content h2 {{
-      margin: 12px 0;
-      font-size: 26px;
-      color: white;
-      line-height: 1.3;
-    }}
-    .ad-description {{
-      margin: 0;
-      color: #dbeafe;
-      line-height: 1.6;
-      font-size: 15px;
-    }}
-    .ad-timeframe {{
-      margin: 0;
-      color: #fcd34d;
-      font-size: 12px;
-      letter-spacing: 0.08em;
-      text-transform: uppercase;
-    }}
-    @media (max-width: 640px) {{
-      .card {{
-        max-width: 100%;
-      }}
-      .page-layout {{
-        margin: 24px auto;
-      }}
-      .ad-image-wrapper img {{
-        height: 220px;
-      }}
-      .ad-content {{
-        padding: 20px 18px 24px;
-      }}
-      .ad-content h2 {{
-        font-size: 22px;
-      }}
-    }}
-    .message {{
-      margin-top: 20px;
-      padding: 12px 16px;
-      border-radius: 8px;
-      font-size: 14px;
-      font-weight: 500;
-      min-height: 20px;
-    }}
-  </style>
-</head>
-<body>
-  <div class="page-layout">
-    <div class="card form-card">
-      {ad_section_html}
-      <h1>{page_title}</h1>
-      <div class="input-group">
-        <label for="email">Email Address</label>
-        <input type="email" id="email" placeholder="Enter your email address" required>
-        <div id="validation-message" class="validation-message"></div>
-      </div>
-      <div class="consent">
-        <label for="consent">
-          <input type="checkbox" id="consent">
-          <span>
-            By providing your email address, you agree and consent that it may be used for marketing purposes, including but not limited to receiving promotional emails, newsletters, offers, and updates related to our products and services. You may unsubscribe at any time using the link provided in each email.
-          </span>
-        </label>
-      </div>
-      <div id="consent-validation" class="validation-message"></div>
-      <button type="button" id="login-btn" disabled>{button_text}</button>
-      <div class="message" id="message"></div>
-      
-    """
-    
-    show_social_logins = google_toggle_enabled or facebook_toggle_enabled
-    if show_social_logins:
-        html += """
-    <div class="social-login">
-      <p>Or continue with:</p>
-"""
-        if google_toggle_enabled:
-            google_href = "/auth/google/login" if google_button_active else "#"
-            google_extra_class = "" if google_button_active else " disabled"
-            google_disabled_attr = "" if google_button_active else ' data-disabled="true"'
-            google_status_badge = "" if google_button_active else '<span class="status-badge">Offline</span>'
-            html += f"""
-      <a href="{google_href}" class="social-button google{google_extra_class}"{google_disabled_attr}>
-        <svg viewBox="0 0 24 24" xmlns="http://www.w3.org/2000/svg">
-          <path d="M22.56 12.25c0-.78-.07-1.53-.2-2.25H12v4.26h5.92c-.26 1.37-1.04 2.53-2.21 3.31v2.77h3.57c2.08-1.92 3.28-4.74 3.28-8.09z" fill="#4285F4"/>
-          <path d="M12 23c2.97 0 5.46-.98 7.28-2.66l-3.57-2.77c-.98.66-2.23 1.06-3.71 1.06-2.86 0-5.29-1.93-6.16-4.53H2.18v2.84C3.99 20.53 7.7 23 12 23z" fill="#34A853"/>
-          <path d="M5.84 14.09c-.22-.66-.35-1.36-.35-2.09s.13-1.43.35-2.09V7.07H2.18C1.43 8.55 1 10.22 1 12s.43 3.45 1.18 4.93l2.85-2.22.81-.62z" fill="#FBBC05"/>
-          <path d="M12 5.38c1.62 0 3.06.56 4.21 1.64l3.15-3.15C17.45 2.09 14.97 1 12 1 7.7 1 3.99 3.47 2.18 7.07l3.66 2.84c.87-2.6 3.3-4.53 6.16-4.53z" fill="#EA4335"/>
-        </svg>
-        Continue with Google
-        {google_status_badge}
-      </a>
-"""
-        if facebook_toggle_enabled:
-            facebook_href = "/auth/facebook/login" if facebook_button_active else "#"
-            facebook_extra_class = "" if facebook_button_active else " disabled"
-            facebook_disabled_attr = "" if facebook_button_active else ' data-disabled="true"'
-            facebook_status_badge = "" if facebook_button_active else '<span class="status-badge">Offline</span>'
-            html += f"""
-      <a href="{facebook_href}" class="social-button facebook{facebook_extra_class}"{facebook_disabled_attr}>
-        <svg viewBox="0 0 24 24" xmlns="http://www.w3.org/2000/svg" fill="#1877f2">
-          <path d="M24 12.073c0-6.627-5.373-12-12-12s-12 5.373-12 12c0 5.99 4.388 10.954 10.125 11.854v-8.385H7.078v-3.47h3.047V9.43c0-3.007 1.792-4.669 4.533-4.669 1.312 0 2.686.235 2.686.235v2.953H15.83c-1.491 0-1.956.925-1.956 1.874v2.25h3.328l-.532 3.47h-2.796v8.385C19.612 23.027 24 18.062 24 12.073z"/>
-        </svg>
-        Continue with Facebook
-        {facebook_status_badge}
-      </a>
-"""
-        html += """
-    </div>
-"""
-        if google_toggle_enabled and not google_button_active:
-            html += """
-    <div class="oauth-warning">Google login is temporarily unavailable. Please contact the administrator.</div>
-"""
-        if facebook_toggle_enabled and not facebook_button_active:
-            html += """
-    <div class="oauth-warning">Facebook login is temporarily unavailable. Please contact the administrator.</div>
-"""
-    
-    html += f"""
-    </div>
-  </div>
-  
-  <script>
-    // ✅ domain HTTPS - Use production URL, or local origin for development
-    const API_BASE = window.location.origin;
-  
-    var GATEWAY_IP = "{GATEWAY_IP}";
-    var HOTSPOT_USER = "{HOTSPOT_USER}";
-    var HOTSPOT_PASS = "{HOTSPOT_PASS}";
-    var FINAL_REDIRECT = "{DST_URL}";
-  
-    var emailInput = document.getElementById("email");
-    var validationMessage = document.getElementById("validation-message");
-    var loginBtn = document.getElementById("login-btn");
-    var consentCheckbox = document.getElementById("consent");
-    var consentValidation = document.getElementById("consent-validation");
-  
-    console.log("Elements found - emailInput:", !!emailInput, "loginBtn:", !!loginBtn, "consentCheckbox:", !!consentCheckbox);
-  
-    if (!emailInput || !loginBtn || !consentCheckbox) {{
-      console.error("Required elements not found!");
-      alert("Error: Required form elements not found. Please refresh the page.");
-    }} else {{
-      console.log("Initial email value:", emailInput.value);
-      console.log("Initial consent checked:", consentCheckbox.checked);
-    
-      var emailRegex = /^[^\\s@]+@[^\\s@]+\\.[^\\s@]+$/;
-    
-      function updateButtonState() {{
-        try {{
-          if (!emailInput || !loginBtn || !consentCheckbox) {{
-            console.error("Elements missing in updateButtonState");
-            return;
-          }}
-          
-          var email = emailInput.value.trim();
-          var emailValid = emailRegex.test(email);
-          var consentChecked = consentCheckbox.checked;
-          
-          console.log("updateButtonState - Email:", email, "Valid:", emailValid, "Consent:", consentChecked);
-          
-          if (validationMessage) {{
-            if (!emailValid) {{
-              validationMessage.textContent = "That's not an email format!";
-              validationMessage.className = "validation-message invalid";
-            }} else {{
-              validationMessage.textContent = "✓ Looks good!";
-              validationMessage.className = "validation-message valid";
-            }}
-          }}
-          
-          if (consentValidation) {{
-            if (consentChecked) {{
-              consentValidation.textContent = "✓ Thanks for subscribing!";
-              consentValidation.className = "validation-message valid";
-            }} else {{
-              consentValidation.textContent = "Please check the box to agree to receive our newsletter";
-              consentValidation.className = "validation-message invalid";
-            }}
-          }}
-          
-          var shouldEnable = emailValid && consentChecked;
-          loginBtn.disabled = !shouldEnable;
-          console.log("Button state updated - shouldEnable:", shouldEnable, "disabled:", loginBtn.disabled);
-          
-          // Force enable if email and consent are valid (safety check)
-          if (emailValid && consentChecked && loginBtn.disabled) {{
-            console.warn("Button should be enabled but is disabled - forcing enable");
-            loginBtn.disabled = false;
-          }}
-        }} catch (error) {{
-          console.error("Error in updateButtonState:", error);
-          console.error(error.stack);
-        }}
-      }}
-
-      emailInput.addEventListener("input", updateButtonState);
-      consentCheckbox.addEventListener("change", updateButtonState);
-      
-      // Initialize button state on page load - try multiple times to ensure it works
-      setTimeout(updateButtonState, 100);
-      setTimeout(updateButtonState, 500);
-      
-      // Also run when DOM is fully ready
-      if (document.readyState === "loading") {{
-        document.addEventListener("DOMContentLoaded", updateButtonState);
-      }} else {{
-        updateButtonState();
-      }}
-      
-      console.log("Initial button state - disabled:", loginBtn.disabled);
-    
-      // Login function - make it globally accessible
-      async function handleLogin() {{
-        console.log("=== LOGIN FUNCTION CALLED ===");
-        try {{
-          var email = emailInput.value.trim();
-          var msg = document.getElementById("message");
-          
-          console.log("Email:", email);
-          console.log("Consent checked:", consentCheckbox.checked);
-          console.log("API_BASE:", API_BASE);
-      
-          if (!emailRegex.test(email)) {{
-            msg.textContent = "Please enter a valid email.";
-            msg.className = "message error";
-            return;
-          }}
-          if (!consentCheckbox.checked) {{
-            msg.textContent = "Please check the box to agree to receive our newsletter";
-            msg.className = "message error";
-            return;
-          }}
-      
-          msg.textContent = "Saving email...";
-          msg.className = "message";
-          console.log("Attempting to save email...");
-      
-          try {{
-            var emailObj = {{}};
-            emailObj.email = email;
-            emailObj.consent = true;
-            var apiUrl = API_BASE + "/save_trial_email";
-            console.log("Fetching:", apiUrl);
-            console.log("Payload:", JSON.stringify(emailObj));
-            
-            var response = await fetch(apiUrl, {{
-              method: "POST",
-              headers: {{"Content-Type": "application/json"}},
-              body: JSON.stringify(emailObj)
-            }});
-            console.log("Response status:", response.status);
-            if (!response.ok) {{
-              var errorText = await response.text();
-              console.error("Failed to save email:", response.status, errorText);
-            }} else {{
-              var result = await response.json();
-              console.log("Email saved successfully:", result);
-            }}
-          }} catch (error) {{
-            console.error("Error saving email:", error);
-            // Continue anyway - don't block the login
-          }}
-      
-          msg.textContent = "Connecting to WiFi...";
-          msg.className = "message success";
-      
-          var loginUrl = "http://" + GATEWAY_IP + "/login?username=" + HOTSPOT_USER +
-            "&password=" + HOTSPOT_PASS +
-            "&dst=" + encodeURIComponent(FINAL_REDIRECT);
-          console.log("Redirecting to:", loginUrl);
-      
-          setTimeout(function() {{
-            window.location.href = loginUrl;
-          }}, 1000);
-        }} catch (error) {{
-          console.error("Error in login function:", error);
-          alert("An error occurred: " + error.message + "\\nCheck console for details.");
-        }}
-      }}
-      
-      // Make it globally accessible
-      window.login = handleLogin;
-      
-      console.log("Login function registered. API_BASE:", API_BASE);
-      console.log("Login function available:", typeof window.login);
-      
-      // Attach event listener to button
-      function handleButtonClick(e) {{
-        console.log("=== BUTTON CLICKED ===");
-        console.log("Button disabled:", loginBtn.disabled);
-        console.log("Email:", emailInput.value);
-        console.log("Consent:", consentCheckbox.checked);
-        
-        // Always allow click, check validation inside
-        e.preventDefault();
-        e.stopPropagation();
-        
-        // Re-check validation
-        var email = emailInput.value.trim();
-        var emailValid = emailRegex.test(email);
-        var consentChecked = consentCheckbox.checked;
-        
-        if (!emailValid || !consentChecked) {{
-          console.warn("Validation failed - Email valid:", emailValid, "Consent:", consentChecked);
-          alert("Please enter a valid email and check the consent box.");
-          updateButtonState();
-          return;
-        }}
-        
-        console.log("Validation passed, calling handleLogin...");
-        handleLogin();
-      }}
-      
-      loginBtn.addEventListener("click", handleButtonClick);
-      loginBtn.onclick = handleButtonClick;
-      
-      // Handle disabled social buttons
-      var disabledButtons = document.querySelectorAll('.social-button[data-disabled="true"]');
-      for (var i = 0; i < disabledButtons.length; i++) {{
-        var button = disabledButtons[i];
-        button.addEventListener("click", function(event) {{
-          event.preventDefault();
-          var provider = button.classList.contains("google") ? "Google" : "Facebook";
-          alert(provider + " login is not configured yet. Please contact the administrator.");
-        }});
-      }}
-    }}
-  </script>
-  
-</body>
-</html>
-    """
-    return HTMLResponse(content=html)
+    return LOGIN_TEMPLATE.render(
+        page_title=page_title,
+        background_style=background_style,
+        ad_section_html=ad_section_html,
+        button_text=button_text,
+        google_toggle_enabled=google_toggle_enabled,
+        facebook_toggle_enabled=facebook_toggle_enabled,
+        google_button_active=google_button_active,
+        facebook_button_active=facebook_button_active,
+        gateway_ip=GATEWAY_IP,
+        hotspot_user=HOTSPOT_USER,
+        hotspot_pass=HOTSPOT_PASS,
+        final_redirect=DST_URL,
+    )
 
@@ -0,0 +1,105 @@
+"""Measure /login latency on its own and while long dashboard exports run.
+
+Every route in app.py is `async def`, so any blocking database call made on
+the event loop stalls every other request on that worker. This script checks
+that a heavy /dashboard/export does not slow down the captive portal.
+
+Usage (against a running server, ideally with a single worker):
+    python bench_login_latency.py --base-url http://127.0.0.1:8000 --password <DASHBOARD_PASSWORD>
+
+Options:
+    --duration   seconds per phase (default 15)
+    --exports    concurrent export loops during the load phase (default 2)
+    --format     export format: csv, xlsx or pdf (default csv)
+    --interval   pause between /login samples in seconds (default 0.05)
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+def summarize(label: str, samples: list):
+    if not samples:
+        print(f"{label:<22} no samples")
+        return None
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    p50 = statistics.median(ordered)
+    print(
+        f"{label:<22} n={len(ordered):<5} p50={p50:7.1f}ms  p95={pct(95):7.1f}ms  "
+        f"p99={pct(99):7.1f}ms  max={ordered[-1]:7.1f}ms"
+    )
+    return p50, pct(95)
+
+
+async def sample_login(client: httpx.AsyncClient, duration: float, interval: float) -> list:
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        resp = await client.get("/login")
+        resp.raise_for_status()
+        latencies.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def export_loop(client: httpx.AsyncClient, fmt: str, stop: asyncio.Event, durations: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        resp = await client.get("/dashboard/export", params={"format": fmt})
+        resp.raise_for_status()
+        durations.append((time.perf_counter() - started) * 1000)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--password", required=True, help="dashboard password (for /dashboard/export)")
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--exports", type=int, default=2)
+    parser.add_argument("--format", default="csv", choices=["csv", "xlsx", "pdf"])
+    parser.add_argument("--interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    timeout = httpx.Timeout(300.0)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=timeout) as guest, \
+            httpx.AsyncClient(base_url=args.base_url, timeout=timeout) as admin:
+        resp = await admin.post("/dashboard", data={"password": args.password})
+        if resp.status_code != 200:
+            raise SystemExit(f"Dashboard login failed with HTTP {resp.status_code}")
+
+        # Warm up connections and caches before measuring
+        await sample_login(guest, 1.0, args.interval)
+
+        print(f"Phase 1: /login only ({args.duration:g}s)")
+        idle = await sample_login(guest, args.duration, args.interval)
+
+        print(f"Phase 2: /login with {args.exports} concurrent {args.format} export loop(s) ({args.duration:g}s)")
+        stop = asyncio.Event()
+        export_durations: list = []
+        exporters = [
+            asyncio.create_task(export_loop(admin, args.format, stop, export_durations))
+            for _ in range(args.exports)
+        ]
+        await asyncio.sleep(0.5)  # let the first exports reach the database
+        loaded = await sample_login(guest, args.duration, args.interval)
+        stop.set()
+        await asyncio.gather(*exporters)
+
+    print()
+    base = summarize("/login idle", idle)
+    under = summarize("/login during export", loaded)
+    summarize("/dashboard/export", export_durations)
+    if base and under:
+        print(f"\np50 ratio (loaded / idle): {under[0] / base[0]:.2f}x   p95 ratio: {under[1] / base[1]:.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,172 @@
+"""Compare page render cost of the Jinja2 templates against the old f-string pages.
+
+The previous implementation of /login, /dashboard, /admin and /admin/scheduler
+built each page with f-strings and `html +=` concatenation. This script loads
+that version of app.py from git (the parent of the commit that added
+templates/) and the commit that added templates/, with its own templates, so
+both sides render the same page content; pages grew later (the dashboard got
+cards, a chart and a keyset pager), which would make a comparison against the
+working tree meaningless. Both implementations get the same in-memory data
+and the script reports, per page, the mean render time and the peak memory
+traced by tracemalloc while one page is produced. No database connection is
+made.
+
+Usage (from the repository root, with the app's environment loaded):
+    python bench_render.py
+
+Options:
+    --iterations   renders per page and implementation (default 300)
+    --rows         dashboard rows on the page (default 20)
+    --ads          scheduled ads listed on the scheduler page (default 50)
+    --legacy-rev   git revision holding the f-string app.py (default: before templates/)
+    --template-rev git revision holding the template app.py (default: the commit adding templates/)
+"""
+import argparse
+import asyncio
+import io
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+import types
+from datetime import date, datetime, time as dtime, timedelta
+
+from fastapi.responses import StreamingResponse
+
+
+class FakeRequest:
+    session = {"logged_in": True}
+
+
+def templates_revision() -> str:
+    first = subprocess.run(
+        ["git", "rev-list", "HEAD", "--", "templates"], capture_output=True, text=True, check=True
+    ).stdout.split()
+    if not first:
+        raise SystemExit("templates/ is not in git history; pass --legacy-rev and --template-rev")
+    return first[-1]
+
+
+def load_revision(rev: str, name: str, template_dir: str = None):
+    source = subprocess.run(["git", "show", f"{rev}:app.py"], capture_output=True, text=True, check=True).stdout
+    if template_dir:
+        # Point the module at the templates of the same revision instead of the working tree
+        assert source.count('TEMPLATE_DIR = "templates"') == 1, f"{rev}:app.py has no TEMPLATE_DIR"
+        source = source.replace('TEMPLATE_DIR = "templates"', f"TEMPLATE_DIR = {template_dir!r}")
+    module = types.ModuleType(name)
+    module.__file__ = f"{name}.py"
+    sys.modules[name] = module
+    exec(compile(source, f"{name}.py", "exec"), module.__dict__)
+    return module
+
+
+def extract_templates(rev: str, target: str) -> str:
+    archive = subprocess.run(["git", "archive", rev, "templates"], capture_output=True, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(target)
+    return f"{target}/templates"
+
+
+def fixtures(module, rows: int, ads: int) -> dict:
+    today = date.today()
+    settings = module._default_page_settings()
+    settings.update(google_login_enabled="true", facebook_login_enabled="true")
+    emails = [(f"guest{i}@example.com", datetime.now() - timedelta(minutes=i)) for i in range(rows)]
+    scheduled = [
+        {
+            "id": i + 1,
+            "title": f"Campaign {i + 1}",
+            "start_date": today + timedelta(days=i - ads // 2),
+            "end_date": today + timedelta(days=i - ads // 2 + 3),
+            "start_time": dtime(0, 0),
+            "end_time": dtime(23, 59, 59),
+            "is_active": True,
+        }
+        for i in range(ads)
+    ]
+    return {
+        "get_page_settings": settings,
+        "fetch_email_page": (rows * 50, emails),
+        "get_all_scheduled_ads": scheduled,
+        "get_active_scheduled_ad": scheduled[ads // 2] if scheduled else None,
+    }
+
+
+def install_fakes(module, data: dict):
+    async def run_db(fn, *args, **kwargs):
+        return data[fn.__name__]
+
+    module.run_db = run_db
+
+
+async def body_of(response) -> bytes:
+    if isinstance(response, StreamingResponse):
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return response.body
+
+
+def page_renderers(module, data: dict, ad_html: str) -> dict:
+    request = FakeRequest()
+
+    async def login():
+        return module.render_login_page(data["get_page_settings"], ad_html).encode("utf-8")
+
+    async def dashboard():
+        return await body_of(await module.show_dashboard(page=3, date_filter="last30"))
+
+    async def admin():
+        return await body_of(await module.admin_panel(request))
+
+    async def scheduler():
+        return await body_of(await module.scheduler_page(request))
+
+    return {"/login": login, "/dashboard": dashboard, "/admin": admin, "/admin/scheduler": scheduler}
+
+
+async def measure(render, iterations: int):
+    html = await render()  # warm up
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await render()
+    mean_ms = (time.perf_counter() - started) * 1000 / iterations
+
+    tracemalloc.start()
+    await render()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return mean_ms, peak, len(html)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--ads", type=int, default=50)
+    parser.add_argument("--legacy-rev", default=None)
+    parser.add_argument("--template-rev", default=None)
+    args = parser.parse_args()
+
+    template_rev = args.template_rev or templates_revision()
+    legacy = load_revision(args.legacy_rev or f"{template_rev}^", "legacy_app")
+    with tempfile.TemporaryDirectory() as tmp:
+        current = load_revision(template_rev, "template_app", extract_templates(template_rev, tmp))
+    data = fixtures(current, args.rows, args.ads)
+    ad_html = current.get_last_good_ad_content()
+    for module in (legacy, current):
+        install_fakes(module, data)
+
+    old_pages = page_renderers(legacy, data, ad_html)
+    new_pages = page_renderers(current, data, ad_html)
+    print(f"{'page':<18} {'impl':<9} {'mean':>9} {'peak alloc':>11} {'bytes':>8}")
+    for page in old_pages:
+        old = await measure(old_pages[page], args.iterations)
+        new = await measure(new_pages[page], args.iterations)
+        for label, (mean_ms, peak, size) in (("f-string", old), ("template", new)):
+            print(f"{page:<18} {label:<9} {mean_ms:7.3f}ms {peak / 1024:9.1f}KiB {size:8d}")
+        print(f"{'':<18} {'ratio':<9} {new[0] / old[0]:8.2f}x {new[1] / old[1]:10.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
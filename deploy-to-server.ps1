@@ -75,6 +75,7 @@ $filesToUpload = @(
     "requirements.txt",
     "gunicorn_config.py",
     "monitor.py",
+    "manage.py",
     "deploy-zero-downtime.sh",
     "deploy.sh",
     "login.html"
@@ -82,7 +83,8 @@ $filesToUpload = @(
 
 # Directories to upload
 $dirsToUpload = @(
-    "img"
+    "img",
+    "templates"
 )
 
 # Files to exclude
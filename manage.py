@@ -0,0 +1,248 @@
+"""Maintenance commands for the WiFi portal, run against the configured database.
+
+Usage:
+    python manage.py check-schedule-index [--schedules 200] [--probes 5000] [--rounds 20] [--seed N]
+    python manage.py verify-schedule-index [--schedules 200] [--probes 2000] [--seed N]
+    python manage.py backfill-rollups [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+
+Commands:
+    check-schedule-index    needs the app's environment but no reachable
+                            database: build ScheduleIndex from
+                            random one-off, recurring and rotating schedules
+                            and compare it, at random instants and at every
+                            boundary, with a brute-force evaluation of the
+                            rules in ACTIVE_ADS_QUERY. Each round also walks a
+                            rolling index (since set, short horizon) forward
+                            in time the way AdScheduleCache uses it.
+    verify-schedule-index   fill a temporary copy of scheduled_ads with random
+                            one-off and recurring schedules and check that
+                            ScheduleIndex returns the same live ads as
+                            ACTIVE_ADS_QUERY at random instants and at every
+                            boundary. Nothing is written: the copy is a TEMP
+                            table that shadows the real one and the
+                            transaction is rolled back.
+    backfill-rollups        recompute the daily signup rollups behind the
+                            dashboard (trial_email_daily and
+                            trial_email_daily_domain) from trial_emails,
+                            for every day or only the given range. Captures
+                            keep flowing; they wait for the rebuild to commit.
+"""
+import argparse
+import random
+import sys
+from datetime import date, datetime, time, timedelta
+
+import app
+
+
+def _random_time(rng: random.Random):
+    if rng.random() < 0.05:
+        return None
+    return time(rng.randrange(24), rng.randrange(60), rng.randrange(60))
+
+
+def _random_schedule(rng: random.Random, today):
+    start_date = today + timedelta(days=rng.randint(-20, 20))
+    end_date = start_date + timedelta(days=rng.choice([0, 0, 0, 1, 2, 5, 14]))
+    weekdays, exceptions = None, []
+    if rng.random() < 0.3:
+        weekdays = rng.randrange(1, 128)
+        exceptions = [start_date + timedelta(days=rng.randrange(15)) for _ in range(rng.randrange(3))]
+    return (
+        f"Schedule {rng.randrange(10**6)}", start_date, end_date,
+        _random_time(rng), _random_time(rng), rng.random() < 0.85,
+        weekdays, exceptions,
+    )
+
+
+def _order_key(row):
+    return (row[9], row[11])
+
+
+def _index_row(ad_id: int, schedule, weight):
+    title, start_date, end_date, start_time, end_time, _, weekdays, exceptions = schedule
+    return (
+        ad_id, title, None, None, None, None, None, None, None,
+        start_date, end_date, start_time, end_time, True, None,
+        weekdays, exceptions, weight,
+    )
+
+
+def _live_at(row, when: datetime) -> bool:
+    """ACTIVE_ADS_QUERY's test for one row, evaluated directly from its SQL definitions."""
+    start_date, end_date, start_time, end_time, weekdays, exceptions = row[9], row[10], row[11], row[12], row[15], row[16]
+    if weekdays is None:
+        # scheduled_ad_period()
+        start = datetime.combine(start_date + timedelta(days=1), time.min) if start_time is None else datetime.combine(start_date, start_time)
+        end = datetime.combine(end_date, time.min) if end_time is None else datetime.combine(end_date, end_time) + timedelta(microseconds=1)
+        return start <= when < end
+    # active_period envelope, then scheduled_ad_occurs_at()
+    if not datetime.combine(start_date, time.min) <= when < datetime.combine(end_date + timedelta(days=2), time.min):
+        return False
+    daily_start = start_time if start_time is not None else time(0, 0)
+    daily_end = end_time if end_time is not None else time(23, 59, 59)
+    for day in (when.date(), when.date() - timedelta(days=1)):
+        if not (start_date <= day <= end_date and weekdays >> day.weekday() & 1 and day not in exceptions):
+            continue
+        end = datetime.combine(day, daily_end) + timedelta(microseconds=1)
+        if daily_end < daily_start:
+            end += timedelta(days=1)
+        if datetime.combine(day, daily_start) <= when < end:
+            return True
+    return False
+
+
+def _same_live_set(rows, got, when: datetime) -> bool:
+    expected = [row for row in rows if _live_at(row, when)]
+    return (
+        {row[0] for row in expected} == {row[0] for row in got}
+        and sorted((_order_key(row) for row in expected), key=lambda k: (k[0], k[1] is None, k[1] or time.min), reverse=True)
+        == [_order_key(row) for row in got]
+    )
+
+
+def check_schedule_index(args) -> int:
+    rng = random.Random(args.seed)
+    today = datetime.now().date()
+    first = datetime.combine(today - timedelta(days=22), time.min)
+    span_us = 60 * 24 * 3600 * 10**6
+    mismatches = probed = 0
+
+    def report(label: str, when: datetime, rows, got):
+        expected = [row[0] for row in rows if _live_at(row, when)]
+        print(f"MISMATCH ({label}) at {when.isoformat()}: expected={sorted(expected)} index={[r[0] for r in got]}")
+
+    for _ in range(args.rounds):
+        rows = []
+        for ad_id in range(1, args.schedules + 1):
+            schedule = _random_schedule(rng, today)
+            if schedule[5]:  # SCHEDULED_ADS_INDEX_QUERY only returns active rows
+                rows.append(_index_row(ad_id, schedule, rng.choice([None, None, rng.randint(1, 1000)])))
+
+        # Whole span at once, probed in random order and at every boundary
+        index = app.ScheduleIndex(rows)
+        index.at(first + timedelta(microseconds=span_us))
+        probes = [first + timedelta(microseconds=rng.randrange(span_us)) for _ in range(args.probes)]
+        for boundary in index.boundaries:
+            probes += [boundary, boundary - timedelta(microseconds=1)]
+        rng.shuffle(probes)
+        for when in probes:
+            got = index.at(when)["rows"]
+            if not _same_live_set(rows, got, when):
+                mismatches += 1
+                if mismatches <= 10:
+                    report("full", when, rows, got)
+        probed += len(probes)
+
+        # Rolling index as AdScheduleCache builds it: lookups only move forward, past many horizon extensions
+        since = first + timedelta(microseconds=rng.randrange(span_us // 4))
+        rolling = app.ScheduleIndex(rows, since=since, horizon=timedelta(hours=rng.choice([1, 6, 36])))
+        probes = sorted(since + timedelta(microseconds=rng.randrange(span_us // 2)) for _ in range(args.probes // 4))
+        for when in probes:
+            got = rolling.at(when)["rows"]
+            if not _same_live_set(rows, got, when):
+                mismatches += 1
+                if mismatches <= 10:
+                    report("rolling", when, rows, got)
+        probed += len(probes)
+
+    print(f"{args.rounds} rounds of {args.schedules} schedules, {probed} probes: {mismatches} mismatches")
+    return 1 if mismatches else 0
+
+
+def verify_schedule_index(args) -> int:
+    rng = random.Random(args.seed)
+    today = datetime.now().date()
+    schedules = [_random_schedule(rng, today) for _ in range(args.schedules)]
+
+    with app.db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            # Unqualified names resolve to pg_temp first, so the queries below see only this copy
+            # INCLUDING GENERATED keeps active_period; constraints are left out so random schedules may overlap
+            cur.execute("CREATE TEMP TABLE scheduled_ads (LIKE public.scheduled_ads INCLUDING DEFAULTS INCLUDING GENERATED)")
+            app.execute_values(
+                cur,
+                """
+                INSERT INTO scheduled_ads (
+                    title, start_date, end_date, start_time, end_time, is_active,
+                    recurrence_weekdays, recurrence_exceptions
+                )
+                VALUES %s
+                """,
+                schedules,
+            )
+            cur.execute(app.SCHEDULED_ADS_INDEX_QUERY, (None,))
+            index = app.ScheduleIndex(cur.fetchall())
+
+            first = datetime.combine(today - timedelta(days=22), time.min)
+            span_us = 60 * 24 * 3600 * 10**6
+            # Expand recurring schedules over the whole probe span so every boundary is listed
+            index.at(first + timedelta(microseconds=span_us))
+            probes = [first + timedelta(microseconds=rng.randrange(span_us)) for _ in range(args.probes)]
+            for boundary in index.boundaries:
+                probes += [boundary, boundary - timedelta(microseconds=1)]
+
+            mismatches = 0
+            for when in probes:
+                cur.execute(app.ACTIVE_ADS_QUERY, app._active_ads_params(when))
+                expected = cur.fetchall()
+                got = index.at(when)["rows"]
+                # Rows with equal start are in no particular order in SQL, so compare sets plus start order
+                same = (
+                    {row[0] for row in expected} == {row[0] for row in got}
+                    and [_order_key(row) for row in expected] == [_order_key(row) for row in got]
+                )
+                if not same:
+                    mismatches += 1
+                    if mismatches <= 10:
+                        print(f"MISMATCH at {when.isoformat()}: sql={[r[0] for r in expected]} index={[r[0] for r in got]}")
+        finally:
+            cur.close()
+            conn.rollback()
+
+    print(
+        f"{len(schedules)} schedules, {index.size} indexed, {len(index.boundaries)} boundaries, "
+        f"{len(probes)} probes: {mismatches} mismatches"
+    )
+    return 1 if mismatches else 0
+
+
+def backfill_rollups(args) -> int:
+    if args.since and args.until and args.until < args.since:
+        print("--until is before --since")
+        return 1
+    with app.db_cursor() as cur:
+        days = app.rebuild_email_rollups(cur, args.since, args.until)
+    print(f"Rebuilt {days} day(s) of signup rollups from {args.since or 'the first capture'} to {args.until or 'the last capture'}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    check = commands.add_parser("check-schedule-index", help="compare ScheduleIndex with a brute-force oracle, no database")
+    check.add_argument("--schedules", type=int, default=200)
+    check.add_argument("--probes", type=int, default=5000)
+    check.add_argument("--rounds", type=int, default=20)
+    check.add_argument("--seed", type=int, default=None)
+    check.set_defaults(handler=check_schedule_index)
+
+    verify = commands.add_parser("verify-schedule-index", help="compare ScheduleIndex with ACTIVE_ADS_QUERY")
+    verify.add_argument("--schedules", type=int, default=200)
+    verify.add_argument("--probes", type=int, default=2000)
+    verify.add_argument("--seed", type=int, default=None)
+    verify.set_defaults(handler=verify_schedule_index)
+
+    backfill = commands.add_parser("backfill-rollups", help="recompute daily signup rollups from trial_emails")
+    backfill.add_argument("--since", type=date.fromisoformat, default=None)
+    backfill.add_argument("--until", type=date.fromisoformat, default=None)
+    backfill.set_defaults(handler=backfill_rollups)
+
+    args = parser.parse_args()
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+"""ScheduleIndex against the rules of ACTIVE_ADS_QUERY, over randomized schedules.
+
+The oracle check needs no database: it compares ScheduleIndex with a
+brute-force evaluation of the SQL definitions (manage.py check-schedule-index).
+The SQL check compares it with ACTIVE_ADS_QUERY itself (manage.py
+verify-schedule-index) and runs only when TEST_DB_NAME names a database the
+DB_* settings can reach; it migrates that database and writes nothing else.
+
+    python -m pytest tests
+    TEST_DB_NAME=wifi_test python -m pytest tests
+"""
+import argparse
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # app finds img/, templates/ and .env relative to the working directory
+
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+if load_dotenv:
+    load_dotenv()
+if os.getenv("TEST_DB_NAME"):
+    os.environ["DB_NAME"] = os.environ["TEST_DB_NAME"]
+# app reads its database settings at import; the oracle check never connects
+os.environ.setdefault("DB_PORT", "5432")
+
+import app  # noqa: E402
+import manage  # noqa: E402
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_schedule_index_matches_oracle(seed):
+    args = argparse.Namespace(schedules=150, probes=2000, rounds=3, seed=seed)
+    assert manage.check_schedule_index(args) == 0
+
+
+@pytest.mark.skipif(not os.getenv("TEST_DB_NAME"), reason="TEST_DB_NAME is not set")
+@pytest.mark.parametrize("seed", [1, 2])
+def test_schedule_index_matches_active_ads_query(seed):
+    app.migrate_db()
+    args = argparse.Namespace(schedules=150, probes=1000, seed=seed)
+    assert manage.verify_schedule_index(args) == 0